@@ -1,11 +1,24 @@
-import h5py
 import glob
+import os
+import sys
 
-# snaps = sorted(glob.glob("/cosma7/data/dp004/dc-chai1/nearly_final_model/I102_L25N188_I75_BH_BOOST_SLOPE_0p0/colibre_????.hdf5"))
-snaps = sorted(glob.glob("Hypercube1/wdir_0/colibre_????.hdf5"))
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "../Visualisations/PlotMaps"
+    )
+)
+from redshift_table import RedshiftTable
 
-with open("snapshot_redshifts.txt", "w") as ofile:
-    for snap in snaps:
-        with h5py.File(snap, "r") as ifile:
-            z = ifile["/Header"].attrs["Redshift"][0]
-        ofile.write(f"{snap.split('/')[-1]}\t{z:.2f}\n")
+if __name__ == "__main__":
+
+    # snaps = sorted(glob.glob("/cosma7/data/dp004/dc-chai1/nearly_final_model/I102_L25N188_I75_BH_BOOST_SLOPE_0p0/colibre_????.hdf5"))
+    snaps = sorted(glob.glob("Hypercube1/wdir_0/colibre_????.hdf5"))
+
+    # the snapshot headers are read in parallel (this needs to happen in the
+    # main guard, since the worker processes import this script)
+    redshifts = RedshiftTable.from_snapshots(snaps, nproc=8)
+
+    with open("snapshot_redshifts.txt", "w") as ofile:
+        for isnap, snap in enumerate(snaps):
+            z = redshifts.get_redshift(isnap)
+            ofile.write(f"{snap.split('/')[-1]}\t{z:.2f}\n")
@@ -0,0 +1,75 @@
+import concurrent.futures
+import numpy as np
+
+"""
+batch_projection.py
+
+Project interpolated particle positions for a batch of frames at once.
+
+The star maps are simple 2D histograms of the particle masses (this is what
+the swiftsimio "histogram" backend does), so there is no need to put the
+interpolated positions back into a swiftsimio dataset and project every frame
+separately. Instead, the pixel indices for all frames in a batch (see
+trajectories.py) are computed in a single vectorised pass, and the masses are
+binned into all frame maps with a single call to numpy.bincount().
+
+Since the positions are wrapped into the box and the projected region lies
+inside the box, periodic copies of the particles never contribute to the
+maps.
+
+Writing the compressed maps takes longer than creating them. The maps of a
+batch are therefore written in parallel by a pool of threads (zlib releases
+the GIL while compressing).
+"""
+
+
+def get_pixel_indices(positions, region, res):
+    """
+    Get the flattened pixel index for the given (nframe, N, 3) positions in
+    maps with res x res pixels covering the given region
+    ([xmin, xmax, ymin, ymax, zmin, zmax], in the same units as the
+    positions). The pixel index includes the frame index.
+
+    Returns the pixel indices and a mask that selects the positions that fall
+    inside the region.
+    """
+    xmin, xmax, ymin, ymax, zmin, zmax = region
+    nframe = positions.shape[0]
+    ix = np.floor((positions[:, :, 0] - xmin) * (res / (xmax - xmin))).astype(np.int64)
+    iy = np.floor((positions[:, :, 1] - ymin) * (res / (ymax - ymin))).astype(np.int64)
+    z = positions[:, :, 2]
+    inside = (ix >= 0) & (ix < res) & (iy >= 0) & (iy < res) & (z >= zmin) & (z <= zmax)
+    index = np.arange(nframe, dtype=np.int64)[:, None] * res
+    index = (index + ix) * res + iy
+    return index, inside
+
+
+def project_batch(positions, masses, region, res):
+    """
+    Bin the given masses at the given (nframe, N, 3) positions into nframe
+    maps with res x res pixels covering the given region (see
+    get_pixel_indices()).
+
+    Returns an (nframe, res, res) array with the total mass in each pixel. The
+    first pixel index corresponds to the x coordinate.
+    """
+    nframe = positions.shape[0]
+    index, inside = get_pixel_indices(positions, region, res)
+    weights = np.broadcast_to(masses[None, :], inside.shape)[inside]
+    maps = np.bincount(index[inside], weights=weights, minlength=nframe * res * res)
+    return maps.reshape((nframe, res, res))
+
+
+def save_maps(filenames, maps, mapname="surfdens", nthread=1):
+    """
+    Save the given maps (one per file name) as compressed .npz files with the
+    given internal map name, using nthread threads.
+    """
+
+    def save_map(args):
+        filename, data = args
+        np.savez_compressed(filename, **{mapname: data})
+
+    with concurrent.futures.ThreadPoolExecutor(nthread) as executor:
+        # list() makes sure that exceptions in the threads are raised here
+        list(executor.map(save_map, zip(filenames, maps)))
@@ -0,0 +1,178 @@
+import numpy as np
+
+"""
+cell_selection.py
+
+Read the particles in a fixed region from a sequence of SWIFT snapshots,
+without building a new spatial mask for every snapshot.
+
+SWIFT snapshots contain a "Cells" group with the centres of the top level
+cells, and, for every particle type, the number of particles in each cell and
+the offset of the first particle of each cell in the particle datasets. The
+cells that overlap with a region only depend on the cell grid, which is the
+same for all snapshots of a run. CellSelection therefore selects the cells
+once, and only reads the (small) counts and offsets for every snapshot to
+turn the selection into ranges of particles. A cheap check of the cell grid
+metadata makes sure the selection is recomputed if a snapshot uses a
+different grid.
+
+Particles can drift slightly outside their cell between tree rebuilds, so the
+cells are padded by a margin (a fraction of the cell size) when they are
+selected. Particles outside the region itself are not removed.
+
+All positions are in the internal length units of the snapshot.
+"""
+
+
+def get_cell_grid(handle):
+    """
+    Get the structure of the cell grid of the given (open) snapshot: the
+    number of cells in each dimension, the cell size and the number of cells.
+    """
+    metadata = handle["Cells/Meta-data"].attrs
+    return (
+        tuple(int(n) for n in np.ravel(metadata["dimension"])),
+        tuple(float(x) for x in np.ravel(metadata["size"])),
+        int(np.ravel(metadata["nr_cells"])[0]),
+    )
+
+
+def get_boxsize(handle):
+    """
+    Get the box size of the given (open) snapshot, in all 3 dimensions.
+    """
+    boxsize = np.ravel(handle["Header"].attrs["BoxSize"]).astype(np.float64)
+    if boxsize.shape[0] == 1:
+        boxsize = np.repeat(boxsize, 3)
+    return boxsize
+
+
+def select_cells(centres, cell_size, region, boxsize, margin=0.1):
+    """
+    Get the indices of the cells with the given centres that overlap with the
+    given region ([[xmin, xmax], [ymin, ymax], [zmin, zmax]]), taking into
+    account periodic wrapping. The cells are padded by margin times the cell
+    size on all sides.
+    """
+    region = np.asarray(region, dtype=np.float64)
+    region_centre = 0.5 * (region[:, 0] + region[:, 1])
+    region_half = 0.5 * (region[:, 1] - region[:, 0])
+    cell_half = (0.5 + margin) * np.asarray(cell_size, dtype=np.float64)
+
+    dx = centres - region_centre[None, :]
+    dx -= boxsize[None, :] * np.round(dx / boxsize[None, :])
+    overlaps = np.all(np.abs(dx) <= (region_half + cell_half)[None, :], axis=1)
+    return np.flatnonzero(overlaps)
+
+
+def merge_ranges(offsets, counts):
+    """
+    Turn the given particle offsets and counts into a sorted list of
+    [begin, end) ranges, merging ranges that are adjacent.
+    """
+    keep = counts > 0
+    begins = offsets[keep]
+    ends = begins + counts[keep]
+    order = np.argsort(begins)
+    begins = begins[order]
+    ends = ends[order]
+    if begins.shape[0] == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    # a new range starts wherever a range does not continue the previous one
+    starts = np.ones(begins.shape[0], dtype=bool)
+    starts[1:] = begins[1:] != ends[:-1]
+    istart = np.flatnonzero(starts)
+    iend = np.append(istart[1:], begins.shape[0]) - 1
+    return np.stack([begins[istart], ends[iend]], axis=1).astype(np.int64)
+
+
+class CellSelection:
+    """
+    Cells that overlap with a fixed region, shared by all snapshots that use
+    the same cell grid.
+    """
+
+    def __init__(self, region, margin=0.1):
+        """
+        Create an (empty) selection for the given region
+        ([[xmin, xmax], [ymin, ymax], [zmin, zmax]], in internal length
+        units), with the given cell margin (in units of the cell size). The
+        cells are selected for the first snapshot that is used.
+        """
+        self.region = np.asarray(region, dtype=np.float64)
+        self.margin = margin
+        self.grid = None
+        self.cells = None
+
+    def update(self, handle):
+        """
+        Make sure the selection is valid for the given (open) snapshot. The
+        cells are only selected again if the cell grid is different.
+
+        Returns True if the cells were selected again.
+        """
+        grid = get_cell_grid(handle)
+        if grid == self.grid:
+            return False
+        centres = handle["Cells/Centres"][...]
+        self.cells = select_cells(
+            centres, grid[1], self.region, get_boxsize(handle), self.margin
+        )
+        self.grid = grid
+        return True
+
+    def get_ranges(self, handle, group):
+        """
+        Get the ranges of particles of the given type (e.g. "PartType4") in
+        the selected cells of the given (open) snapshot, as an (nrange, 2)
+        array of [begin, end) indices.
+        """
+        self.update(handle)
+        cells = handle["Cells"]
+        if not group in cells["Counts"]:
+            return np.zeros((0, 2), dtype=np.int64)
+        offsets = cells["OffsetsInFile" if "OffsetsInFile" in cells else "Offsets"]
+        counts = cells["Counts"][group][...][self.cells]
+        offsets = offsets[group][...][self.cells]
+        return merge_ranges(offsets.astype(np.int64), counts.astype(np.int64))
+
+
+def read_particles(handle, group, fields, ranges):
+    """
+    Read the given fields of the given particle type (e.g. "PartType4") from
+    the given (open) snapshot, for the given ranges of particles (see
+    CellSelection.get_ranges()).
+
+    Returns a dictionary with the raw values (in internal units) for each
+    field. If the snapshot does not contain the particle type, the arrays are
+    empty.
+    """
+    data = {}
+    for field in fields:
+        if not group in handle:
+            data[field] = np.zeros(0)
+            continue
+        dataset = handle[group][field]
+        size = int(np.sum(ranges[:, 1] - ranges[:, 0]))
+        values = np.empty((size,) + dataset.shape[1:], dtype=dataset.dtype)
+        ioffset = 0
+        for begin, end in ranges:
+            dataset.read_direct(
+                values, np.s_[begin:end], np.s_[ioffset : ioffset + end - begin]
+            )
+            ioffset += end - begin
+        data[field] = values
+    return data
+
+
+def get_internal_units(handle):
+    """
+    Get the internal length, mass and time unit of the given (open) snapshot,
+    in cgs units.
+    """
+    units = handle["Units"].attrs
+    return {
+        "length": float(np.ravel(units["Unit length in cgs (U_L)"])[0]),
+        "mass": float(np.ravel(units["Unit mass in cgs (U_M)"])[0]),
+        "time": float(np.ravel(units["Unit time in cgs (U_t)"])[0]),
+    }
@@ -0,0 +1,126 @@
+import numpy as np
+
+"""
+id_matching.py
+
+Match particles between snapshots using their (unique) particle IDs.
+
+The particles of each snapshot are sorted on ID once (see SortedParticles).
+Matching two sets of sorted particles is then a single join of two sorted
+arrays, which returns the indices of the common particles in both sets at
+once. PairMatcher keeps the sorted particles of the second snapshot of a pair,
+so that they can be reused as the first snapshot of the next pair: every
+snapshot in a sequence is only sorted once.
+
+Nothing in here is specific to a particle type.
+"""
+
+
+class SortedParticles:
+    """
+    Particle IDs and coordinates of a single snapshot, sorted on ID.
+    """
+
+    def __init__(self, ids, coordinates, key=None, velocities=None):
+        """
+        Sort the given particle IDs and (N, 3) coordinates (and optionally
+        velocities) on ID.
+
+        The key (e.g. the snapshot number) can be used to identify the
+        snapshot. The order attribute contains the original index of each
+        sorted particle.
+        """
+        self.key = key
+        self.order = np.argsort(ids)
+        self.ids = ids[self.order]
+        self.coordinates = coordinates[self.order]
+        self.velocities = None
+        if velocities is not None:
+            self.velocities = velocities[self.order]
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+
+def match_sorted_ids(ids_1, ids_2):
+    """
+    Find the IDs that are present in both given sorted arrays of unique IDs.
+
+    Returns the indices of the common IDs in ids_1 and ids_2, in increasing
+    order of ID, so that ids_1[index_1] == ids_2[index_2].
+    """
+    if ids_1.shape[0] == 0 or ids_2.shape[0] == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty.copy()
+    index_2 = np.searchsorted(ids_2, ids_1)
+    np.minimum(index_2, ids_2.shape[0] - 1, out=index_2)
+    found = ids_2[index_2] == ids_1
+    return np.flatnonzero(found), index_2[found]
+
+
+class PairMatcher:
+    """
+    Match particles between consecutive pairs of snapshots.
+
+    Usage:
+      matcher = PairMatcher()
+      for snap in snapshots:
+        matcher.add_snapshot(SortedParticles(ids, coordinates, key=snap))
+        if matcher.first is not None:
+          coordinates_1, coordinates_2 = matcher.get_matched_coordinates()
+    """
+
+    def __init__(self):
+        self.first = None
+        self.second = None
+        self.index_1 = None
+        self.index_2 = None
+
+    def add_snapshot(self, particles):
+        """
+        Add the next snapshot (a SortedParticles object). The previous second
+        snapshot becomes the first snapshot, and the particles of both are
+        matched.
+        """
+        self.first = self.second
+        self.second = particles
+        self.index_1 = None
+        self.index_2 = None
+        if self.first is not None:
+            self.index_1, self.index_2 = match_sorted_ids(
+                self.first.ids, self.second.ids
+            )
+
+    def get_matched_coordinates(self):
+        """
+        Get the coordinates of the particles that are present in both
+        snapshots, in the same (ID) order for both snapshots.
+        """
+        return (
+            self.first.coordinates[self.index_1],
+            self.second.coordinates[self.index_2],
+        )
+
+    def get_matched_velocities(self):
+        """
+        Get the velocities of the particles that are present in both
+        snapshots, in the same order as get_matched_coordinates().
+        """
+        return (
+            self.first.velocities[self.index_1],
+            self.second.velocities[self.index_2],
+        )
+
+    def get_first_indices(self):
+        """
+        Get the original (unsorted) indices of the matched particles in the
+        first snapshot, in the same order as get_matched_coordinates().
+        """
+        return self.first.order[self.index_1]
+
+    def get_second_indices(self):
+        """
+        Get the original (unsorted) indices of the matched particles in the
+        second snapshot, in the same order as get_matched_coordinates().
+        """
+        return self.second.order[self.index_2]
@@ -4,13 +4,27 @@ import sys
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
-import swiftsimio
 import unyt
 
+from id_matching import SortedParticles, PairMatcher
+from trajectories import (
+    interpolate_linear,
+    interpolate_hermite,
+    get_position_derivatives,
+)
+from batch_projection import project_batch, save_maps
+from cell_selection import CellSelection, read_particles, get_internal_units
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../PlotMaps"))
+from redshift_table import RedshiftTable
+
 box_size = int(sys.argv[1])
 n_part = int(sys.argv[2])
 run = sys.argv[3]
 n_frame = int(sys.argv[4])
+# optional: interpolation scheme, "linear" (default) or "hermite" (cubic,
+# using the star velocities)
+interpolation = sys.argv[5] if len(sys.argv) > 5 else 'linear'
 
 sim_name = f'L{box_size:04d}N{n_part:04d}/{run}/'
 flamingo_dir = f'/cosma8/data/dp004/flamingo/Runs/{sim_name}/'
@@ -54,6 +68,16 @@ region = [
         bcentre[2] + zwidth/2,
 ]
 
+# Region in Mpc, and area of a pixel
+region_Mpc = [r.to('Mpc').value for r in region]
+pixel_area = (region[1] - region[0]) * (region[3] - region[2]) / res**2
+
+# Number of frames that are interpolated and projected in one go (every
+# frame needs a res x res double precision map), and number of threads
+# used to write the maps
+batch_size = 4
+n_thread = 8
+
 zmin = 0
 zmax = 15
 a_range = np.linspace(1.0 / (1 + zmax), 1.0, n_frame)
@@ -62,107 +86,125 @@ z_range = 1.0 / a_range - 1.0
 def get_flamingo_filename(snap):
     return f'{flamingo_dir}snapshots/flamingo_{snap:04d}/flamingo_{snap:04d}.hdf5'
 
-def get_file_redshift(snap):
+# Snapshot redshifts, read once instead of opening the snapshot headers
+# for every frame
+redshifts = RedshiftTable.from_output_list(f'{flamingo_dir}output_list.txt')
+
+# The cells that overlap with the load region are selected once, and
+# reused for all snapshots with the same cell grid
+cell_selection = None
+Mpc_in_cgs = (1.0 * unyt.Mpc).to('cm').value
+
+def load_snapshot(snap):
+    # Read the stars in the load region, in Mpc, g and dx/da (in Mpc)
+    global cell_selection
+    print(f'Loading snapshot {snap}')
     filename = get_flamingo_filename(snap)
-    with h5py.File(filename, 'r') as file:
-        z = file['Header'].attrs['Redshift']
-    return z
+    fields = ['ParticleIDs', 'Coordinates', 'Masses']
+    if interpolation == 'hermite':
+        fields.append('Velocities')
+    with h5py.File(filename, 'r') as handle:
+        units = get_internal_units(handle)
+        length_unit = units['length'] / Mpc_in_cgs
+        if cell_selection is None:
+            cell_selection = CellSelection(
+                [[x.to('Mpc').value / length_unit for x in r] for r in load_region]
+            )
+        if cell_selection.update(handle):
+            print(f'Selected {cell_selection.cells.shape[0]} cells')
+        ranges = cell_selection.get_ranges(handle, 'PartType4')
+        data = read_particles(handle, 'PartType4', fields, ranges)
+        H = handle['Cosmology'].attrs['H [internal units]'][0]
+
+    stars = {
+        'ids': data['ParticleIDs'],
+        'coordinates': data['Coordinates'].reshape((-1, 3)) * length_unit,
+        'masses': data['Masses'] * units['mass'],
+    }
+    if interpolation == 'hermite':
+        # velocities and H are both in internal units
+        a = redshifts.get_scale_factor(snap)
+        dxda = get_position_derivatives(data['Velocities'].reshape((-1, 3)), a, H)
+        stars['dxda'] = dxda * length_unit
+    return stars
+
+def sort_stars(stars, snap):
+    # Sort the stars on ID and recentre them, once per snapshot
+    # For Hermite interpolation, we also need dx/da, which we store
+    # as the particle velocities
+    if not stars['ids'].shape[0]:
+        print(f'No star particles found')
+    particles = SortedParticles(
+        stars['ids'], stars['coordinates'], key=snap, velocities=stars.get('dxda')
+    )
+    particles.coordinates = (particles.coordinates + bcentre.value - centre.value) % box_size
+    return particles
 
+# The sorted stars of the second snapshot of a pair are reused when
+# it becomes the first snapshot of the next pair
+matcher = PairMatcher()
 snap = 0
 i_frame = 0
-reload_data = True
 while i_frame < n_frame:
-    print(f'Frame: {i_frame}')
 
-    # Check if curent redshift is still between the two loaded snapshots
-    while z_range[i_frame] < get_file_redshift(snap+1):
+    # Find the snapshot pair for the current redshift, and all frames
+    # that lie between the same two snapshots
+    while z_range[i_frame] < redshifts.get_redshift(snap+1):
         snap += 1
-        reload_data = True
-
-    if reload_data:
-        try:
-            data_1 = data_2
-        except NameError:
-            print(f'Loading snapshot {snap}')
-            filename_1 = get_flamingo_filename(snap)
-            mask_1 = swiftsimio.mask(filename_1, spatial_only=True)
-            mask_1.constrain_spatial(load_region)
-            data_1 = swiftsimio.load(filename_1, mask=mask_1)
-
-        print(f'Loading snapshot {snap+1}')
-        filename_2 = get_flamingo_filename(snap+1)
-        mask_2 = swiftsimio.mask(filename_2, spatial_only=True)
-        mask_2.constrain_spatial(load_region)
-        data_2 = swiftsimio.load(filename_2, mask=mask_2)
-
-        try:
-            print(f'Sorting particles')
-            ids_1 = data_1.stars.particle_ids.value
-            argsort_1 = np.argsort(ids_1)
-            ids_1 = ids_1[argsort_1]
-            coords_1 = data_1.stars.coordinates.value[argsort_1]
-            coords_1 = (coords_1 + bcentre.value - centre.value) % box_size
-
-            ids_2 = data_2.stars.particle_ids.value
-            argsort_2 = np.argsort(ids_2)
-            ids_2 = ids_2[argsort_2]
-            coords_2 = data_2.stars.coordinates.value[argsort_2]
-            coords_2 = (coords_2 + bcentre.value - centre.value) % box_size
-
-            # Find which ids in ids_1 are also in ids_2
-            s_1 = np.searchsorted(ids_2, ids_1)
-            m_1 = s_1 < ids_2.shape[0]
-            m_1[m_1] = ids_2[s_1[m_1]] == ids_1[m_1]
-
-            # Same the other way
-            s_2 = np.searchsorted(ids_1, ids_2)
-            m_2 = s_2 < ids_1.shape[0]
-            m_2[m_2] = ids_1[s_2[m_2]] == ids_2[m_2]
-
-            coords_1 = coords_1[m_1]
-            coords_2 = coords_2[m_2]
-        except AttributeError:
-            print(f'No star particles found')
-            coords_1 = np.zeros(shape=(0, 3))
-            coords_2 = np.zeros(shape=(0, 3))
-        reload_data = False
-
-    # Interpolate positions
-    a = 1 / (1 + z_range[i_frame])
-    a_1 = 1 / (1 + get_file_redshift(snap))
-    a_2 = 1 / (1 + get_file_redshift(snap+1))
-    frac = (a - a_1) / (a_2 - a_1)
-    positions = (1 - frac) * coords_1 + frac * coords_2 
-
-    if not positions.shape[0]:
-        i_frame += 1
+    frames = [i_frame]
+    while frames[-1] + 1 < n_frame and z_range[frames[-1]+1] >= redshifts.get_redshift(snap+1):
+        frames.append(frames[-1] + 1)
+    i_frame = frames[-1] + 1
+
+    if matcher.second is None or matcher.second.key != snap:
+        data_2 = load_snapshot(snap)
+        matcher.add_snapshot(sort_stars(data_2, snap))
+    data_1 = data_2
+
+    data_2 = load_snapshot(snap+1)
+    print(f'Sorting particles')
+    matcher.add_snapshot(sort_stars(data_2, snap+1))
+    coords_1, coords_2 = matcher.get_matched_coordinates()
+    if interpolation == 'hermite':
+        dxda_1, dxda_2 = matcher.get_matched_velocities()
+
+    if not coords_1.shape[0]:
         continue
 
-    # Setting positions within swiftswimio object
-    # Stars not present in both snapshots are moved to origin
-    data_1.stars.coordinates *= 0
-    data_1.stars.coordinates[argsort_1[m_1]] += positions * unyt.Mpc
-
-    # TODO: Calculate smoothing lengths
-
-    print('Creating projection')
-    star_mass = swiftsimio.visualisation.projection.project_pixel_grid(
-        data=data_1.stars,
-        boxsize=data_1.metadata.boxsize,
-        resolution=res,
-        project="masses",
-        parallel=True,
-        region=region,
-        backend="histogram",
-    )
-    # This unit stuff was lifted from one of Bert's scripts, I'm not sure it matters
-    units = 1.0 / ((region[1] - region[0]) * (region[3] - region[2]))
-    units.convert_to_units(1.0 / (region[0].units * region[2].units))
-    units *= data_1.stars.masses.units
-    star_mass = unyt.unyt_array(star_mass, units=units)
-    star_mass.convert_to_units("g/cm**2")
-
-    np.savez_compressed(f'{output_dir}/stars_{i_frame:04d}.npz', surfdens=star_mass)
-
-    i_frame += 1
-
+    # Stars not present in both snapshots are not shown
+    masses = data_1['masses'][matcher.get_first_indices()]
+    # Conversion factor from mass (in g) per pixel to surface density
+    mass_to_sigma = 1.0 / pixel_area.to('cm**2').value
+
+    for i_batch in range(0, len(frames), batch_size):
+        batch = frames[i_batch:i_batch+batch_size]
+        print(f'Frames: {batch[0]}-{batch[-1]}')
+
+        # Interpolate positions, taking into account that stars can cross
+        # the periodic boundary between the two snapshots
+        if interpolation == 'hermite':
+            positions = interpolate_hermite(
+                coords_1,
+                coords_2,
+                dxda_1,
+                dxda_2,
+                redshifts.get_scale_factor(snap),
+                redshifts.get_scale_factor(snap+1),
+                1 / (1 + z_range[batch]),
+                box_size,
+            )
+        else:
+            fracs = redshifts.get_interpolation_factor(snap, z_range[batch])
+            positions = interpolate_linear(coords_1, coords_2, fracs, box_size)
+
+        print('Creating projections')
+        star_mass = project_batch(positions, masses, region_Mpc, res)
+        del positions
+        star_mass *= mass_to_sigma
+
+        save_maps(
+            [f'{output_dir}/stars_{i:04d}.npz' for i in batch],
+            star_mass,
+            nthread=n_thread,
+        )
+        del star_mass
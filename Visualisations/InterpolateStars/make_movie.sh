@@ -15,8 +15,13 @@ sim_name="L${box_size}N${n_part}/${run}"
 
 # Extract and interpolate stars
 python -u interpolate_stars.py $box_size $n_part $run $n_frame
+# (add "hermite" to interpolate the star trajectories using their velocities)
 python -u plot_frames.py $box_size $n_part $run $n_frame
 
+# Alternatively, pipe the frames directly into ffmpeg (if available), which
+# skips writing the PNG files:
+# python -u plot_frames.py $box_size $n_part $run $n_frame 0_stars.mp4
+
 # Copy files to laptop
 # Set framerate such that runtime is ~20s
 # ffmpeg -framerate 10 -i frame_%04d.png -c:v libx264 -pix_fmt yuv420p 0_stars.mp4
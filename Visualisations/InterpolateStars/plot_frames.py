@@ -1,3 +1,5 @@
+import io
+import os
 import sys
 
 import astropy.cosmology
@@ -5,10 +7,18 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../PlotMaps/Evolution"))
+from video_pipe import VideoWriter
+
 box_size = int(sys.argv[1])
 n_part = int(sys.argv[2])
 run = sys.argv[3]
 n_frame = int(sys.argv[4])
+# optional: name of a video file. If given, frames are piped directly into
+# ffmpeg instead of being written as PNG files
+video_file = sys.argv[5] if len(sys.argv) > 5 else None
+framerate = 10
+dpi = 240
 
 sim_name = f'L{box_size:04d}N{n_part:04d}/{run}/'
 # TODO: Set dir
@@ -20,6 +30,10 @@ zmax = 15
 a_range = np.linspace(1.0 / (1 + zmax), 1.0, n_frame)
 z_range = 1.0 / a_range - 1.0
 
+video = None
+if video_file is not None:
+    video = VideoWriter(video_file, 16 * dpi, 9 * dpi, framerate)
+
 for i_frame in range(n_frame):
     print(f'Plotting frame: {i_frame}')
     z = z_range[i_frame]
@@ -61,7 +75,17 @@ for i_frame in range(n_frame):
     ax1.imshow(logo)
     ax1.axis('off')
 
-    plt.savefig(f'{output_dir}/frame_{i_frame:04d}.png', dpi=240)
+    if video is None:
+        plt.savefig(f'{output_dir}/frame_{i_frame:04d}.png', dpi=dpi)
+    else:
+        # render the frame as raw RGBA data and pass it on to ffmpeg
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='rgba', dpi=dpi)
+        frame = np.frombuffer(buffer.getbuffer(), dtype=np.uint8)
+        video.write(frame.reshape((9 * dpi, 16 * dpi, 4)))
     fig.clear()
     plt.close(fig)
 
+if video is not None:
+    video.close()
+
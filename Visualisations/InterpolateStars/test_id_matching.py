@@ -0,0 +1,122 @@
+import numpy as np
+
+from id_matching import SortedParticles, PairMatcher
+
+"""
+test_id_matching.py
+
+Check that id_matching.py gives the same result as the two-way searchsorted
+join that interpolate_stars.py used before.
+
+Run with "python3 -m pytest test_id_matching.py", or simply with
+"python3 test_id_matching.py".
+"""
+
+
+def old_join(ids_1, coordinates_1, ids_2, coordinates_2):
+    """
+    The original matching code from interpolate_stars.py.
+
+    Returns coords_1, coords_2 and the original indices of the matched
+    particles in the first snapshot (argsort_1[m_1]).
+    """
+    argsort_1 = np.argsort(ids_1)
+    ids_1 = ids_1[argsort_1]
+    coords_1 = coordinates_1[argsort_1]
+
+    argsort_2 = np.argsort(ids_2)
+    ids_2 = ids_2[argsort_2]
+    coords_2 = coordinates_2[argsort_2]
+
+    # Find which ids in ids_1 are also in ids_2
+    s_1 = np.searchsorted(ids_2, ids_1)
+    m_1 = s_1 < ids_2.shape[0]
+    m_1[m_1] = ids_2[s_1[m_1]] == ids_1[m_1]
+
+    # Same the other way
+    s_2 = np.searchsorted(ids_1, ids_2)
+    m_2 = s_2 < ids_1.shape[0]
+    m_2[m_2] = ids_1[s_2[m_2]] == ids_2[m_2]
+
+    return coords_1[m_1], coords_2[m_2], argsort_1[m_1]
+
+
+def new_join(ids_1, coordinates_1, ids_2, coordinates_2):
+    """
+    The same join, using PairMatcher.
+    """
+    matcher = PairMatcher()
+    matcher.add_snapshot(SortedParticles(ids_1, coordinates_1, key=0))
+    matcher.add_snapshot(SortedParticles(ids_2, coordinates_2, key=1))
+    coords_1, coords_2 = matcher.get_matched_coordinates()
+    return coords_1, coords_2, matcher.get_first_indices()
+
+
+def make_snapshot(rng, ids):
+    """
+    Create a snapshot with the given IDs (in random order) and random
+    coordinates.
+    """
+    ids = rng.permutation(np.asarray(ids, dtype=np.int64))
+    return ids, rng.random((ids.shape[0], 3))
+
+
+def check_pair(name, snapshot_1, snapshot_2):
+    old = old_join(*snapshot_1, *snapshot_2)
+    new = new_join(*snapshot_1, *snapshot_2)
+    for old_values, new_values in zip(old, new):
+        assert old_values.shape == new_values.shape, name
+        assert np.array_equal(old_values, new_values), name
+
+
+def get_id_sets(rng):
+    """
+    Pairs of ID sets: random overlapping, disjoint, empty and one-sided sets.
+    """
+    pool = rng.choice(1 << 40, size=3000, replace=False)
+    return {
+        "random": (pool[:2000], pool[1000:]),
+        "identical": (pool[:1000], pool[:1000]),
+        "subset": (pool[:1000], pool[200:700]),
+        "disjoint": (pool[:1000], pool[1000:2000]),
+        "interleaved": (np.arange(0, 2000, 2), np.arange(1, 2001, 2)),
+        "empty": (pool[:0], pool[:0]),
+        "first empty": (pool[:0], pool[:1000]),
+        "second empty": (pool[:1000], pool[:0]),
+    }
+
+
+def test_pairs():
+    rng = np.random.default_rng(41)
+    for name, (ids_1, ids_2) in get_id_sets(rng).items():
+        check_pair(name, make_snapshot(rng, ids_1), make_snapshot(rng, ids_2))
+
+
+def test_sequence():
+    # the second snapshot of a pair is reused as the first snapshot of the
+    # next pair: this should be the same as sorting it again
+    rng = np.random.default_rng(42)
+    pool = rng.choice(1 << 40, size=3000, replace=False)
+    snapshots = [
+        make_snapshot(rng, pool[:2000]),
+        make_snapshot(rng, pool[500:2500]),
+        make_snapshot(rng, pool[1000:]),
+    ]
+    matcher = PairMatcher()
+    for snap, (ids, coordinates) in enumerate(snapshots):
+        matcher.add_snapshot(SortedParticles(ids, coordinates, key=snap))
+        if snap == 0:
+            assert matcher.first is None
+            continue
+        assert matcher.first.key == snap - 1
+        coords_1, coords_2 = matcher.get_matched_coordinates()
+        old = old_join(*snapshots[snap - 1], *snapshots[snap])
+        assert np.array_equal(coords_1, old[0])
+        assert np.array_equal(coords_2, old[1])
+        assert np.array_equal(matcher.get_first_indices(), old[2])
+
+
+if __name__ == "__main__":
+    test_pairs()
+    test_sequence()
+    print("All tests passed.")
@@ -0,0 +1,106 @@
+import numpy as np
+
+"""
+trajectories.py
+
+Interpolate particle positions between two snapshots in a periodic box.
+
+Positions are interpolated along the displacement between the two snapshots,
+using minimum image differences: a particle that crosses the periodic
+boundary between the two snapshots moves across the boundary, instead of
+flying across the whole box. The interpolated positions are wrapped back into
+the box.
+
+Two interpolation schemes are supported, both as a function of an
+interpolation variable t (e.g. the scale factor) that goes from t_1 (first
+snapshot) to t_2 (second snapshot):
+ - linear interpolation of the positions.
+ - cubic Hermite interpolation, which also uses the derivatives of the
+   positions with respect to t in both snapshots (e.g. computed from the
+   particle velocities, see get_position_derivatives()), so that particles
+   follow curved trajectories and move smoothly from one snapshot pair to the
+   next.
+
+All functions are vectorised over particles and over frames: they return the
+positions for a whole batch of frames at once, as an array with shape
+(nframe, N, 3).
+"""
+
+
+def minimum_image(dx, boxsize):
+    """
+    Get the minimum image of the given (N, 3) coordinate differences in a
+    periodic box with the given size.
+    """
+    return dx - boxsize * np.round(dx / boxsize)
+
+
+def get_weights(fracs):
+    """
+    Get the cubic Hermite basis weights for the given interpolation fractions
+    (between 0 and 1): the weight of the displacement and the weights of the
+    derivatives at the start and end point.
+    """
+    fracs = np.asarray(fracs, dtype=np.float64)
+    f2 = fracs * fracs
+    f3 = f2 * fracs
+    wdx = -2.0 * f3 + 3.0 * f2
+    wm1 = f3 - 2.0 * f2 + fracs
+    wm2 = f3 - f2
+    return wdx, wm1, wm2
+
+
+def interpolate_linear(coordinates_1, coordinates_2, fracs, boxsize):
+    """
+    Linearly interpolate between the given (N, 3) coordinates for each of the
+    given interpolation fractions (0 for the first snapshot, 1 for the
+    second).
+
+    Returns an array with shape (nframe, N, 3), wrapped into the box.
+    """
+    fracs = np.atleast_1d(np.asarray(fracs, dtype=coordinates_1.dtype))
+    dx = minimum_image(coordinates_2 - coordinates_1, boxsize)
+    positions = fracs[:, None, None] * dx[None, :, :]
+    positions += coordinates_1[None, :, :]
+    np.mod(positions, boxsize, out=positions)
+    return positions
+
+
+def interpolate_hermite(
+    coordinates_1, coordinates_2, derivatives_1, derivatives_2, t_1, t_2, ts, boxsize
+):
+    """
+    Cubic Hermite interpolation between the given (N, 3) coordinates at t_1
+    and t_2, for each of the given values of the interpolation variable.
+    derivatives_1 and derivatives_2 are the derivatives of the coordinates
+    with respect to the interpolation variable at t_1 and t_2.
+
+    Returns an array with shape (nframe, N, 3), wrapped into the box.
+    """
+    ts = np.atleast_1d(np.asarray(ts, dtype=np.float64))
+    dt = t_2 - t_1
+    wdx, wm1, wm2 = get_weights((ts - t_1) / dt)
+    dtype = coordinates_1.dtype
+
+    dx = minimum_image(coordinates_2 - coordinates_1, boxsize)
+    positions = np.empty((ts.shape[0],) + coordinates_1.shape, dtype=dtype)
+    for iframe in range(ts.shape[0]):
+        position = positions[iframe]
+        np.multiply(dx, dtype.type(wdx[iframe]), out=position)
+        position += dtype.type(wm1[iframe] * dt) * derivatives_1
+        position += dtype.type(wm2[iframe] * dt) * derivatives_2
+        position += coordinates_1
+        np.mod(position, boxsize, out=position)
+    return positions
+
+
+def get_position_derivatives(velocities, a, H):
+    """
+    Convert the given peculiar velocities (a dx/dt, with x the comoving
+    position) at scale factor a into derivatives of the comoving position with
+    respect to the scale factor, dx/da = v / (a^2 H(a)).
+
+    Velocities and the Hubble parameter H (at scale factor a) should use
+    consistent units, e.g. km/s and km/s/Mpc for positions in Mpc.
+    """
+    return velocities / (a * a * H)
@@ -6,6 +6,8 @@ import multiprocessing as mp
 import argparse
 import os
 
+from compositor import render_overlay, composite, read_png, write_png
+
 pl.rcParams["text.usetex"] = True
 
 labels = {
@@ -34,6 +36,26 @@ def add_label(args):
 
   return output
 
+def add_label_fast(args):
+  """
+  Same as add_label(), but composes the label directly onto the image (see
+  compositor.py), without displaying the image in a matplotlib figure.
+  """
+
+  z, type, input, output = args
+
+  img = np.array(read_png(input))
+  height, width = img.shape[:2]
+
+  def draw(fig, ax):
+    ax.text(50. / width, 1. - 50. / height, f"$z = {z:5.2f}$, {labels[type]}",
+            color="w", transform=ax.transAxes)
+
+  composite(img, render_overlay(width, height, draw, dpi=300))
+  write_png(output, img)
+
+  return output
+
 if __name__ == "__main__":
 
   mp.set_start_method("forkserver")
@@ -46,6 +68,7 @@ if __name__ == "__main__":
   argparser.add_argument("--nproc", "-j", type=int, default=1)
   argparser.add_argument("--imin", "-i", type=int, default=-1)
   argparser.add_argument("--imax", "-I", type=int, default=-1)
+  argparser.add_argument("--compositor", action="store_true")
   args = argparser.parse_args()
 
   a_range = np.linspace(1./(1.+args.zmax), 1., args.nframe)
@@ -65,5 +88,6 @@ if __name__ == "__main__":
   os.makedirs(args.outputfolder, exist_ok=True)
 
   pool = mp.Pool(args.nproc)
-  for output in pool.imap_unordered(add_label, arglist):
+  function = add_label_fast if args.compositor else add_label
+  for output in pool.imap_unordered(function, arglist):
     print(output)
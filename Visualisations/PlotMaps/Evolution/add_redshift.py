@@ -2,6 +2,11 @@ import numpy as np
 import yaml
 import argparse
 import re
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from redshift_table import RedshiftTable
 
 if __name__ == "__main__":
 
@@ -14,11 +19,11 @@ if __name__ == "__main__":
   with open(args.limitsfile, "r") as handle:
     limits = yaml.safe_load(handle.read())
 
-  zs = np.loadtxt(args.redshiftfile)
+  redshifts = RedshiftTable.from_output_list(args.redshiftfile)
 
   for file in limits:
     idx = int(re.search("00\d\d", file)[0])
-    limits[file]["redshift"] = f"{zs[idx]:.2f}"
+    limits[file]["redshift"] = f"{redshifts.get_redshift(idx):.2f}"
 
   with open(args.outputfile, "w") as handle:
     handle.write(yaml.safe_dump(limits))
@@ -5,6 +5,15 @@ import matplotlib.pyplot as pl
 import multiprocessing as mp
 import argparse
 import os
+import functools
+
+from compositor import (
+  render_overlay,
+  composite,
+  resize,
+  read_png,
+  write_png,
+)
 
 pl.rcParams["text.usetex"] = True
 
@@ -15,6 +24,9 @@ labels = {
   "xray": "ROSAT X-ray luminosity",
 }
 
+# size (in pixels) of each half of a combined frame
+frame_size = 1800
+
 def get_label_fraction(box_size):
     """
     Get an appropriate size (as a fraction of the box size) for the ruler
@@ -29,21 +41,19 @@ def get_label_fraction(box_size):
         label_fraction *= 0.5
     return label_fraction
 
-def combine_frames(args):
-
-  z, type, input_large, input_small, output, selection, boxsize = args
+def draw_annotations(fig, ax, selection, boxsize):
+  """
+  Draw the annotations that are the same for all frames: the selection
+  outline, the scale rulers, the credits and the logo.
+  ax contains the axes for the large and the small image, both with limits
+  [0, 1] x [0, 1].
+  """
 
-  img_large = pl.imread(input_large)
-  img_small = pl.imread(input_small)
   logo = pl.imread("FLAMINGO_thumbnailer.png")
 
   boxsize_large = boxsize
   boxsize_small = (selection[1]-selection[0])*boxsize
 
-  fig, ax = pl.subplots(1, 2, figsize=(12,6))
-
-  ax[0].imshow(img_large, extent=[0., 1., 0., 1.])
-  ax[0].text(0.05, 0.95, f"$z = {z:5.2f}$, {labels[type]}", color="w")
   ax[0].plot([selection[0], selection[0], selection[1], selection[1], selection[0]],
              [selection[2], selection[3], selection[3], selection[2], selection[2]], "-", color="w",
              linewidth=0.4)
@@ -59,7 +69,6 @@ def combine_frames(args):
     )
   ax[0].text(0.05, 0.07, scale_label, color="w")
 
-  ax[1].imshow(img_small, extent=[0., 1., 0., 1.])
   ax[1].plot([0., 0., 1., 1., 0.], [0., 1., 1., 0., 0.], "-", color="w")
 
   label_fraction = get_label_fraction(boxsize_small)
@@ -73,18 +82,97 @@ def combine_frames(args):
   ax[1].text(0.7, 0.06, "FLAMINGO", color="w")
   ax[1].text(0.7, 0.03, "Virgo Consortium", color="w")
 
-  ax[0].axis("off")
-  ax[1].axis("off")
-  pl.tight_layout(pad=0)
   ax = fig. add_axes([0.92,0.02,0.1,0.1])
   ax.imshow(logo)
   ax.axis("off")
+
+def draw_redshift(ax, z, type):
+  """
+  Draw the redshift label on the axis of the large image.
+  """
+  ax[0].text(0.05, 0.95, f"$z = {z:5.2f}$, {labels[type]}", color="w")
+
+def combine_frames(args):
+
+  z, type, input_large, input_small, output, selection, boxsize = args
+
+  img_large = pl.imread(input_large)
+  img_small = pl.imread(input_small)
+
+  fig, ax = pl.subplots(1, 2, figsize=(12,6))
+
+  ax[0].imshow(img_large, extent=[0., 1., 0., 1.])
+  ax[1].imshow(img_small, extent=[0., 1., 0., 1.])
+  draw_redshift(ax, z, type)
+
+  ax[0].axis("off")
+  ax[1].axis("off")
+  pl.tight_layout(pad=0)
+  draw_annotations(fig, ax, selection, boxsize)
   pl.savefig(output, dpi=300)
   fig.clear()
   pl.close(fig)
 
   return output
 
+def get_half_axes(fig):
+  """
+  Add the axes for the large (left) and small (right) image to the given
+  overlay figure.
+  """
+  ax = [fig.add_axes([0., 0., 0.5, 1.]), fig.add_axes([0.5, 0., 0.5, 1.])]
+  for a in ax:
+    a.set_xlim(0., 1.)
+    a.set_ylim(0., 1.)
+    a.patch.set_alpha(0.)
+    a.axis("off")
+  return ax
+
+@functools.lru_cache(maxsize=None)
+def get_static_overlay(selection, boxsize):
+  """
+  Get the (cached) overlay with the annotations that are the same for all
+  frames.
+  """
+  return render_overlay(
+    2 * frame_size,
+    frame_size,
+    lambda fig, ax: draw_annotations(fig, get_half_axes(fig), selection, boxsize),
+    dpi=300,
+  )
+
+def combine_frames_fast(args):
+  """
+  Same as combine_frames(), but composes the frame directly as an RGB image
+  (see compositor.py): the two input images are resized and put side by side,
+  and the annotations are alpha-blended on top. The static annotations are
+  only rendered once per worker process.
+  """
+
+  z, type, input_large, input_small, output, selection, boxsize = args
+
+  img = np.concatenate(
+    [
+      resize(read_png(input_large), frame_size, frame_size),
+      resize(read_png(input_small), frame_size, frame_size),
+    ],
+    axis=1,
+  )
+
+  composite(img, get_static_overlay(tuple(selection), boxsize))
+  composite(
+    img,
+    render_overlay(
+      2 * frame_size,
+      frame_size,
+      lambda fig, ax: draw_redshift(get_half_axes(fig), z, type),
+      dpi=300,
+    ),
+  )
+  write_png(output, img)
+
+  return output
+
 if __name__ == "__main__":
 
   mp.set_start_method("forkserver")
@@ -100,6 +188,7 @@ if __name__ == "__main__":
   argparser.add_argument("--imin", "-i", type=int, default=-1)
   argparser.add_argument("--imax", "-I", type=int, default=-1)
   argparser.add_argument("--boxsizeMpc", "-b", type=float, default=1000.)
+  argparser.add_argument("--compositor", action="store_true")
   args = argparser.parse_args()
 
   a_range = np.linspace(1./(1.+args.zmax), 1., args.nframe)
@@ -120,5 +209,6 @@ if __name__ == "__main__":
   os.makedirs(args.outputfolder, exist_ok=True)
 
   pool = mp.Pool(args.nproc)
-  for output in pool.imap_unordered(combine_frames, arglist):
+  function = combine_frames_fast if args.compositor else combine_frames
+  for output in pool.imap_unordered(function, arglist):
     print(output)
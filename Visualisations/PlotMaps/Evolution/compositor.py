@@ -0,0 +1,92 @@
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+"""
+compositor.py
+
+Lightweight frame compositor for the evolution movie scripts.
+
+Instead of creating a matplotlib figure for every frame and calling imshow()
+and savefig() on a full resolution map, frames are composed directly as 8-bit
+RGB arrays:
+ - map values are converted into 8-bit colours using a colour lookup table
+   (see colour_lut.py in the parent folder),
+ - the resulting image is cropped and resized to the output resolution,
+ - text, lines and logos are drawn onto a transparent overlay that is
+   rendered with matplotlib (without any image data) and alpha-blended onto
+   the frame. Overlays that are the same for all frames can be cached.
+ - the frame is written using a fast PNG encoder (or can be passed on to a
+   video encoder).
+"""
+
+
+def resize(rgb, width, height):
+    """
+    Resize the given RGB image to the given width and height (in pixels),
+    using area averaging.
+    """
+    if rgb.shape[1] == width and rgb.shape[0] == height:
+        return rgb
+    image = Image.fromarray(np.ascontiguousarray(rgb))
+    return np.asarray(image.resize((width, height), Image.Resampling.BOX))
+
+
+def render_overlay(width, height, draw, dpi=300):
+    """
+    Render a transparent RGBA overlay with the given width and height (in
+    pixels) using matplotlib.
+
+    The draw function is called with the figure and a single axis that covers
+    the entire figure, has limits [0, 1] x [0, 1], and has its axis turned off.
+    It can add text, lines and (small) images. The dpi determines the size of
+    text and lines.
+
+    Returns the overlay as an 8-bit RGBA array, with the first row at the top.
+    """
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    fig.patch.set_alpha(0.0)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.0, 0.0, 1.0, 1.0])
+    ax.set_xlim(0.0, 1.0)
+    ax.set_ylim(0.0, 1.0)
+    ax.patch.set_alpha(0.0)
+    ax.axis("off")
+    draw(fig, ax)
+    canvas.draw()
+    return np.array(canvas.buffer_rgba())
+
+
+def composite(rgb, overlay):
+    """
+    Alpha-blend the given RGBA overlay onto the given RGB image (in place).
+    Both need to have the same size.
+    """
+    alpha = overlay[..., 3:4].astype(np.uint16)
+    blended = rgb.astype(np.uint16) * (255 - alpha)
+    blended += overlay[..., :3].astype(np.uint16) * alpha
+    blended += 127
+    blended //= 255
+    rgb[...] = blended
+    return rgb
+
+
+def write_png(filename, rgb, compress_level=1):
+    """
+    Write the given RGB image to a PNG file.
+
+    A low compression level is a lot faster and only results in slightly
+    larger files.
+    """
+    Image.fromarray(rgb).save(filename, compress_level=compress_level)
+
+
+def read_png(filename):
+    """
+    Read the given PNG file as an 8-bit RGB image.
+    """
+    return np.asarray(Image.open(filename).convert("RGB"))
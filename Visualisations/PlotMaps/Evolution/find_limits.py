@@ -1,21 +1,119 @@
 import os
+import sys
 import numpy as np
 import multiprocessing as mp
 import glob
 import argparse
 import yaml
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from map_store import is_map_store, get_statistics, load_map
+
+"""
+find_limits.py
+
+Compute statistics for all maps in a folder in a single streaming pass.
+
+For every map, we compute the minimum, maximum and mean value, and a histogram
+of the logarithm of the (positive) pixel values. Surface density maps are
+normalised by their mean value first. All histograms use the same fixed bins,
+so they can simply be added up to obtain a histogram for a set of maps. From
+these histograms, we compute approximate percentiles, per map and per quantity
+(the combination of all maps of the same type). These can be used to set
+robust colour limits that are not determined by a single outlier pixel.
+
+The maps are processed in chunks of rows, so that no large temporary arrays are
+created, and different maps are processed in parallel.
+"""
+
+# fixed logarithmic histogram bins, covering 100 dex with a precision of
+# 0.01 dex
+log_bin_min = -50.0
+log_bin_width = 0.01
+nbin = 10000
+
+# number of map rows that is processed in one go
+chunk_size = 256
+
+# types of maps; also used to generate the quantity names in plot_frames.py
+types = ["gas", "star", "dm"]
+
+
+def get_fullquantity(filename, name):
+  """
+  Get the full quantity name ("<type>/<mapname>") for the map in the given
+  file with the given internal map name.
+  """
+  for type in types:
+    if type in filename:
+      break
+  return f"{type}/{name}"
+
+
+def get_percentiles(counts, levels):
+  """
+  Get approximate percentiles for the given levels (in %) from the given
+  histogram counts. Within a bin, we linearly interpolate in log space.
+
+  Only positive pixel values are taken into account.
+  """
+  cumulative = np.cumsum(counts)
+  total = cumulative[-1]
+  percentiles = []
+  for level in levels:
+    if total == 0:
+      percentiles.append(np.nan)
+      continue
+    target = 0.01 * level * total
+    ibin = min(np.searchsorted(cumulative, target, side="left"), nbin - 1)
+    below = cumulative[ibin] - counts[ibin]
+    frac = (target - below) / counts[ibin] if counts[ibin] > 0 else 0.5
+    percentiles.append(10.0 ** (log_bin_min + (ibin + frac) * log_bin_width))
+  return percentiles
+
+
+def get_map_statistics(name, data, dmean):
+  """
+  Compute the statistics for the given map with the given internal map name
+  and mean value.
+
+  Returns the minimum, maximum, mean and histogram counts. For surface density
+  maps, all values are normalised by the mean.
+  """
+  norm = 1.0
+  if name == "surfdens" and dmean > 0.:
+    norm = 1.0 / dmean
+
+  dmin = np.inf
+  dmax = -np.inf
+  counts = np.zeros(nbin, dtype=np.int64)
+  for ibegin in range(0, data.shape[0], chunk_size):
+    chunk = np.array(data[ibegin : ibegin + chunk_size], dtype=np.float64)
+    chunk *= norm
+    dmin = min(dmin, chunk.min())
+    dmax = max(dmax, chunk.max())
+    chunk = chunk[chunk > 0.]
+    ibin = np.floor((np.log10(chunk) - log_bin_min) / log_bin_width)
+    ibin = np.clip(ibin, 0, nbin - 1).astype(np.int64)
+    counts += np.bincount(ibin, minlength=nbin)
+
+  return dmin, dmax, dmean * norm, counts
+
 def process_file(filename):
-  data = np.load(filename)
-  name = data.files[0]
-  data = data[name]
-  if name == "surfdens":
+  """
+  Compute the statistics for the given .npz file or .map store.
+
+  Returns the file name, internal map name, minimum, maximum, mean and
+  histogram counts. For surface density maps, all values are normalised by
+  the mean.
+  """
+  name, data = load_map(filename)
+  if is_map_store(filename):
+    dmean = get_statistics(filename)["mean"]
+  else:
     dmean = data.mean()
-    if dmean > 0.:
-      data /= dmean
-  dmin = data.min()
-  dmax = data.max()
-  return filename, name, dmin, dmax
+
+  return (filename, name) + get_map_statistics(name, data, dmean)
 
 if __name__ == "__main__":
 
@@ -25,19 +123,58 @@ if __name__ == "__main__":
   argparser.add_argument("folder")
   argparser.add_argument("output")
   argparser.add_argument("--nproc", "-j", type=int, default=1)
+  argparser.add_argument("--percentiles", "-p", type=float, nargs="+",
+                         default=[0.1, 1., 50., 99., 99.9])
+  argparser.add_argument("--quantity_output", "-q", default=None)
+  argparser.add_argument("--robust_range", "-r", type=float, nargs=2,
+                         default=[0.1, 99.99])
   args = argparser.parse_args()
 
   files = []
   for dirname in os.listdir(args.folder):
       if 'snapshot_' in dirname:
           files += glob.glob(f'{args.folder}/{dirname}/*.npz')
+          files += glob.glob(f'{args.folder}/{dirname}/*.map')
 
   pool = mp.Pool(args.nproc)
   data = {}
-  for file, name, dmin, dmax in pool.imap_unordered(process_file, files):
+  quantities = {}
+  for file, name, dmin, dmax, dmean, counts in pool.imap_unordered(process_file, files):
     print(file)
-    data[file] = {"quantity": name, "min": f"{dmin:.9e}", "max": f"{dmax:.9e}"}
+    percentiles = get_percentiles(counts, args.percentiles)
+    data[file] = {
+      "quantity": name,
+      "min": f"{dmin:.9e}",
+      "max": f"{dmax:.9e}",
+      "mean": f"{dmean:.9e}",
+      "percentiles": {f"{l:g}": f"{p:.9e}" for l, p in zip(args.percentiles, percentiles)},
+    }
     print(file, data[file])
 
+    # merge the statistics for all maps of the same quantity
+    quantity = get_fullquantity(file, name)
+    if not quantity in quantities:
+      quantities[quantity] = {"min": dmin, "max": dmax, "counts": counts}
+    else:
+      quantities[quantity]["min"] = min(quantities[quantity]["min"], dmin)
+      quantities[quantity]["max"] = max(quantities[quantity]["max"], dmax)
+      quantities[quantity]["counts"] += counts
+
   with open(args.output, "w") as handle:
     handle.write(yaml.safe_dump(data))
+
+  if args.quantity_output is not None:
+    output = {}
+    for quantity, stats in quantities.items():
+      percentiles = get_percentiles(stats["counts"], args.percentiles)
+      robust_min, robust_max = get_percentiles(stats["counts"], args.robust_range)
+      output[quantity] = {
+        "min": f"{stats['min']:.9e}",
+        "max": f"{stats['max']:.9e}",
+        "robust_min": f"{robust_min:.9e}",
+        "robust_max": f"{robust_max:.9e}",
+        "percentiles": {f"{l:g}": f"{p:.9e}" for l, p in zip(args.percentiles, percentiles)},
+      }
+      print(quantity, output[quantity])
+    with open(args.quantity_output, "w") as handle:
+      handle.write(yaml.safe_dump(output))
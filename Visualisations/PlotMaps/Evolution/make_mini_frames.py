@@ -11,6 +11,10 @@ def convert_file(args):
   data = np.load(input)
   newdata = {}
   for key in data.files:
+    # the provenance record (if any) is not a map
+    if key == "provenance":
+      newdata[key] = data[key]
+      continue
     newdata[key] = data[key][:100,:100]
 
   np.savez_compressed(output, **newdata)
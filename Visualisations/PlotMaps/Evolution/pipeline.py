@@ -0,0 +1,277 @@
+import os
+import sys
+import argparse
+import numpy as np
+import multiprocessing as mp
+import unyt
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../ZoomMaps")
+)
+from map_store import is_map_store, get_statistics, load_map
+from redshift_table import RedshiftTable
+from make_zoom_maps import create_maps
+from shared_maps import create_shared_map, release_shared_map
+from find_limits import get_map_statistics, get_percentiles, get_fullquantity
+from plot_frames import (
+    get_quantity_limits,
+    get_redshift_index,
+    get_frame_arglist,
+    init_worker,
+    make_frames,
+)
+
+"""
+pipeline.py
+
+Run the evolution movie pipeline (make_maps_all_snapshots.py, find_limits.py,
+add_redshift.py and plot_frames.py) in a single process.
+
+The maps for every snapshot are created with create_maps(). Freshly projected
+maps are copied into shared memory blocks (as single precision arrays) and
+their statistics are computed immediately, so that they never need to be read
+back from disk: the frame rendering workers access them directly (see
+shared_maps.py). The maps are still written to disk as usual, so that a
+subsequent run can reuse them; maps that were already up to date are read from
+disk once to compute their statistics, and are rendered from disk as well.
+
+The total size of the shared memory blocks is limited by --memory_budget;
+maps that do not fit within the budget are rendered from disk.
+
+The limits (with redshifts) and quantity limits that would be produced by
+find_limits.py and add_redshift.py are written to the output folder as well,
+so that plot_frames.py can be rerun on the same maps.
+"""
+
+# percentiles that are stored in the limits files (same as in find_limits.py)
+default_percentiles = [0.1, 1.0, 50.0, 99.0, 99.9]
+
+
+class MapCollector:
+    """
+    Callback for create_maps() that collects the statistics of all maps and
+    copies them into shared memory, as long as they fit within the memory
+    budget.
+    """
+
+    def __init__(self, memory_budget, percentiles=default_percentiles):
+        """
+        Create an empty collector that can use up to memory_budget bytes of
+        shared memory.
+        """
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.percentiles = percentiles
+        self.redshift = None
+        self.limits = {}
+        self.quantities = {}
+        self.blocks = []
+        self.descriptors = {}
+
+    def add_statistics(self, filename, name, data, dmean):
+        """
+        Compute the statistics for the given map and add them to the limits.
+        """
+        dmin, dmax, dmean, counts = get_map_statistics(name, data, dmean)
+        percentiles = get_percentiles(counts, self.percentiles)
+        self.limits[filename] = {
+            "quantity": name,
+            "min": f"{dmin:.9e}",
+            "max": f"{dmax:.9e}",
+            "mean": f"{dmean:.9e}",
+            "percentiles": {
+                f"{l:g}": f"{p:.9e}" for l, p in zip(self.percentiles, percentiles)
+            },
+            "redshift": f"{self.redshift:.2f}",
+        }
+
+        # merge the statistics for all maps of the same quantity
+        quantity = get_fullquantity(filename, name)
+        if not quantity in self.quantities:
+            self.quantities[quantity] = {"min": dmin, "max": dmax, "counts": counts}
+        else:
+            stats = self.quantities[quantity]
+            stats["min"] = min(stats["min"], dmin)
+            stats["max"] = max(stats["max"], dmax)
+            stats["counts"] += counts
+
+    def __call__(self, filename, name, data):
+        """
+        Process a freshly created map (see create_maps()).
+        """
+        # the neutrino maps are not used for the evolution movie
+        if "neutrino" in filename:
+            return
+        data = np.asarray(data)
+        dmean = data.mean()
+        self.add_statistics(filename, name, data, dmean)
+
+        size = data.size * np.dtype(np.float32).itemsize
+        if self.memory_used + size > self.memory_budget:
+            return
+        block, descriptor = create_shared_map(data, np.float32, mean=float(dmean))
+        self.blocks.append(block)
+        self.descriptors[filename] = descriptor
+        self.memory_used += size
+
+    def add_existing(self, filename):
+        """
+        Process a map that was up to date and hence was not created again.
+        """
+        if filename in self.limits:
+            return
+        name, data = load_map(filename)
+        if is_map_store(filename):
+            dmean = get_statistics(filename)["mean"]
+        else:
+            dmean = data.mean()
+        self.add_statistics(filename, name, data, dmean)
+
+    def get_quantity_limits(self, robust_range):
+        """
+        Get the combined statistics for each quantity, in the same format as
+        the --quantity_output of find_limits.py.
+        """
+        output = {}
+        for quantity, stats in self.quantities.items():
+            percentiles = get_percentiles(stats["counts"], self.percentiles)
+            robust_min, robust_max = get_percentiles(stats["counts"], robust_range)
+            output[quantity] = {
+                "min": f"{stats['min']:.9e}",
+                "max": f"{stats['max']:.9e}",
+                "robust_min": f"{robust_min:.9e}",
+                "robust_max": f"{robust_max:.9e}",
+                "percentiles": {
+                    f"{l:g}": f"{p:.9e}" for l, p in zip(self.percentiles, percentiles)
+                },
+            }
+        return output
+
+    def release(self):
+        """
+        Release all shared memory blocks.
+        """
+        for block in self.blocks:
+            release_shared_map(block)
+        self.blocks = []
+        self.descriptors = {}
+        self.memory_used = 0
+
+
+def get_map_names(output_folder, boxsize, res, map_format):
+    """
+    Get the names of the maps created by create_maps() that are used for the
+    evolution movie.
+    """
+    rname = f"L{boxsize:.0f}_{res}"
+    return [
+        f"{output_folder}/{rname}_{name}.{map_format}"
+        for name in [
+            "gas_map_sigma",
+            "gas_map_temp",
+            "gas_map_xray",
+            "dm_map_sigma",
+            "star_map_sigma",
+        ]
+    ]
+
+
+if __name__ == "__main__":
+
+    mp.set_start_method("forkserver")
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "snapshot", help="Snapshot name pattern, e.g. flamingo_{snap:04d}.hdf5"
+    )
+    argparser.add_argument("redshiftfile", help="List of output redshifts")
+    argparser.add_argument("mapfolder")
+    argparser.add_argument("outputfolder")
+    argparser.add_argument("--boxsize", "-L", type=float, required=True)
+    argparser.add_argument("--resolution", "-R", type=int, default=8192)
+    argparser.add_argument(
+        "--centre", "-C", type=float, nargs=3, required=True, help="Centre (in Mpc)"
+    )
+    argparser.add_argument("--zwidth", "-z", type=float, default=20.0)
+    argparser.add_argument("--map_format", "-f", choices=["npz", "map"], default="npz")
+    argparser.add_argument("--nproc", "-j", type=int, default=1)
+    argparser.add_argument("--nframe", "-n", type=int, default=100)
+    argparser.add_argument("--cachesize", "-c", type=int, default=4)
+    argparser.add_argument("--nthread", "-t", type=int, default=1)
+    argparser.add_argument(
+        "--memory_budget",
+        "-m",
+        type=float,
+        default=16.0,
+        help="Maximum size of the maps kept in shared memory (in GB)",
+    )
+    argparser.add_argument("--robust_range", "-r", type=float, nargs=2, default=None)
+    argparser.add_argument("--compositor", action="store_true")
+    argparser.add_argument("--label", action="store_true")
+    args = argparser.parse_args()
+
+    os.makedirs(args.outputfolder, exist_ok=True)
+
+    redshifts = RedshiftTable.from_output_list(args.redshiftfile)
+    centre = unyt.unyt_array(args.centre, units="Mpc")
+
+    collector = MapCollector(args.memory_budget * 1.0e9)
+    try:
+        for snap in range(len(redshifts)):
+            print(f"Creating maps for snapshot {snap}")
+            folder = f"{args.mapfolder}/snapshot_{snap:04d}"
+            collector.redshift = redshifts.get_redshift(snap)
+            create_maps(
+                args.snapshot.format(snap=snap),
+                args.boxsize,
+                args.resolution,
+                centre=centre,
+                zwidth=args.zwidth * unyt.Mpc,
+                output_folder=folder,
+                map_format=args.map_format,
+                map_callback=collector,
+            )
+            for filename in get_map_names(
+                folder, args.boxsize, args.resolution, args.map_format
+            ):
+                collector.add_existing(filename)
+        print(
+            f"{len(collector.descriptors)} of {len(collector.limits)} maps"
+            f" in shared memory ({collector.memory_used / 1.0e9:.2f} GB)"
+        )
+
+        limits = collector.limits
+        with open(f"{args.outputfolder}/limits_with_z.yml", "w") as handle:
+            handle.write(yaml.safe_dump(limits))
+
+        quantitylimits = None
+        if args.robust_range is not None:
+            quantitylimits = collector.get_quantity_limits(args.robust_range)
+            with open(f"{args.outputfolder}/quantity_limits.yml", "w") as handle:
+                handle.write(yaml.safe_dump(quantitylimits))
+
+        quantities, zmax = get_quantity_limits(limits, quantitylimits)
+        a_range = np.linspace(1.0 / (1 + zmax), 1.0, args.nframe)
+        z_range = 1.0 / a_range - 1.0
+        index = get_redshift_index(limits)
+        arglist = get_frame_arglist(
+            z_range,
+            quantities,
+            index,
+            args.outputfolder,
+            fast=args.compositor,
+            label=args.label,
+        )
+
+        blocksize = max(1, int(np.ceil(len(arglist) / args.nproc)))
+        with mp.Pool(
+            args.nproc,
+            initializer=init_worker,
+            initargs=(args.cachesize, collector.descriptors, args.nthread),
+        ) as pool:
+            for frame in pool.imap_unordered(make_frames, arglist, chunksize=blocksize):
+                print(frame)
+    finally:
+        collector.release()
@@ -8,21 +8,94 @@ import matplotlib.pyplot as pl
 import yaml
 import argparse
 import os
+import sys
+import functools
 from swiftsimio.visualisation.tools.cmaps import LinearSegmentedCmap2D
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from map_store import is_map_store, get_statistics, load_map
+from colour_lut import (
+    get_lut,
+    get_lut_2d,
+    get_index_type,
+    apply_lut,
+    apply_lut_2d,
+    log_map,
+    blend_log_index,
+)
+from compositor import (
+    resize,
+    render_overlay,
+    composite,
+    write_png,
+)
+from video_pipe import VideoWriter, ordered_results
+from shared_maps import attach_shared_map
+
 gas_temperature_map = LinearSegmentedCmap2D(
     colors=[[0.0, 0.0, 0.0], [0.2, 0.5, 1.0], [1.0, 0.3, 0.1], [1.0, 1.0, 1.0]],
     coordinates=[[0.0, 0.0], [0.0, 1.0], [1.0, 0.0], [1.0, 1.0]],
     name="gas_temperature_map",
 )
+
 dm_map = pl.get_cmap("cividis")
 xray_map = pl.get_cmap("magma")
 # star_map = pl.get_cmap("pink")
 star_map = pl.get_cmap("gist_gray")
 
+# colour lookup tables (see colour_lut.py)
+luts = {
+    "dm": get_lut(dm_map),
+    "gas": get_lut_2d(gas_temperature_map),
+    "xray": get_lut(xray_map),
+    "star": get_lut(star_map),
+}
+
+# labels that are added with --label (same as in add_labels.py)
+labels = {
+    "gas": "Gas surface density and temperature",
+    "dm": "Dark matter surface density",
+    "star": "Stellar surface density",
+    "xray": "ROSAT X-ray luminosity",
+}
+
 square = True
 
+# number of decoded maps that each worker process keeps in memory
+# set in init_worker()
+cachesize = 4
+
+# maps that are available in shared memory (see pipeline.py), by file name
+# set in init_worker()
+shared_maps = {}
+
+# number of threads that each worker process uses to blend maps
+# set in init_worker()
+nthread = 1
+
+# reusable colour index buffers for each quantity (see get_quantity_index())
+index_buffers = {}
+
 def read_map(filename, mapname, selection=None):
+    if filename in shared_maps:
+        # the map was handed over in shared memory, together with its mean
+        descriptor = shared_maps[filename]
+        data = attach_shared_map(descriptor)
+        if selection is not None:
+            data = data[selection[0] : selection[1], selection[2] : selection[3]]
+        data = np.array(data, dtype=np.float64)
+        if mapname == "surfdens" and descriptor["mean"] > 0.:
+            data /= descriptor["mean"]
+        return data
+    if is_map_store(filename):
+        # only read the selected pixels, and use the stored mean
+        _, data = load_map(filename, selection)
+        data = np.array(data)
+        if mapname == "surfdens":
+          dmean = get_statistics(filename)["mean"]
+          if dmean > 0.:
+            data /= dmean
+        return data
     data = np.load(filename)[mapname]
     if mapname == "surfdens":
       dmean = data.mean()
@@ -36,44 +109,118 @@ def read_map(filename, mapname, selection=None):
         ]
 
 
-def get_quantity(z, quantity, limits, selection=None):
+@functools.lru_cache(maxsize=None)
+def get_map_cache():
+    """
+    Get the LRU cache of decoded maps for this process.
 
-    zmin = -1000.0
-    filemin = None
-    zmax = 1000.0
-    filemax = None
-    for file in limits:
-        if limits[file]["fullquantity"] == quantity:
-            zdiff = z - np.float32(limits[file]["redshift"])
-            if zdiff <= 0.0 and zdiff > zmin:
-                zmin = zdiff
-                filemin = file
-            elif zdiff > 0.0 and zdiff < zmax:
-                zmax = zdiff
-                filemax = file
+    Consecutive frames use the same maps, so if a worker process handles a
+    contiguous block of frames, every map only needs to be read once.
+    The maps are cached as single precision logarithms (see
+    colour_lut.log_map()), which is what the blending kernel needs, and are
+    read-only.
+    """
 
-    # TODO: Needed if a snapshot exists for DM but not for stars
-    if filemin is None:
-        return read_map(filemax, limits[filemax]["quantity"], selection)
+    @functools.lru_cache(maxsize=cachesize)
+    def cached_read_map(filename, mapname, selection):
+        data = log_map(read_map(filename, mapname, selection))
+        data.flags.writeable = False
+        return data
 
-    if filemax is None:
-        return read_map(filemin, limits[filemin]["quantity"], selection)
+    return cached_read_map
 
-    mapmin = read_map(filemin, limits[filemin]["quantity"], selection)
-    mapmax = read_map(filemax, limits[filemax]["quantity"], selection)
 
-    a = 1.0 / (1.0 + z)
-    amin = 1.0 / (1.0 + z - zmin)
-    amax = 1.0 / (1.0 + z - zmax)
+def init_worker(size, maps=None, threads=1):
+    """
+    Initialise a worker process: set the size of the map cache, the
+    descriptors of the maps that are available in shared memory (if any) and
+    the number of threads used to blend maps.
+    """
+    global cachesize, shared_maps, nthread
+    cachesize = size
+    if maps is not None:
+        shared_maps = maps
+    nthread = threads
 
-    fac = (a - amin) / (amax - amin)
 
-    mapdata = (1.0 - fac) * mapmin + fac * mapmax
+def get_redshift_index(limits):
+    """
+    Create an index that links each quantity to the redshifts of its maps.
 
-    del mapmin
-    del mapmax
+    For each quantity, the index contains a sorted array of redshifts and the
+    corresponding file names and internal map names.
+    """
+    index = {}
+    for file in limits:
+        quantity = limits[file]["fullquantity"]
+        if not quantity in index:
+            index[quantity] = []
+        index[quantity].append(
+            (np.float32(limits[file]["redshift"]), file, limits[file]["quantity"])
+        )
+    for quantity in index:
+        entries = sorted(index[quantity], key=lambda entry: entry[0])
+        index[quantity] = (
+            np.array([entry[0] for entry in entries], dtype=np.float32),
+            [entry[1] for entry in entries],
+            [entry[2] for entry in entries],
+        )
+    return index
+
+
+def get_quantity_index(z, quantity, index, limits, selection=None, binary=False):
+    """
+    Get the colour indices for the given quantity at the given redshift.
+
+    The maps for the snapshots just before and after z are blended in log
+    space, with weights set by the scale factor, and are converted into
+    colour indices using a logarithmic normalisation within the given limits
+    ([vmin, vmax]), in a single pass (see colour_lut.blend_log_index()).
+    If binary is True, all pixels above vmin get the highest index.
+
+    The result is written into a buffer that is reused for the next frame.
+    """
+
+    read = get_map_cache()
+    zs, files, mapnames = index[quantity]
+
+    # find the maps with the closest redshift larger than or equal to z (imin)
+    # and the closest redshift smaller than z (imax)
+    imin = np.searchsorted(zs, np.float32(z), side="left")
+    imax = imin - 1
 
-    return mapdata
+    # TODO: Needed if a snapshot exists for DM but not for stars
+    if imin == len(zs):
+        imin = imax
+        fac = 0.0
+    elif imax < 0:
+        imax = imin
+        fac = 0.0
+    else:
+        a = 1.0 / (1.0 + z)
+        amin = 1.0 / (1.0 + zs[imin])
+        amax = 1.0 / (1.0 + zs[imax])
+        fac = (a - amin) / (amax - amin)
+
+    logmin = read(files[imin], mapnames[imin], selection)
+    logmax = read(files[imax], mapnames[imax], selection)
+
+    nlevel = luts[quantity.split("/")[0]].shape[0]
+    buffer = index_buffers.get(quantity)
+    if buffer is None or buffer.shape != logmin.shape:
+        buffer = np.empty(logmin.shape, dtype=get_index_type(nlevel))
+        index_buffers[quantity] = buffer
+
+    return blend_log_index(
+        logmin,
+        logmax,
+        fac,
+        *limits,
+        nlevel=nlevel,
+        out=buffer,
+        binary=binary,
+        nthread=nthread,
+    )
 
 
 def get_quantities(q):
@@ -85,44 +232,151 @@ def get_quantities(q):
     }[q]
 
 
-def combine_maps(q, maps, quantities):
-    if q == "dm":
-        return dm_map(maps[0].T)
-    elif q == "gas":
-        return gas_temperature_map(maps[0].T, maps[1].T)
-    elif q == "xray":
-        return xray_map(maps[0].T)
-    elif q == "star":
-        return star_map(maps[0].T)
+def combine_maps(q, indices):
+    """
+    Convert the given colour indices (see get_quantity_index()) into an 8-bit
+    RGBA image, using the colour lookup table for the given quantity.
+    """
+    if q == "gas":
+        return apply_lut_2d(indices[0].T, indices[1].T, luts[q])
+    elif q in luts:
+        return apply_lut(indices[0].T, luts[q])
     else:
         raise RuntimeError(f"Unknown quantity: {q}!")
 
 
+def draw_static_overlay(fig, ax):
+    """
+    Draw the parts of the frame annotation that are the same for all frames
+    on the given figure and axis (which covers the whole frame).
+    """
+    # TODO: Text location for square images
+    if square:
+        ax.text(0.7, 0.06, "FLAMINGO", color="w", transform = ax.transAxes)
+        ax.text(0.7, 0.03, "Virgo Consortium", color="w", transform = ax.transAxes)
+    else:
+        ax.text(0.85, 0.08, "FLAMINGO", color="w",
+                transform = ax.transAxes, fontsize='large')
+        ax.text(0.85, 0.04, "Virgo Consortium", color="w",
+                transform = ax.transAxes, fontsize='large')
+
+    logo = pl.imread("flamingo_logo.png")
+    # TODO: Flamingo logo location for square images
+    if square:
+        ax1 = fig.add_axes([0.90,0.02,0.1,0.1])
+    else:
+        ax1 = fig.add_axes([0.92,0.02,0.08,0.1])
+    ax1.imshow(logo)
+    ax1.axis('off')
+
+
+def draw_labels(ax, z, quantity, label):
+    """
+    Draw the parts of the frame annotation that depend on the redshift on the
+    given axis: the age of the Universe and optionally the label that is
+    otherwise added by add_labels.py.
+    """
+    cosmo = astropy.cosmology.FlatLambdaCDM(H0=68.1, Om0=0.306)
+    age = cosmo.age(z).value
+    time_label = f'Universe Age: {age:.2f} Gyr'
+    if square:
+        ax.text(0.02, 0.05, time_label, color="w", transform = ax.transAxes)
+    else:
+        ax.text(0.02, 0.05, time_label, color="w",
+                transform = ax.transAxes, fontsize='x-large')
+    if label:
+        # same position as in add_labels.py: 50 pixels from the top left
+        width, height, dpi = get_frame_size()
+        ax.text(50. / width, 1. - 50. / height,
+                f"$z = {z:5.2f}$, {labels[quantity]}", color="w",
+                transform = ax.transAxes)
+
+
+def get_frame_size():
+    """
+    Get the width and height (in pixels) and the resolution (dpi) of a frame.
+    """
+    if square:
+        return 1800, 1800, 300
+    else:
+        return 3840, 2160, 240
+
+
+@functools.lru_cache(maxsize=None)
+def get_static_overlay(width, height, dpi):
+    """
+    Get the (cached) overlay with the static frame annotations.
+    """
+    return render_overlay(width, height, draw_static_overlay, dpi)
+
+
+def compose_frame(z, quantity, mapdata, output, label):
+    """
+    Compose a frame directly as an RGB image, without creating a matplotlib
+    figure for the map (see compositor.py).
+
+    The map is given as an RGBA image (see combine_maps()). The frame is
+    written to the given output file, unless output is None. The RGB image
+    is returned.
+    """
+    # images are plotted with the origin at the bottom
+    width, height, dpi = get_frame_size()
+    rgb = np.array(resize(mapdata[::-1, :, :3], width, height))
+
+    composite(rgb, get_static_overlay(width, height, dpi))
+    composite(
+        rgb,
+        render_overlay(
+            width,
+            height,
+            lambda fig, ax: draw_labels(ax, z, quantity, label),
+            dpi,
+        ),
+    )
+    if output is not None:
+        write_png(output, rgb)
+    return rgb
+
+
 def make_frames(args):
 
-    idx, z, quantities, limits, outputfolder, quantity, selection = args
+    (
+        idx,
+        z,
+        quantities,
+        index,
+        outputfolder,
+        quantity,
+        selection,
+        fast,
+        label,
+        video,
+    ) = args
 
     output = f"{outputfolder}/{quantity}_frame_{idx:04d}.png"
 
-    maps = []
-    norms = {}
+    indices = []
     for q in get_quantities(quantity):
-        dmin = quantities[q]["min"]
-        dmax = quantities[q]["max"]
-        mapdata = get_quantity(z, q, limits, selection)
+        limits = (quantities[q]["min"], quantities[q]["max"])
+        # stars are shown as a binary map
+        mapindex = get_quantity_index(
+            z, q, index, limits, selection, binary=(quantity == "star")
+        )
         if not square:
-            i_cut = mapdata.shape[0] * 7 // 32
-            mapdata = mapdata[:, i_cut:-i_cut]
-        mapdata[mapdata <= dmin] = dmin
+            i_cut = mapindex.shape[0] * 7 // 32
+            mapindex = mapindex[:, i_cut:-i_cut]
+        indices.append(mapindex)
+
+    mapdata = combine_maps(quantity, indices)
+    del indices
 
-        if quantity == 'star':
-            mapdata[mapdata > dmin] = dmax
+    # in video mode, the frame is returned instead of written to a file
+    if video:
+        return compose_frame(z, quantity, mapdata, None, label)
 
-        mapdata = matplotlib.colors.LogNorm(vmin=dmin, vmax=dmax)(mapdata)
-        maps.append(mapdata)
-    mapdata = combine_maps(quantity, maps, quantities)
-    for map in maps:
-        del map
+    if fast:
+        compose_frame(z, quantity, mapdata, output, label)
+        return output
 
     if square:
         fig, ax = pl.subplots(figsize=(6, 6))
@@ -131,38 +385,15 @@ def make_frames(args):
 
     ax.imshow(mapdata, origin="lower")
 
-    cosmo = astropy.cosmology.FlatLambdaCDM(H0=68.1, Om0=0.306)
-    age = cosmo.age(z).value
-    time_label = f'Universe Age: {age:.2f} Gyr'
-    # TODO: Text location for square images
-    if square:
-        ax.text(0.02, 0.05, time_label, color="w", transform = ax.transAxes)
-        ax.text(0.7, 0.06, "FLAMINGO", color="w", transform = ax.transAxes)
-        ax.text(0.7, 0.03, "Virgo Consortium", color="w", transform = ax.transAxes)
-    else:
-        ax.text(0.02, 0.05, time_label, color="w",
-                transform = ax.transAxes, fontsize='x-large')
-        ax.text(0.85, 0.08, "FLAMINGO", color="w",
-                transform = ax.transAxes, fontsize='large')
-        ax.text(0.85, 0.04, "Virgo Consortium", color="w",
-                transform = ax.transAxes, fontsize='large')
+    draw_labels(ax, z, quantity, label)
     ax.axis("off")
 
     pl.tight_layout(pad=0)
 
-    logo = pl.imread("flamingo_logo.png")
-    # TODO: Flamingo logo location for square images
-    if square:
-        ax1 = fig.add_axes([0.90,0.02,0.1,0.1])
-    else:
-        ax1 = fig.add_axes([0.92,0.02,0.08,0.1])
-    ax1.imshow(logo)
-    ax1.axis('off')
+    draw_static_overlay(fig, ax)
 
-    if square:
-        pl.savefig(output, dpi=300)
-    else:
-        pl.savefig(output, dpi=240)
+    width, height, dpi = get_frame_size()
+    pl.savefig(output, dpi=dpi)
     fig.clear()
     pl.close(fig)
 
@@ -171,31 +402,22 @@ def make_frames(args):
     return output
 
 
-if __name__ == "__main__":
-
-    mp.set_start_method("forkserver")
-
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument("inputlimits")
-    argparser.add_argument("outputfolder")
-    argparser.add_argument("--nproc", "-j", type=int, default=1)
-    argparser.add_argument("--nframe", "-n", type=int, default=100)
-    argparser.add_argument("--imin", "-i", type=int, default=-1)
-    argparser.add_argument("--imax", "-I", type=int, default=-1)
-    argparser.add_argument("--selection", "-s", type=int, nargs="+", default=None)
-    args = argparser.parse_args()
-
-    os.makedirs(args.outputfolder, exist_ok=True)
-
-    with open(args.inputlimits, "r") as handle:
-        limits = yaml.safe_load(handle.read())
+def get_quantity_limits(limits, quantitylimits=None):
+    """
+    Get the plotting limits for each quantity from the limits for the
+    individual maps (see find_limits.py and add_redshift.py).
 
-    files = limits.keys()
+    If quantitylimits (the --quantity_output of find_limits.py) is given, the
+    robust limits in there are used instead of the absolute minimum and
+    maximum.
 
+    Also sets the full quantity name for each map in limits. Returns the
+    limits for each quantity and the maximum redshift.
+    """
     zmax = 0
     types = ["gas", "star", "dm"]
     quantities = {}
-    for file in files:
+    for file in limits:
         for type in types:
             if type in file:
                 break
@@ -210,6 +432,13 @@ if __name__ == "__main__":
             quantities[quantity]["min"] = min(quantities[quantity]["min"], dmin)
             quantities[quantity]["max"] = max(quantities[quantity]["max"], dmax)
 
+    # use robust limits (based on percentiles, see find_limits.py), if provided
+    if quantitylimits is not None:
+        for q in quantitylimits:
+            if q in quantities:
+                quantities[q]["min"] = np.float64(quantitylimits[q]["robust_min"])
+                quantities[q]["max"] = np.float64(quantitylimits[q]["robust_max"])
+
     for q in quantities:
         dmin = quantities[q]["min"]
         dmax = quantities[q]["max"]
@@ -220,20 +449,129 @@ if __name__ == "__main__":
     quantities["gas/temp"]["min"] = 1.0e4
     quantities["gas/temp"]["max"] = 1.0e7
 
+    return quantities, zmax
+
+
+def get_frame_arglist(
+    z_range,
+    quantities,
+    index,
+    outputfolder,
+    selection=None,
+    imin=-1,
+    imax=-1,
+    fast=False,
+    label=False,
+    video=False,
+):
+    """
+    Get the arguments for make_frames() for all frames.
+
+    Frames are ordered per quantity and then in redshift, and are handed out
+    to the workers in contiguous blocks, so that consecutive frames handled by
+    the same worker use the same (cached) maps.
+    """
+    arglist = []
+    for q in ["dm", "gas", "star", "xray"]:
+        for idx, z in enumerate(z_range):
+            if imin >= 0 and idx < imin:
+                continue
+            if imax >= 0 and idx >= imax:
+                continue
+            arglist.append(
+                (
+                    idx,
+                    z,
+                    quantities,
+                    index,
+                    outputfolder,
+                    q,
+                    selection,
+                    fast,
+                    label,
+                    video,
+                )
+            )
+    return arglist
+
+
+if __name__ == "__main__":
+
+    mp.set_start_method("forkserver")
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("inputlimits")
+    argparser.add_argument("outputfolder")
+    argparser.add_argument("--nproc", "-j", type=int, default=1)
+    argparser.add_argument("--nframe", "-n", type=int, default=100)
+    argparser.add_argument("--imin", "-i", type=int, default=-1)
+    argparser.add_argument("--imax", "-I", type=int, default=-1)
+    argparser.add_argument("--selection", "-s", type=int, nargs="+", default=None)
+    argparser.add_argument("--quantitylimits", "-q", default=None)
+    argparser.add_argument("--cachesize", "-c", type=int, default=4)
+    argparser.add_argument("--nthread", "-t", type=int, default=1)
+    argparser.add_argument("--blocksize", "-b", type=int, default=None)
+    argparser.add_argument("--compositor", action="store_true")
+    argparser.add_argument("--label", action="store_true")
+    argparser.add_argument("--video", action="store_true")
+    argparser.add_argument("--framerate", "-r", type=float, default=10.)
+    argparser.add_argument("--window", "-w", type=int, default=None)
+    args = argparser.parse_args()
+
+    os.makedirs(args.outputfolder, exist_ok=True)
+
+    with open(args.inputlimits, "r") as handle:
+        limits = yaml.safe_load(handle.read())
+
+    quantitylimits = None
+    if args.quantitylimits is not None:
+        with open(args.quantitylimits, "r") as handle:
+            quantitylimits = yaml.safe_load(handle.read())
+    quantities, zmax = get_quantity_limits(limits, quantitylimits)
+
     a_range = np.linspace(1.0 / (1 + zmax), 1.0, args.nframe)
     z_range = 1.0 / a_range - 1.0
 
-    arglist = []
-    for idx, z in enumerate(z_range):
-        if args.imin >= 0 and idx < args.imin:
-            continue
-        if args.imax >= 0 and idx >= args.imax:
-            continue
+    index = get_redshift_index(limits)
+    selection = tuple(args.selection) if args.selection is not None else None
+
+    arglist = get_frame_arglist(
+        z_range,
+        quantities,
+        index,
+        args.outputfolder,
+        selection,
+        args.imin,
+        args.imax,
+        args.compositor,
+        args.label,
+        args.video,
+    )
+
+    pool = mp.Pool(
+        args.nproc,
+        initializer=init_worker,
+        initargs=(args.cachesize, None, args.nthread),
+    )
+
+    # video mode: stream the frames for each quantity into ffmpeg, in order
+    if args.video:
+        window = args.window
+        if window is None:
+            window = 2 * args.nproc
+        width, height, _ = get_frame_size()
         for q in ["dm", "gas", "star", "xray"]:
-            arglist.append(
-                (idx, z, quantities, limits, args.outputfolder, q, args.selection)
-            )
+            qargs = [arg for arg in arglist if arg[5] == q]
+            output = f"{args.outputfolder}/{q}.mp4"
+            with VideoWriter(output, width, height, args.framerate) as video:
+                for frame in ordered_results(pool, make_frames, qargs, window):
+                    video.write(frame)
+            print(output)
+    # PNG mode: the frames are written in any order
+    else:
+        blocksize = args.blocksize
+        if blocksize is None:
+            blocksize = max(1, int(np.ceil(len(arglist) / args.nproc)))
 
-    pool = mp.Pool(args.nproc)
-    for frame in pool.imap_unordered(make_frames, arglist):
-        print(frame)
+        for frame in pool.imap_unordered(make_frames, arglist, chunksize=blocksize):
+            print(frame)
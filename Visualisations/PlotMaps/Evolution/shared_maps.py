@@ -0,0 +1,68 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+"""
+shared_maps.py
+
+Hand maps over between processes using shared memory blocks.
+
+The process that creates a map copies it into a named shared memory block
+and passes on a small descriptor (a dictionary with the name, shape and data
+type of the block, and optional extra information). Other processes (e.g. the
+workers of a multiprocessing pool) use the descriptor to access the map
+without any copying or disk I/O.
+
+The creating process owns the blocks and needs to release them when they are
+no longer needed (see release_shared_map()).
+"""
+
+# shared memory blocks this process has attached to, by block name
+# the blocks need to stay open as long as arrays that use them exist
+attached_blocks = {}
+
+
+def create_shared_map(data, dtype=np.float32, **info):
+    """
+    Copy the given map into a new shared memory block, using the given data
+    type.
+
+    Returns the shared memory block (which needs to be kept alive and released
+    by the caller) and the descriptor that can be passed on to other
+    processes. Additional keyword arguments are stored in the descriptor.
+    """
+    values = np.asarray(data)
+    block = shared_memory.SharedMemory(
+        create=True, size=max(values.size * np.dtype(dtype).itemsize, 1)
+    )
+    shared = np.ndarray(values.shape, dtype=dtype, buffer=block.buf)
+    shared[...] = values
+    descriptor = dict(info)
+    descriptor.update(
+        {"block": block.name, "shape": list(values.shape), "dtype": np.dtype(dtype).str}
+    )
+    return block, descriptor
+
+
+def attach_shared_map(descriptor):
+    """
+    Get the map described by the given descriptor, as a read-only array that
+    uses the shared memory block.
+    """
+    name = descriptor["block"]
+    if not name in attached_blocks:
+        attached_blocks[name] = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(
+        descriptor["shape"],
+        dtype=np.dtype(descriptor["dtype"]),
+        buffer=attached_blocks[name].buf,
+    )
+    data.flags.writeable = False
+    return data
+
+
+def release_shared_map(block):
+    """
+    Release the given shared memory block (created with create_shared_map()).
+    """
+    block.close()
+    block.unlink()
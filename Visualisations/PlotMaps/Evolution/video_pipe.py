@@ -0,0 +1,123 @@
+import subprocess
+import numpy as np
+
+"""
+video_pipe.py
+
+Stream movie frames directly into a video encoder.
+
+Instead of writing every frame to a PNG file and running ffmpeg on the
+resulting files afterwards, frames are passed on to an ffmpeg subprocess as
+raw 8-bit RGB data, in the order in which they appear in the movie.
+
+Frames that are rendered in parallel finish in an arbitrary order.
+ordered_results() hands out the frames to a multiprocessing pool, but only
+allows a limited number of frames to be rendered ahead of the next frame
+that needs to be written. Frames that finish early are kept in this bounded
+buffer until it is their turn, so that the memory usage does not depend on
+the total number of frames.
+"""
+
+# default ffmpeg encoder options: H.264 with a pixel format that every player
+# understands
+default_encoder_options = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+
+
+class VideoWriter:
+    """
+    Video file that is written by an ffmpeg subprocess, frame by frame.
+
+    Usage:
+      with VideoWriter("movie.mp4", 1800, 1800, framerate=10) as video:
+        for frame in frames:
+          video.write(frame)
+    """
+
+    def __init__(
+        self,
+        filename,
+        width,
+        height,
+        framerate=10,
+        encoder_options=default_encoder_options,
+        ffmpeg="ffmpeg",
+    ):
+        """
+        Start the ffmpeg subprocess that writes a video with the given file
+        name, frame size (in pixels) and frame rate (in frames per second).
+        """
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.nframe = 0
+        command = [
+            ffmpeg,
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-framerate",
+            f"{framerate}",
+            "-i",
+            "-",
+            *encoder_options,
+            "-r",
+            f"{framerate}",
+            filename,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        """
+        Write the next frame: an 8-bit RGB (or RGBA, the alpha channel is
+        ignored) image with the first row at the top.
+        """
+        if frame.shape[0] != self.height or frame.shape[1] != self.width:
+            raise RuntimeError(
+                f"Wrong frame size: {frame.shape[1]}x{frame.shape[0]}"
+                f" (expected {self.width}x{self.height})!"
+            )
+        rgb = np.ascontiguousarray(frame[:, :, :3], dtype=np.uint8)
+        self.process.stdin.write(rgb.data)
+        self.nframe += 1
+
+    def close(self):
+        """
+        Finish the video and wait for ffmpeg to exit.
+        """
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.process = None
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed while writing {self.filename}!")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def ordered_results(pool, function, arglist, window):
+    """
+    Apply the given function to all elements of arglist using the given
+    multiprocessing pool, and yield the results in the order of arglist.
+
+    At most window tasks are submitted ahead of the next result that will
+    be yielded, which limits the number of results that are kept in memory
+    while waiting for an earlier (slower) result.
+    """
+    pending = {}
+    next_submit = 0
+    for inext in range(len(arglist)):
+        while next_submit < len(arglist) and next_submit < inext + window:
+            pending[next_submit] = pool.apply_async(function, (arglist[next_submit],))
+            next_submit += 1
+        yield pending.pop(inext).get()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+block_reduce.py
+
+Downsample (large) maps by combining blocks of pixels into a single pixel,
+e.g. to make sparse stellar maps look less noisy.
+
+Reshaping a map into (nx, fx, ny, fy) blocks only works if the map size is a
+multiple of the reduction factor, and reducing the reshaped map one axis at a
+time creates a large temporary. Instead, the full blocks are reduced over
+both block axes at once, the partial blocks at the edge of the map are
+reduced separately (the result has ceil(n / factor) pixels in each
+dimension), and the map is processed in chunks of block rows, so that the
+temporaries never exceed the chunk size. The chunks can be processed by
+multiple threads, since numpy releases the GIL for the reductions.
+
+Supported reductions are "sum", "mean" and "max", and their NaN-aware
+versions "nansum", "nanmean" and "nanmax", which ignore NaN pixels. A block
+that only contains NaN pixels becomes 0 for "nansum" and NaN for the other
+NaN-aware reductions. The mean of a partial block is the mean of the pixels
+that are actually in the block.
+
+Maps with units (unyt arrays) keep their units.
+"""
+
+import numpy as np
+import unyt
+from colour_lut import default_chunk_size, get_executor
+
+# reductions: numpy ufunc used to combine pixels, and the value NaN pixels are
+# replaced with for the NaN-aware version
+reductions = {
+    "sum": (np.add, 0.0),
+    "mean": (np.add, 0.0),
+    "max": (np.maximum, -np.inf),
+}
+
+
+def get_block_starts(size, factor):
+    """
+    Get the index of the first pixel in each block, and the number of pixels
+    in each block, for a map axis with the given size.
+    """
+    starts = np.arange(0, size, factor)
+    counts = np.minimum(starts + factor, size) - starts
+    return starts, counts
+
+
+def reduce_blocks(values, ufunc, xfactor, yfactor):
+    """
+    Reduce every xfactor x yfactor block of the given 2D array with the given
+    ufunc. The full blocks are reduced as a reshaped view of the array, the
+    partial blocks at the edges (if any) separately. The rows in a block are
+    reduced first, since that only involves element-wise operations on
+    contiguous rows.
+    """
+    nx, ny = values.shape
+    nbx = nx // xfactor
+    nby = ny // yfactor
+    result = np.empty((-(-nx // xfactor), -(-ny // yfactor)), dtype=values.dtype)
+    for xpart, xblocks, nblockx in [
+        (slice(0, nbx * xfactor), slice(0, nbx), nbx),
+        (slice(nbx * xfactor, nx), slice(nbx, None), 1),
+    ]:
+        for ypart, yblocks, nblocky in [
+            (slice(0, nby * yfactor), slice(0, nby), nby),
+            (slice(nby * yfactor, ny), slice(nby, None), 1),
+        ]:
+            part = values[xpart, ypart]
+            if part.size == 0:
+                continue
+            part = part.reshape(
+                (nblockx, part.shape[0] // nblockx, nblocky, part.shape[1] // nblocky)
+            )
+            result[xblocks, yblocks] = ufunc.reduce(ufunc.reduce(part, axis=1), axis=2)
+    return result
+
+
+def block_reduce(
+    data,
+    factor,
+    reduction="mean",
+    nthread=1,
+    chunk_size=default_chunk_size,
+):
+    """
+    Downsample the given 2D map by combining every factor x factor block of
+    pixels using the given reduction. The factor can also be given as a pair
+    (xfactor, yfactor). The map size does not need to be a multiple of the
+    factor.
+
+    The map is processed in chunks of block rows with approximately
+    chunk_size pixels, using nthread threads. Returns the downsampled map.
+    """
+    xfactor, yfactor = (factor, factor) if np.isscalar(factor) else factor
+    nan_aware = reduction.startswith("nan")
+    try:
+        ufunc, nan_value = reductions[reduction[3:] if nan_aware else reduction]
+    except KeyError:
+        raise RuntimeError(f"Unknown reduction: {reduction}!")
+    is_mean = reduction.endswith("mean")
+
+    values = np.asarray(data)
+    nx, ny = values.shape
+    xstarts, xcounts = get_block_starts(nx, xfactor)
+    ystarts, ycounts = get_block_starts(ny, yfactor)
+    dtype = values.dtype
+    if is_mean or not np.issubdtype(dtype, np.inexact):
+        dtype = np.result_type(dtype, np.float32)
+    out = np.empty((xstarts.shape[0], ystarts.shape[0]), dtype=dtype)
+
+    def process_chunk(blocks):
+        xbegin = xstarts[blocks.start]
+        xend = min(xstarts[blocks.stop - 1] + xfactor, nx)
+        chunk = values[xbegin:xend].astype(dtype, copy=nan_aware)
+        if nan_aware:
+            valid = ~np.isnan(chunk)
+            np.copyto(chunk, nan_value, where=~valid)
+        result = reduce_blocks(chunk, ufunc, xfactor, yfactor)
+        if nan_aware:
+            counts = reduce_blocks(valid.astype(np.int32), np.add, xfactor, yfactor)
+        else:
+            counts = xcounts[blocks, None] * ycounts[None, :]
+        if is_mean:
+            np.divide(result, counts, out=result, where=counts > 0)
+        if nan_aware and reduction != "nansum":
+            result[counts == 0] = np.nan
+        out[blocks] = result
+
+    nrow = max(1, chunk_size // max(1, xfactor * ny))
+    if nthread > 1:
+        nrow = min(nrow, max(1, xstarts.shape[0] // nthread))
+    chunks = [
+        slice(ibegin, min(ibegin + nrow, xstarts.shape[0]))
+        for ibegin in range(0, xstarts.shape[0], nrow)
+    ]
+    if nthread > 1 and len(chunks) > 1:
+        # list() makes sure that exceptions in the threads are raised here
+        list(get_executor(nthread).map(process_chunk, chunks))
+    else:
+        for blocks in chunks:
+            process_chunk(blocks)
+
+    if hasattr(data, "units"):
+        return unyt.unyt_array(out, data.units)
+    return out
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""
+colour_lut.py
+
+Quantised colour map lookup tables (LUTs) to convert (large) maps into 8-bit
+RGBA images.
+
+Applying matplotlib.colors.LogNorm() and a colour map to a map creates a
+number of temporary double precision arrays, and returns a float64 RGBA image
+that is 4 times larger than the map itself. Instead, we convert the map into
+integer colour indices in a single pass over the map (in chunks, using a small
+single precision buffer), and then look up the colours in a table with
+nlevel precomputed RGBA colours. The result is an 8-bit RGBA image that is 8
+times smaller than the float64 image and can be passed on to imshow() or
+written to an image file directly.
+
+With nlevel = 256 (the default), the indices are 8-bit integers and the
+result is identical to applying LogNorm() and a standard matplotlib colour map
+(which also has 256 colours). With nlevel = 4096, the indices are 16-bit
+integers, which is useful for colour maps with more colours.
+
+2D colour maps (like swiftsimio's LinearSegmentedCmap2D used for the gas
+surface density-temperature maps) are supported through a 2D LUT with
+nlevel x nlevel colours.
+
+Non-positive and NaN values are treated as values below vmin, i.e. they get
+the first colour of the colour map.
+
+blend_log_index() combines two maps (e.g. for consecutive snapshots) and
+converts the result into colour indices in a single pass: the maps are stored
+as single precision logarithms (see log_map()), are blended in log space and
+normalised straight into a (reusable) index buffer. If numba is available, the
+kernel is compiled, so that no temporary arrays are needed at all. The work
+can be split over multiple threads, since both the numba kernel and the numpy
+operations release the GIL.
+"""
+
+import functools
+import concurrent.futures
+import numpy as np
+import matplotlib
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# default number of levels in a lookup table
+default_nlevel = 256
+
+# number of pixels that is processed in one go
+default_chunk_size = 1 << 22
+
+
+def get_index_type(nlevel):
+    """
+    Get the smallest integer type that can hold nlevel colour indices.
+    """
+    if nlevel <= 256:
+        return np.uint8
+    if nlevel <= 65536:
+        return np.uint16
+    raise RuntimeError(f"Too many levels for a lookup table: {nlevel}!")
+
+
+def get_lut_centres(nlevel):
+    """
+    Get the normalised values at the centres of the nlevel LUT bins.
+    """
+    return (np.arange(nlevel) + 0.5) / nlevel
+
+
+def get_lut(cmap, nlevel=default_nlevel):
+    """
+    Get the lookup table for the given matplotlib colour map (or colour map
+    name): an array of nlevel RGBA colours, as 8-bit integers.
+    """
+    if isinstance(cmap, str):
+        cmap = matplotlib.colormaps[cmap]
+    return cmap(get_lut_centres(nlevel), bytes=True)
+
+
+def get_lut_2d(cmap, nlevel=default_nlevel):
+    """
+    Get the lookup table for the given 2D colour map (e.g. a swiftsimio
+    LinearSegmentedCmap2D): an array with shape (nlevel, nlevel, 4) that
+    contains the RGBA colour for each combination of horizontal (first index)
+    and vertical (second index) level, as 8-bit integers.
+    """
+    centres = get_lut_centres(nlevel)
+    horizontal, vertical = np.meshgrid(centres, centres, indexing="ij")
+    rgba = np.asarray(cmap(horizontal, vertical), dtype=np.float64)
+    return np.round(np.clip(rgba, 0.0, 1.0) * 255.0).astype(np.uint8)
+
+
+def get_row_chunks(shape, chunk_size):
+    """
+    Split the first dimension of an array with the given shape into chunks of
+    approximately chunk_size elements.
+    """
+    nrow = max(1, chunk_size // max(1, int(np.prod(shape[1:]))))
+    for ibegin in range(0, shape[0], nrow):
+        yield slice(ibegin, ibegin + nrow)
+
+
+def log_index(
+    data,
+    vmin,
+    vmax,
+    nlevel=default_nlevel,
+    chunk_size=default_chunk_size,
+):
+    """
+    Convert the given map into colour indices, using a logarithmic
+    normalisation between vmin and vmax.
+
+    This is equivalent to applying matplotlib.colors.LogNorm(vmin, vmax) and
+    converting the result into one of nlevel levels, but does not create any
+    temporary arrays larger than chunk_size elements. Values outside
+    [vmin, vmax] are clipped.
+
+    Returns an array with the same shape as data, with 8-bit (nlevel <= 256)
+    or 16-bit indices.
+    """
+    logmin = np.log10(float(vmin))
+    scale = nlevel / (np.log10(float(vmax)) - logmin)
+
+    index = np.empty(data.shape, dtype=get_index_type(nlevel))
+    for rows in get_row_chunks(data.shape, chunk_size):
+        chunk = np.asarray(data[rows])
+        values = np.empty(chunk.shape, dtype=np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.log10(chunk, out=values, casting="same_kind")
+        values -= logmin
+        values *= scale
+        np.nan_to_num(values, copy=False, nan=0.0, neginf=0.0, posinf=nlevel - 1)
+        np.clip(values, 0, nlevel - 1, out=values)
+        index[rows] = values
+    return index
+
+
+def apply_lut(index, lut):
+    """
+    Convert the given colour indices into colours, using the given lookup
+    table.
+    """
+    return np.take(lut, index, axis=0)
+
+
+def apply_lut_2d(horizontal_index, vertical_index, lut, chunk_size=default_chunk_size):
+    """
+    Convert the given pairs of colour indices into colours, using the given 2D
+    lookup table.
+    """
+    nlevel = lut.shape[1]
+    flat_lut = lut.reshape((-1, lut.shape[2]))
+    rgba = np.empty(horizontal_index.shape + lut.shape[2:], dtype=lut.dtype)
+    for rows in get_row_chunks(horizontal_index.shape, chunk_size):
+        flat_index = horizontal_index[rows].astype(np.intp)
+        flat_index *= nlevel
+        flat_index += vertical_index[rows]
+        np.take(flat_lut, flat_index, axis=0, out=rgba[rows])
+    return rgba
+
+
+def colourise(data, vmin, vmax, lut, chunk_size=default_chunk_size):
+    """
+    Convert the given map into an 8-bit RGBA image, using a logarithmic
+    normalisation between vmin and vmax and the given lookup table (see
+    get_lut()).
+
+    This replaces cmap(matplotlib.colors.LogNorm(vmin, vmax)(data)).
+    """
+    return apply_lut(log_index(data, vmin, vmax, lut.shape[0], chunk_size), lut)
+
+
+def colourise_2d(
+    horizontal_data,
+    horizontal_limits,
+    vertical_data,
+    vertical_limits,
+    lut,
+    chunk_size=default_chunk_size,
+):
+    """
+    Convert the given pair of maps into an 8-bit RGBA image, using logarithmic
+    normalisations between the given limits ([vmin, vmax]) and the given 2D
+    lookup table (see get_lut_2d()).
+
+    This replaces
+      cmap(LogNorm(*horizontal_limits)(horizontal_data),
+           LogNorm(*vertical_limits)(vertical_data))
+    """
+    nlevel = lut.shape[0]
+    horizontal_index = log_index(
+        horizontal_data, *horizontal_limits, nlevel, chunk_size
+    )
+    vertical_index = log_index(vertical_data, *vertical_limits, nlevel, chunk_size)
+    return apply_lut_2d(horizontal_index, vertical_index, lut, chunk_size)
+
+
+def log_map(data, chunk_size=default_chunk_size):
+    """
+    Get the base 10 logarithm of the given map, as a single precision array.
+    Non-positive values become -inf.
+    """
+    values = np.empty(data.shape, dtype=np.float32)
+    for rows in get_row_chunks(data.shape, chunk_size):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.log10(np.asarray(data[rows]), out=values[rows], casting="same_kind")
+    return values
+
+
+def blend_log_index_numpy(log0, log1, fac, logmin, scale, nlevel, binary, out):
+    """
+    numpy version of the blend_log_index() kernel, for a single chunk.
+    """
+    values = np.fmax(log0, np.float32(logmin))
+    other = np.fmax(log1, np.float32(logmin))
+    values *= np.float32(1.0 - fac)
+    other *= np.float32(fac)
+    values += other
+    del other
+    if binary:
+        out[...] = np.where(values > logmin, nlevel - 1, 0)
+        return
+    values -= np.float32(logmin)
+    values *= np.float32(scale)
+    np.nan_to_num(values, copy=False, nan=0.0, posinf=nlevel - 1)
+    np.clip(values, 0, nlevel - 1, out=values)
+    out[...] = values
+
+
+if numba is not None:
+
+    @numba.njit(nogil=True)
+    def blend_log_index_numba(log0, log1, fac, logmin, scale, nlevel, binary, out):
+        """
+        Compiled version of the blend_log_index() kernel, for a single chunk.
+        """
+        w0 = np.float32(1.0 - fac)
+        w1 = np.float32(fac)
+        lmin = np.float32(logmin)
+        lscale = np.float32(scale)
+        for i in range(log0.shape[0]):
+            for j in range(log0.shape[1]):
+                # the negated comparisons also catch NaN values
+                l0 = log0[i, j]
+                if not l0 > lmin:
+                    l0 = lmin
+                l1 = log1[i, j]
+                if not l1 > lmin:
+                    l1 = lmin
+                value = w0 * l0 + w1 * l1
+                if binary:
+                    out[i, j] = nlevel - 1 if value > lmin else 0
+                    continue
+                value = (value - lmin) * lscale
+                if value >= nlevel - 1:
+                    out[i, j] = nlevel - 1
+                elif value > 0.0:
+                    out[i, j] = int(value)
+                else:
+                    out[i, j] = 0
+
+else:
+    blend_log_index_numba = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_executor(nthread):
+    """
+    Get the thread pool with the given number of threads.
+    """
+    return concurrent.futures.ThreadPoolExecutor(nthread)
+
+
+def blend_log_index(
+    log0,
+    log1,
+    fac,
+    vmin,
+    vmax,
+    nlevel=default_nlevel,
+    out=None,
+    binary=False,
+    nthread=1,
+    chunk_size=default_chunk_size,
+    use_numba=True,
+):
+    """
+    Blend the given maps (the base 10 logarithms of the actual maps, see
+    log_map()) in log space with weights (1-fac) and fac, and convert the
+    result into colour indices using a logarithmic normalisation between vmin
+    and vmax.
+
+    Values below vmin are set to vmin before blending. If binary is True, all
+    pixels with a blended value above vmin get the last level, and all other
+    pixels the first level.
+
+    The indices are written into out (a 2D array with 8-bit or 16-bit
+    integers, see get_index_type()), which is allocated if not given. The
+    rows are processed in chunks of approximately chunk_size pixels, using
+    nthread threads. The numba kernel is used if numba is available and
+    use_numba is True.
+
+    This replaces log_index((1-fac)*map0 + fac*map1, vmin, vmax, nlevel)
+    (which blends the maps linearly), without any double precision
+    temporaries. Returns out.
+    """
+    if out is None:
+        out = np.empty(log0.shape, dtype=get_index_type(nlevel))
+    logmin = np.log10(float(vmin))
+    scale = nlevel / (np.log10(float(vmax)) - logmin)
+
+    kernel = blend_log_index_numpy
+    if use_numba and blend_log_index_numba is not None:
+        kernel = blend_log_index_numba
+
+    def process_chunk(rows):
+        kernel(log0[rows], log1[rows], fac, logmin, scale, nlevel, binary, out[rows])
+
+    if nthread > 1:
+        chunk_size = min(chunk_size, max(1, log0.size // nthread))
+    chunks = list(get_row_chunks(log0.shape, chunk_size))
+    if nthread > 1 and len(chunks) > 1:
+        # list() makes sure that exceptions in the threads are raised here
+        list(get_executor(nthread).map(process_chunk, chunks))
+    else:
+        for rows in chunks:
+            process_chunk(rows)
+    return out
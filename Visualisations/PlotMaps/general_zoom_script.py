@@ -18,71 +18,87 @@ To ensure a smooth transition in more challenging maps (the stellar surface
 density map, which has many empty pixels), we linearly interpolate between
 maps at different resolutions over a certain overlap range.
 
-This script uses multiprocessing to generate frames in parallel. It requires
-quite a lot of memory to store all the images in memory, so run it on a large
-machine, like e.g. draco!
+This script uses multiprocessing to generate frames in parallel. The maps
+are converted into RGBA images once and stored as memory-mapped tile pyramids
+(see tile_pyramid.py) next to the maps. For each frame, only the tiles that
+are visible in the frame are read, at the pyramid level that matches the
+resolution of the frame. The pyramids are reused in subsequent runs, as long
+as the map type, scaling and plotting limits do not change.
+
+Usage:
+  python3 general_zoom_script.py [config.yml] [--nproc N] [--imin I]
+    [--imax I] [--task ITASK NTASK] [--overwrite] [--test_frames]
+
+The parameters (see default_parameters below) can be changed using a YAML
+file that contains the parameters that should differ from the defaults. The
+frame schedule (the zoom factor for each frame) only depends on these
+parameters, so that frames can be generated in multiple independent runs:
+ - frames that already exist are skipped, unless --overwrite is given; an
+   interrupted run can simply be restarted.
+ - --imin and --imax restrict the run to frames with imin <= index < imax.
+ - --task ITASK NTASK splits the frames into NTASK contiguous ranges and only
+   generates range ITASK (0 <= ITASK < NTASK), e.g. in a Slurm array job:
+     --task ${SLURM_ARRAY_TASK_ID} ${SLURM_ARRAY_TASK_COUNT}
+   The pyramids should be created before running the array job (e.g. by
+   running the script once with --imax 0), to avoid different tasks creating
+   the same pyramid at the same time.
+
+The engine can also be used from other scripts, e.g.
+  from general_zoom_script import ZoomSequence, read_parameters
+  sequence = ZoomSequence(read_parameters("config.yml"))
+  sequence.plot_frame(0, 1.0)
 """
 
+import os
+import argparse
 import numpy as np
 import matplotlib
 
 matplotlib.use("Agg")
 import matplotlib.pyplot as pl
 import multiprocessing as mp
+import yaml
 from swiftsimio.visualisation.tools.cmaps import LinearSegmentedCmap2D
-
-## input parameters
-
-# type of map to plot
-# The map type can be "stars", "xrays", "dm" or "gas"
-map_type = "dm"
-
-# do not generate the frames, but simply plot the maps next to each other to
-# check the relative scaling
-test_frames = False
-
-# output prefix for frame files. Actual name will be {prefix}_XXXX.png
-nframe = 1000
-output_prefix = "zoom_sequence/frame"
-
-# boxes we have
-boxes = [2800.0, 700., 175.0, 45.0]
-minbox = [350., 87.5, 21.875, 11.25]
-box_names = ["L2800_8192", "L700_8192", "L175_8192", "L45_4096"]
-#boxes = [700., 350.0, 100.0]
-#box_names = ["L700_4096", "L350_3584", "L100_1024"]
-
-# position of the zoom centre
-#xt0 = 504.29982829
-#yt0 = 2199.06415212
-xt0 = 1400.
-yt0 = 1400.
-# largest and smallest zoom box size (in Mpc)
-w0 = 2800.0
-w1 = 20.0
-
-# plotting limits for:
-# - gas surface density (unspecified units)
-smin = 2.e6
-smax = 6.e10
-# - dark matter surface density (unspecified units)
-dmin = 1.e8
-dmax = 3.e12
-# - temperature (K)
-Tmin = 5.e4
-Tmax = 1.0e10
-# - X-ray luminosities (unspecified units)
-Xmax = 1.e8
-Xmin = 1.0e-6 * Xmax
-# - stellar surface density (unspecified units)
-#stmax = 2.7884990987921e19
-#stmin = 1.e14
-stmax = 45307123866.25
-stmin = 1.e-5*stmax
-#stmin = 1.e8
-
-# number of parallel processes to use to generate frames
-nproc = 16
+from map_store import find_map, load_map
+from colour_lut import get_lut, get_lut_2d, colourise, colourise_2d
+from tile_pyramid import TilePyramid, build_pyramid, load_pyramid_provenance
+
+## default input parameters
+
+default_parameters = {
+    # type of map to plot
+    # The map type can be "stars", "xrays", "dm" or "gas"
+    "map_type": "dm",
+    # output prefix for frame files. Actual name will be {prefix}_XXXX.png
+    "output_prefix": "zoom_sequence/frame",
+    # number of frames
+    "nframe": 1000,
+    # boxes we have: size (in Mpc), minimum box size for which the next
+    # (larger) map is blended in, and folder containing the maps
+    "boxes": [2800.0, 700.0, 175.0, 45.0],
+    "minbox": [350.0, 87.5, 21.875, 11.25],
+    "box_names": ["L2800_8192", "L700_8192", "L175_8192", "L45_4096"],
+    # position of the zoom centre (in Mpc)
+    "centre": [1400.0, 1400.0],
+    # largest and smallest zoom box size (in Mpc)
+    "w0": 2800.0,
+    "w1": 20.0,
+    # plotting limits for each type of map:
+    # - gas surface density and temperature (unspecified units and K)
+    # - dark matter surface density (unspecified units)
+    # - X-ray luminosities (unspecified units)
+    # - stellar surface density (unspecified units)
+    "map_limits": {
+        "gas": [2.0e6, 6.0e10, 5.0e4, 1.0e10],
+        "dm": [1.0e8, 3.0e12],
+        "xrays": [1.0e2, 1.0e8],
+        "stars": [4.530712386625e5, 45307123866.25],
+    },
+    # number of parallel processes to use to generate frames
+    "nproc": 16,
+    # resolution of the frames (in pixels): 6 inch at 300 dpi
+    "frame_resolution": 1800,
+}
 
 ## other code: do not touch unless you know what you are doing!
 
@@ -93,30 +109,60 @@ gas_temperature_map = LinearSegmentedCmap2D(
     name="gas_temperature_map",
 )
 
-# LogNorm() objects for all quantities
-Tnrm = matplotlib.colors.LogNorm(vmin=Tmin, vmax=Tmax)
-snrm = matplotlib.colors.LogNorm(vmin=smin, vmax=smax)
-dnrm = matplotlib.colors.LogNorm(vmin=dmin, vmax=dmax)
-Xnrm = matplotlib.colors.LogNorm(vmin=Xmin, vmax=Xmax)
-stnrm = matplotlib.colors.LogNorm(vmin=stmin, vmax=stmax)
-
 # 1D colour maps for dark matter, X-rays and stars
 dmap = pl.get_cmap("cividis")
 Xmap = pl.get_cmap("magma")
 stmap = pl.get_cmap("pink")
 #stmap = pl.get_cmap("viridis")
 
+# colour lookup tables for all quantities (see colour_lut.py)
+# maps are converted into 8-bit RGBA images using a logarithmic normalisation
+gas_lut = get_lut_2d(gas_temperature_map)
+dlut = get_lut(dmap)
+Xlut = get_lut(Xmap)
+stlut = get_lut(stmap)
+
+# maps used for each type of map
+map_names = {
+    "stars": ["star_map_sigma"],
+    "xrays": ["gas_map_xray"],
+    "dm": ["dm_map_sigma"],
+    "gas": ["gas_map_sigma", "gas_map_temp"],
+}
 
-def get_map(folder, fac, type):
+
+def read_parameters(filename=None):
+    """
+    Get the parameters for a zoom sequence: the default parameters, updated
+    with the parameters in the given YAML file (if any).
+    """
+    parameters = dict(default_parameters)
+    if filename is not None:
+        with open(filename, "r") as handle:
+            config = yaml.safe_load(handle.read())
+        if config is not None:
+            for key in config:
+                if not key in default_parameters:
+                    raise RuntimeError(f"Unknown parameter: {key}!")
+            parameters.update(config)
+    return parameters
+
+
+def get_map(folder, fac, type, limits):
     """
     Get a map from the given folder, using the given zoom factor to rescale
     quantities to consistent units.
 
     The map type can be "stars", "xrays", "dm" or "gas"
+
+    Maps are read from .map stores if these exist, or from .npz files
+    otherwise (see map_store.py). The map is returned as an 8-bit RGBA image,
+    using the given plotting limits ([vmin, vmax], or [smin, smax, Tmin, Tmax]
+    for gas).
     """
 
     if type == "stars":
-        stardens = np.load(f"{folder}/star_map_sigma_z0000.npz")["surfdens"]
+        stardens = np.array(load_map(find_map(f"{folder}/star_map_sigma_z0000"))[1])
 
         nanmean = np.nanmean(stardens)
         posmin = stardens[stardens>0.].min()
@@ -127,49 +173,61 @@ def get_map(folder, fac, type):
         stardens *= fac
         stardens[stardens <= 0.] = 1.e-99
 
-        return stmap(stnrm(stardens.T))
+        return colourise(stardens.T, limits[0], limits[1], stlut)
 
     elif type == "xrays":
-        xray = np.load(f"{folder}/gas_map_xray_z0000.npz")["rosat"]
+        xray = np.array(load_map(find_map(f"{folder}/gas_map_xray_z0000"))[1])
         xray[xray <= 0.0] = 1.0e-99
 
         print(xray.min(), xray.max())
 
-        return Xmap(Xnrm(xray.T))
+        return colourise(xray.T, limits[0], limits[1], Xlut)
 
     elif type == "dm":
-        surfdens = np.load(f"{folder}/dm_map_sigma_z0000.npz")["surfdens"] * fac
+        surfdens = load_map(find_map(f"{folder}/dm_map_sigma_z0000"))[1] * fac
 
         print(surfdens.min(), surfdens.max())
 
-        return dmap(dnrm(surfdens.T))
+        return colourise(surfdens.T, limits[0], limits[1], dlut)
 
     elif type == "gas":
-        surfdens = np.load(f"{folder}/gas_map_sigma_z0000.npz")["surfdens"] * fac
-        temp = np.load(f"{folder}/gas_map_temp_z0000.npz")["temp"]
+        surfdens = load_map(find_map(f"{folder}/gas_map_sigma_z0000"))[1] * fac
+        temp = load_map(find_map(f"{folder}/gas_map_temp_z0000"))[1]
 
         print(surfdens.min(), surfdens.max())
 
-        surfdens = snrm(surfdens)
-        temp = Tnrm(temp)
+        return colourise_2d(surfdens.T, limits[0:2], temp.T, limits[2:4], gas_lut)
 
-        return gas_temperature_map(surfdens.T, temp.T)
 
-
-def get_xy(zoomfac):
+def get_pyramid(folder, fac, type, limits):
     """
-    Get the centre of the box at the given zoom factor.
-
-    The centre is chosen so that it is the box centre for a zoom factor of 1,
-    and equal to the chosen zoom centre for the maximum zoom factor.
+    Get the tile pyramid for the map of the given type in the given folder,
+    using the given zoom factor to rescale quantities to consistent units.
 
-    In between, it linearly moves from one to the other.
+    The pyramid is only (re)created if it does not exist yet, or if it was
+    created for different maps, a different zoom factor, different limits or
+    without all the reductions we need.
     """
-    w = w0 / zoomfac
-    t = (w0 - w) / (w0 - w1)
-    x = (xt0 - 0.5 * w1) * t + 0.5 * w
-    y = (yt0 - 0.5 * w1) * t + 0.5 * w
-    return x, y, w
+    filename = f"{folder}/{type}_zoom.pyramid"
+    reductions = ["mean", "max"]
+    provenance = {
+        "type": type,
+        "fac": float(fac),
+        "limits": [float(limit) for limit in limits],
+        "reductions": reductions,
+        "maps": {
+            name: os.path.getmtime(find_map(f"{folder}/{name}_z0000"))
+            for name in map_names[type]
+        },
+    }
+    if load_pyramid_provenance(filename) != provenance:
+        build_pyramid(
+            filename,
+            get_map(folder, fac, type, limits),
+            provenance=provenance,
+            reductions=reductions,
+        )
+    return TilePyramid(filename)
 
 
 def plot_box(x, y, w, ax, color=None):
@@ -191,57 +249,10 @@ def plot_box(x, y, w, ax, color=None):
 
     return
 
-# read the data for the frames we actually have
-# each frame has a corresponding box size, map and anchor point of the map
-# within the original box
-maps = [None] * len(box_names)
-coords = [None] * len(box_names)
-for i, map in enumerate(box_names):
-    fac = w0 / boxes[i]
-    maps[i] = get_map(map, fac**2, map_type)
-    print(maps[i].shape)
-    res = maps[i].shape[0]
-    x, y, _ = get_xy(fac)
-    x -= 0.5 * boxes[i]
-    y -= 0.5 * boxes[i]
-    coords[i] = (x, y)
 
 def get_brightness(rms):
     return np.sqrt(0.241*(rms[0]**2) + 0.691*(rms[1]**2) + 0.068*(rms[2]**2))
 
-if test_frames:
-    factors = [17.89215352740855/19.611332398104803, 1., 1., 1.]
-    for i in range(len(maps)):
-      fig, ax = pl.subplots(figsize=(6.,6.))
-      x, y = coords[i]
-      boxsize = boxes[i]
-      ax.imshow(maps[i], origin="lower")
-      ax.axis("off")
-      ax.set_aspect("equal")
-      pl.tight_layout(pad=0)
-      pl.savefig(f"test_frames_{2*i:04d}.png", dpi=300)
-      pl.close()
-      fig, ax = pl.subplots(figsize=(6.,6.))
-      xmap, ymap = coords[i]
-      if i < len(maps)-1:
-        x, y = coords[i+1]
-        boxsize = boxes[i+1]
-        other_map = np.array(maps[i+1])
-      else:
-        other_map = np.array(maps[i])
-      this_map = np.array(maps[i])
-      other_map[:,:,3] = 0.5
-      ax.imshow(this_map, extent=[xmap, xmap + boxes[i], ymap, ymap + boxes[i]], origin="lower")
-      ax.imshow(other_map, extent=[x, x + boxsize, y, y + boxsize], origin="lower")
-#      ax.imshow(maps[i], extent=[xmap, xmap + boxes[i], ymap, ymap + boxes[i]], origin="lower")
-      ax.axis("off")
-      ax.set_aspect("equal")
-#      ax.set_xlim(x, x + boxsize)
-#      ax.set_ylim(y, y + boxsize)
-      pl.tight_layout(pad=0)
-      pl.savefig(f"test_frames_{2*i+1:04d}.png", dpi=300)
-      pl.close()
-    exit()
 
 def get_label_fraction(box_size):
     """
@@ -258,107 +269,343 @@ def get_label_fraction(box_size):
     return label_fraction
 
 
+class ZoomSequence:
+    """
+    Zoom sequence engine: the maps (as tile pyramids) and parameters needed
+    to plot the frames of a zoom sequence.
+    """
+
+    def __init__(self, parameters):
+        """
+        Set up the zoom sequence with the given parameters (see
+        read_parameters()). Pyramids that do not exist yet or are out of date
+        are created.
+        """
+        self.map_type = parameters["map_type"]
+        self.output_prefix = parameters["output_prefix"]
+        self.nframe = parameters["nframe"]
+        self.boxes = parameters["boxes"]
+        self.minbox = parameters["minbox"]
+        self.box_names = parameters["box_names"]
+        self.xt0, self.yt0 = parameters["centre"]
+        self.w0 = parameters["w0"]
+        self.w1 = parameters["w1"]
+        self.limits = parameters["map_limits"][self.map_type]
+        self.frame_resolution = parameters["frame_resolution"]
+
+        # read the data for the frames we actually have
+        # each frame has a corresponding box size, map and anchor point of the
+        # map within the original box
+        self.maps = [None] * len(self.box_names)
+        self.coords = [None] * len(self.box_names)
+        for i, map in enumerate(self.box_names):
+            fac = self.w0 / self.boxes[i]
+            self.maps[i] = get_pyramid(map, fac**2, self.map_type, self.limits)
+            x, y, _ = self.get_xy(fac)
+            x -= 0.5 * self.boxes[i]
+            y -= 0.5 * self.boxes[i]
+            self.coords[i] = (x, y)
+
+    def get_schedule(self):
+        """
+        Get the zoom factor for each frame: nframe logarithmically spaced
+        factors between 1 and w0/w1.
+        """
+        return np.logspace(0.0, np.log10(self.w0 / self.w1), self.nframe)
+
+    def get_output_name(self, i):
+        """
+        Get the name of the file for frame i.
+        """
+        return f"{self.output_prefix}_{i:04d}.png"
+
+    def get_xy(self, zoomfac):
+        """
+        Get the centre of the box at the given zoom factor.
+
+        The centre is chosen so that it is the box centre for a zoom factor of
+        1, and equal to the chosen zoom centre for the maximum zoom factor.
+
+        In between, it linearly moves from one to the other.
+        """
+        w = self.w0 / zoomfac
+        t = (self.w0 - w) / (self.w0 - self.w1)
+        x = (self.xt0 - 0.5 * self.w1) * t + 0.5 * w
+        y = (self.yt0 - 0.5 * self.w1) * t + 0.5 * w
+        return x, y, w
+
+    def get_visible_map(self, imap, x, y, boxsize, rfac=1):
+        """
+        Get the part of map imap that is visible in a frame that shows the box
+        [x, x + boxsize] x [y, y + boxsize].
+
+        The part is read from the pyramid level that matches the frame
+        resolution. If rfac is not 1, the max-pooled pyramid level that
+        corresponds to a reduction by a factor rfac is used instead, i.e.
+        every rfac x rfac block of pixels is replaced by its maximum value.
+        rfac needs to be a power of 2. For small maps that do not have the
+        corresponding level, the coarsest level is used.
+
+        Returns the image and its extent (for imshow()), or None if the map is
+        not visible in the frame.
+        """
+        pyramid = self.maps[imap]
+        xmap, ymap = self.coords[imap]
+        mapsize = self.boxes[imap]
+        if rfac != 1:
+            level = min(int(np.round(np.log2(rfac))), pyramid.nlevel - 1)
+            reduction = "max"
+        else:
+            level = pyramid.get_level(
+                pyramid.shape[1] * boxsize / mapsize / self.frame_resolution
+            )
+            reduction = "mean"
+        nrow, ncol = pyramid.get_shape(level)
+        pixel_size = mapsize / ncol
+
+        jmin = max(int(np.floor((x - xmap) / pixel_size)), 0)
+        jmax = min(int(np.ceil((x + boxsize - xmap) / pixel_size)), ncol)
+        imin = max(int(np.floor((y - ymap) / pixel_size)), 0)
+        imax = min(int(np.ceil((y + boxsize - ymap) / pixel_size)), nrow)
+        if jmax <= jmin or imax <= imin:
+            return None
+
+        image = pyramid.get_region(level, imin, imax, jmin, jmax, reduction)
+
+        extent = [
+            xmap + jmin * pixel_size,
+            xmap + jmax * pixel_size,
+            ymap + imin * pixel_size,
+            ymap + imax * pixel_size,
+        ]
+        return image, extent
+
+    def plot_frame(self, i, fac):
+        """
+        Plot the frame with the given index i (used to label the resulting
+        image file) and zoom factor fac (that determines the spatial scale
+        that is plotted).
+
+        The frame is first written to a temporary file that is only renamed
+        once it is complete, so that existing frames can safely be skipped
+        when a run is restarted.
+        """
+
+        # get the size of the box from the zoom factor
+        boxsize = self.w0 / fac
+        # now find the closest map in our set that is larger
+        imap = len(self.boxes) - 1
+        while boxsize > self.boxes[imap]:
+            imap -= 1
+
+        # get the anchor point of this particular box
+        x, y, _ = self.get_xy(fac)
+        x -= 0.5 * boxsize
+        y -= 0.5 * boxsize
+
+        # set up the scale label
+        label_fraction = get_label_fraction(boxsize)
+        scale_label = f"{label_fraction*boxsize:.0f} Mpc"
+
+        rfac = 1
+        if self.map_type == "stars" or self.map_type == "gas":
+            if i == 0:
+                rfac = 4
+            if i == 1 or i == 2:
+                rfac = 2
+
+        # make the image
+        fig, ax = pl.subplots(figsize=(6.0, 6.0))
+
+        alphafac = 1.
+        if imap > 0 and (not self.map_type == "gas"):
+            alphafac = (boxsize - self.boxes[imap]) / (
+                self.minbox[imap - 1] - self.boxes[imap]
+            )
+            alphafac = min(1., alphafac)
+            if alphafac < 1.:
+                visible = self.get_visible_map(imap - 1, x, y, boxsize, rfac)
+                if visible is not None:
+                    this_map, extent = visible
+                    ax.imshow(this_map, extent=extent, origin="lower")
+
+        # plot the visible part of the map with the appropriate size (set by
+        # the actual map)
+        visible = self.get_visible_map(imap, x, y, boxsize, rfac)
+        if visible is not None:
+            this_map, extent = visible
+            ax.imshow(
+                this_map,
+                extent=extent,
+                origin="lower",
+                alpha = alphafac,
+            )
+
+        # plot the scale label
+        ax.plot(
+            [x + 0.05 * boxsize, x + (0.05 + label_fraction) * boxsize],
+            [y + 0.05 * boxsize, y + 0.05 * boxsize],
+            "w-", linewidth=4
+        )
+        ax.text(x + 0.05 * boxsize, y + 0.07 * boxsize, scale_label, color="w", fontsize="xx-large")
+
+        # now adjust the axis limits so that only the box of interest is shown
+        ax.set_aspect("equal")
+        ax.set_xlim(x, x + boxsize)
+        ax.set_ylim(y, y + boxsize)
+
+        # clean up the plot and save the frame
+        ax.axis("off")
+        pl.tight_layout(pad=0)
+        output = self.get_output_name(i)
+        tmpname = f"{output.removesuffix('.png')}.tmp.png"
+        pl.savefig(tmpname, dpi=300)
+        pl.close()
+        os.replace(tmpname, output)
+
+    def plot_test_frames(self):
+        """
+        Do not generate the frames, but simply plot the maps next to each
+        other to check the relative scaling.
+        """
+        maps = self.maps
+        coords = self.coords
+        boxes = self.boxes
+        factors = [17.89215352740855/19.611332398104803, 1., 1., 1.]
+        # use the pyramid levels that roughly match the frame resolution
+        images = [
+            pyramid.get_image(
+                pyramid.get_level(pyramid.shape[1] / self.frame_resolution)
+            )
+            for pyramid in maps
+        ]
+        for i in range(len(maps)):
+            fig, ax = pl.subplots(figsize=(6.,6.))
+            x, y = coords[i]
+            boxsize = boxes[i]
+            ax.imshow(images[i], origin="lower")
+            ax.axis("off")
+            ax.set_aspect("equal")
+            pl.tight_layout(pad=0)
+            pl.savefig(f"test_frames_{2*i:04d}.png", dpi=300)
+            pl.close()
+            fig, ax = pl.subplots(figsize=(6.,6.))
+            xmap, ymap = coords[i]
+            if i < len(maps)-1:
+                x, y = coords[i+1]
+                boxsize = boxes[i+1]
+                other_map = np.array(images[i+1])
+            else:
+                other_map = np.array(images[i])
+            this_map = np.array(images[i])
+            other_map[:,:,3] = 128
+            ax.imshow(this_map, extent=[xmap, xmap + boxes[i], ymap, ymap + boxes[i]], origin="lower")
+            ax.imshow(other_map, extent=[x, x + boxsize, y, y + boxsize], origin="lower")
+            ax.axis("off")
+            ax.set_aspect("equal")
+            pl.tight_layout(pad=0)
+            pl.savefig(f"test_frames_{2*i+1:04d}.png", dpi=300)
+            pl.close()
+
+
+def get_frame_range(nframe, imin=-1, imax=-1, task=None):
+    """
+    Get the range of frame indices [first, last) that should be generated.
+
+    imin and imax restrict the range (negative values are ignored). task is a
+    tuple (itask, ntask) that splits the range into ntask contiguous parts of
+    (almost) equal size and selects part itask.
+    """
+    first = max(imin, 0)
+    last = nframe if imax < 0 else min(imax, nframe)
+    if task is not None:
+        itask, ntask = task
+        if itask < 0 or itask >= ntask:
+            raise RuntimeError(f"Invalid task: {itask} (number of tasks: {ntask})!")
+        count = max(last - first, 0)
+        first, last = (
+            first + itask * count // ntask,
+            first + (itask + 1) * count // ntask,
+        )
+    return first, last
+
+
+# zoom sequence used by the worker processes, set in init_worker()
+sequence = None
+
+
+def init_worker(parameters):
+    """
+    Initialise a worker process: open the zoom sequence. The pyramids are
+    memory-mapped, so all workers share the same data.
+    """
+    global sequence
+    sequence = ZoomSequence(parameters)
+
+
 def plot_frame(args):
     """
     Plot the frame with the given args:
     i: the index of the frame (used to label the resulting image file)
     fac: the zoom factor that determines the spatial scale that is plotted
     """
-
     i, fac = args
-    # get the size of the box from the zoom factor
-    boxsize = w0 / fac
-    # now find the closest map in our set that is larger
-    imap = len(boxes) - 1
-    while boxsize > boxes[imap]:
-        imap -= 1
-
-    # get the anchor point of the closest map and of this particular box
-    xmap, ymap = coords[imap]
-    x, y, _ = get_xy(fac)
-    x -= 0.5 * boxsize
-    y -= 0.5 * boxsize
-
-    # set up the scale label
-    label_fraction = get_label_fraction(boxsize)
-    scale_label = f"{label_fraction*boxsize:.0f} Mpc"
-
-    rfac = 1
-    if map_type == "stars" or map_type == "gas":
-      if i == 0:
-        rfac = 4
-      if i == 1 or i == 2:
-        rfac = 2
-
-    # make the image
-    fig, ax = pl.subplots(figsize=(6.0, 6.0))
-
-    alphafac = 1.
-    if imap > 0 and (not map_type == "gas"):
-      alphafac = (boxsize-boxes[imap])/(minbox[imap-1]-boxes[imap])
-      alphafac = min(1., alphafac)
-      if alphafac < 1.:
-        xmm1, ymm1 = coords[imap-1]
-        if rfac != 1:
-          res = maps[imap-1].shape[0]//rfac
-          map_reshape = maps[imap-1].reshape((res, rfac, res, rfac, 4))
-          map_reshape = map_reshape.max(axis=1)
-          map_reshape = map_reshape.max(axis=2)
-          this_map = map_reshape
-        else:
-          this_map = maps[imap-1]
-        ax.imshow(this_map, extent=[xmm1, xmm1 + boxes[imap-1], ymm1, ymm1 + boxes[imap-1]],
-                  origin="lower")
-
-    if rfac != 1:
-        res = maps[imap].shape[0]//rfac
-        map_reshape = maps[imap].reshape((res, rfac, res, rfac, 4))
-        map_reshape = map_reshape.max(axis=1)
-        map_reshape = map_reshape.max(axis=2)
-        this_map = map_reshape
-    else:
-        this_map = maps[imap]
-
-
-    # plot the entire map with the appropriate size (set by the actual map)
-    ax.imshow(
-#        maps[imap],
-        this_map,
-        extent=[xmap, xmap + boxes[imap], ymap, ymap + boxes[imap]],
-        origin="lower",
-        alpha = alphafac,
-    )
-
-    # plot the scale label
-    ax.plot(
-        [x + 0.05 * boxsize, x + (0.05 + label_fraction) * boxsize],
-        [y + 0.05 * boxsize, y + 0.05 * boxsize],
-        "w-", linewidth=4
-    )
-    ax.text(x + 0.05 * boxsize, y + 0.07 * boxsize, scale_label, color="w", fontsize="xx-large")
-
-    # now adjust the axis limits so that only the box of interest is shown
-    ax.set_aspect("equal")
-    ax.set_xlim(x, x + boxsize)
-    ax.set_ylim(y, y + boxsize)
-
-    # clean up the plot and save the frame
-    ax.axis("off")
-    pl.tight_layout(pad=0)
-    pl.savefig(f"{output_prefix}_{i:04d}.png", dpi=300)
-    pl.close()
-
+    sequence.plot_frame(i, fac)
     # return the args so that the caller can track progress
     return i, fac
 
 
-# set up a parallel pool with 32 processes
-pool = mp.Pool(nproc)
-zfacs = np.logspace(0.0, np.log10(w0 / w1), nframe)
-zfacs = [1., 4., 16., 64.]
-# generate 1000 frames between a zoom factor of 1 and w0/w1 (in parallel)
-for i, fac in pool.imap_unordered(
-    plot_frame, enumerate(zfacs)
-):
-    # display some progress
-    print(i, fac, "done")
+def run(parameters, imin=-1, imax=-1, task=None, overwrite=False):
+    """
+    Generate the frames of the zoom sequence with the given parameters (see
+    read_parameters()) in parallel, within the given frame range (see
+    get_frame_range()). Frames that already exist are skipped, unless
+    overwrite is True.
+    """
+    # create the pyramids (if necessary) before the workers open them
+    main_sequence = ZoomSequence(parameters)
+    zfacs = main_sequence.get_schedule()
+    first, last = get_frame_range(len(zfacs), imin, imax, task)
+
+    output_folder = os.path.dirname(main_sequence.get_output_name(0))
+    if output_folder != "":
+        os.makedirs(output_folder, exist_ok=True)
+
+    arglist = []
+    for i in range(first, last):
+        if not overwrite and os.path.exists(main_sequence.get_output_name(i)):
+            continue
+        arglist.append((i, zfacs[i]))
+    print(f"Generating {len(arglist)} frames in range [{first}, {last})")
+    if len(arglist) == 0:
+        return
+
+    pool = mp.Pool(parameters["nproc"], initializer=init_worker, initargs=(parameters,))
+    for i, fac in pool.imap_unordered(plot_frame, arglist):
+        # display some progress
+        print(i, fac, "done")
+    pool.close()
+    pool.join()
+
+
+if __name__ == "__main__":
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("config", nargs="?", default=None)
+    argparser.add_argument("--nproc", "-j", type=int, default=None)
+    argparser.add_argument("--imin", "-i", type=int, default=-1)
+    argparser.add_argument("--imax", "-I", type=int, default=-1)
+    argparser.add_argument("--task", "-t", type=int, nargs=2, default=None)
+    argparser.add_argument("--overwrite", "-o", action="store_true")
+    argparser.add_argument("--test_frames", action="store_true")
+    args = argparser.parse_args()
+
+    parameters = read_parameters(args.config)
+    if args.nproc is not None:
+        parameters["nproc"] = args.nproc
+
+    if args.test_frames:
+        ZoomSequence(parameters).plot_test_frames()
+        exit()
+
+    run(parameters, args.imin, args.imax, args.task, args.overwrite)
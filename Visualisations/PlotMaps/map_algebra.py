@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+map_algebra.py
+
+In-place arithmetic on (large) maps with units, e.g. to sum the surface
+density maps of all particle species into a total mass map.
+
+Adding unyt arrays (total += data) checks and converts the units on every
+operation, and mixing single and double precision maps creates full size
+double precision temporaries. Instead, the units are checked once per
+operation (resulting in a single conversion factor), and the values are added
+straight into a preallocated accumulator (in single precision by default), in
+chunks of rows, using a small buffer if the values need to be converted.
+Since the source maps are only accessed one chunk at a time, read-only
+memory-mapped maps (.map stores, or the on-disk cache of
+plot_map.get_data()) are read straight into the accumulator, without ever
+loading the full map in memory.
+
+The chunks can be processed by multiple threads, since numpy releases the
+GIL for the actual additions.
+"""
+
+import numpy as np
+import unyt
+from colour_lut import default_chunk_size, get_executor, get_row_chunks
+
+
+def zeros_like_map(data, dtype=np.float32):
+    """
+    Create an accumulator for maps like the given one: a map with the same
+    shape and units, with the given data type, filled with zeros.
+    """
+    return unyt.unyt_array(
+        np.zeros(data.shape, dtype=dtype), getattr(data, "units", unyt.dimensionless)
+    )
+
+
+def get_conversion_factor(data, total):
+    """
+    Get the factor that converts values of the given map into the units of
+    the given accumulator. Raises a unyt.exceptions.UnitConversionError if
+    the units are not compatible.
+    """
+    units = getattr(data, "units", unyt.dimensionless)
+    total_units = getattr(total, "units", unyt.dimensionless)
+    if units == total_units:
+        return 1.0
+    return float((1.0 * units).to_value(total_units))
+
+
+def add_map(total, data, nthread=1, chunk_size=default_chunk_size):
+    """
+    Add the given map to the given accumulator (see zeros_like_map()), in
+    place. The units are converted if necessary.
+
+    The rows are processed in chunks of approximately chunk_size pixels, using
+    nthread threads. Returns total.
+    """
+    if total.shape != data.shape:
+        raise RuntimeError(
+            f"Cannot add a map with shape {data.shape} to a map with shape"
+            f" {total.shape}!"
+        )
+    factor = get_conversion_factor(data, total)
+    target = np.asarray(total)
+    source = np.asarray(data)
+
+    def process_chunk(rows):
+        values = source[rows]
+        if factor != 1.0:
+            values = np.multiply(values, factor, dtype=target.dtype)
+        np.add(target[rows], values, out=target[rows], casting="same_kind")
+
+    if nthread > 1:
+        chunk_size = min(chunk_size, max(1, target.size // nthread))
+    chunks = list(get_row_chunks(target.shape, chunk_size))
+    if nthread > 1 and len(chunks) > 1:
+        # list() makes sure that exceptions in the threads are raised here
+        list(get_executor(nthread).map(process_chunk, chunks))
+    else:
+        for rows in chunks:
+            process_chunk(rows)
+    return total
+
+
+def sum_maps(maps, dtype=np.float32, nthread=1, chunk_size=default_chunk_size):
+    """
+    Sum the given maps into a new map with the given data type, in the units
+    of the first map. Returns the sum.
+    """
+    total = zeros_like_map(maps[0], dtype)
+    for data in maps:
+        add_map(total, data, nthread, chunk_size)
+    return total
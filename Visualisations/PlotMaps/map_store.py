@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""
+map_store.py
+
+Uncompressed, memory-mappable alternative to the .npz image maps.
+
+A map store is a folder with a .map extension that contains:
+ - <mapname>.npy: the raw map, stored as an uncompressed .npy array that can
+   be opened with numpy.load(..., mmap_mode="r"), so that only the pixels that
+   are actually used are read from disk.
+ - metadata.yml: the internal name and units of the map, its shape and data
+   type, the tile size, global statistics (minimum, maximum, mean and
+   minimum positive value) and the provenance record of the map (see below).
+ - tiles.npz: minimum, maximum, mean, minimum positive value and number of
+   valid pixels for each square tile of tile_size x tile_size pixels.
+
+<mapname> is the same internal name that is used in the .npz files
+("surfdens", "temp" or "rosat"). Statistics ignore NaN values.
+
+Both .map stores and .npz files can contain a provenance record: a dictionary
+with the parameters that were used to create the map. For .npz files, this is
+stored as a YAML string in an additional "provenance" array after the map
+itself. Scripts that generate maps can use this record to decide whether an
+existing map can be reused (see is_current()).
+
+All functions in this module work on both .map stores and .npz files, so that
+scripts can use either format. For .npz files, the statistics are computed on
+the fly (which requires decompressing the entire map).
+
+When run in standalone mode, the script converts the given .npz files into
+.map stores.
+"""
+
+import os
+import shutil
+import numpy as np
+import yaml
+
+# default size (in pixels) of the square tiles for which we store statistics
+default_tile_size = 512
+
+
+def is_map_store(filename):
+    """
+    Check if the given file name corresponds to a .map store (as opposed to a
+    .npz file).
+    """
+    return filename.rstrip("/").endswith(".map")
+
+
+def find_map(prefix):
+    """
+    Get the name of the map with the given prefix (the file name without
+    extension).
+
+    A .map store is preferred over a .npz file if both exist. If neither exists,
+    the .npz file name is returned.
+    """
+    if os.path.exists(f"{prefix}.map"):
+        return f"{prefix}.map"
+    return f"{prefix}.npz"
+
+
+def get_tile_statistics(data, tile_size=default_tile_size):
+    """
+    Compute the minimum, maximum and mean value for each tile of the given map.
+
+    The map is processed one row of tiles at a time, so that no temporary
+    copies of the entire map are made. The last row/column of tiles can be
+    smaller than tile_size if the map size is not a multiple of it.
+
+    Returns a dictionary with "min", "max", "mean", "posmin" and "count"
+    (number of non-NaN pixels) arrays, with one element per tile.
+    """
+    nx = (data.shape[0] + tile_size - 1) // tile_size
+    ny = (data.shape[1] + tile_size - 1) // tile_size
+    tiles = {key: np.zeros((nx, ny)) for key in ["min", "max", "mean", "posmin"]}
+    tiles["count"] = np.zeros((nx, ny), dtype=np.int64)
+    for i in range(nx):
+        row = np.asarray(data[i * tile_size : (i + 1) * tile_size], dtype=np.float64)
+        for j in range(ny):
+            tile = row[:, j * tile_size : (j + 1) * tile_size]
+            valid = tile[~np.isnan(tile)]
+            tiles["count"][i, j] = valid.size
+            if valid.size == 0:
+                for key in ["min", "max", "mean", "posmin"]:
+                    tiles[key][i, j] = np.nan
+                continue
+            tiles["min"][i, j] = valid.min()
+            tiles["max"][i, j] = valid.max()
+            tiles["mean"][i, j] = valid.mean()
+            positive = valid[valid > 0.0]
+            tiles["posmin"][i, j] = positive.min() if positive.size > 0 else np.nan
+    return tiles
+
+
+def save_map(filename, mapname, data, tile_size=default_tile_size, provenance=None):
+    """
+    Save the given map data under the given internal map name, with an
+    optional provenance record (a dictionary that can be stored in YAML).
+
+    If the file name has a .npz extension, the map is saved using
+    numpy.savez_compressed(), like before. Otherwise, a .map store is created.
+    In both cases, the output is first written to a temporary file/folder that
+    is only moved into place once it is complete, so that an interrupted run
+    never leaves behind a partial map.
+
+    Units are not stored in .npz files; for .map stores, we store the units of
+    the data (if it has any) in the metadata.
+    """
+    if not is_map_store(filename):
+        arrays = {mapname: data}
+        if provenance is not None:
+            arrays["provenance"] = np.array(yaml.safe_dump(provenance))
+        tmpname = f"{filename}.tmp"
+        with open(tmpname, "wb") as handle:
+            np.savez_compressed(handle, **arrays)
+        os.replace(tmpname, filename)
+        return
+
+    units = str(data.units) if hasattr(data, "units") else None
+    values = np.asarray(data)
+
+    # global statistics are derived from the tile statistics, so that we
+    # only need a single pass over the map
+    tiles = get_tile_statistics(values, tile_size)
+    valid = tiles["count"] > 0
+    positive = ~np.isnan(tiles["posmin"])
+    stats = {
+        "min": float(tiles["min"][valid].min()) if valid.any() else np.nan,
+        "max": float(tiles["max"][valid].max()) if valid.any() else np.nan,
+        "mean": float(
+            (tiles["mean"][valid] * tiles["count"][valid]).sum()
+            / max(tiles["count"].sum(), 1)
+        ),
+        "posmin": float(tiles["posmin"][positive].min()) if positive.any() else np.nan,
+    }
+
+    tmpname = f"{filename.rstrip('/')}.tmp"
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    os.makedirs(tmpname)
+    np.save(f"{tmpname}/{mapname}.npy", values)
+    np.savez(f"{tmpname}/tiles.npz", **tiles)
+    metadata = {
+        "name": mapname,
+        "units": units,
+        "shape": list(values.shape),
+        "dtype": values.dtype.str,
+        "tile_size": tile_size,
+        "statistics": stats,
+        "provenance": provenance,
+    }
+    with open(f"{tmpname}/metadata.yml", "w") as handle:
+        handle.write(yaml.safe_dump(metadata))
+
+    if os.path.exists(filename):
+        shutil.rmtree(filename)
+    os.rename(tmpname, filename)
+
+
+def get_metadata(filename):
+    """
+    Get the metadata dictionary of the given .map store.
+    """
+    with open(f"{filename}/metadata.yml", "r") as handle:
+        return yaml.safe_load(handle.read())
+
+
+def load_provenance(filename):
+    """
+    Get the provenance record of the given .map store or .npz file.
+
+    Returns None if the map does not exist, cannot be read, or does not
+    contain a provenance record.
+    """
+    try:
+        if is_map_store(filename):
+            return get_metadata(filename).get("provenance")
+        with np.load(filename) as datafile:
+            if not "provenance" in datafile.files:
+                return None
+            return yaml.safe_load(datafile["provenance"].item())
+    except Exception:
+        return None
+
+
+def is_current(filename, provenance):
+    """
+    Check if the given .map store or .npz file exists and was created with the
+    given provenance record, i.e. if it can be reused instead of regenerated.
+
+    Maps without provenance record are never considered current.
+    """
+    return load_provenance(filename) == provenance
+
+
+def get_mapname(filename):
+    """
+    Get the internal map name of the given .map store or .npz file.
+    """
+    if is_map_store(filename):
+        return get_metadata(filename)["name"]
+    with np.load(filename) as datafile:
+        return datafile.files[0]
+
+
+def load_map(filename, selection=None):
+    """
+    Load the map in the given .map store or .npz file.
+
+    The optional selection is given as [imin, imax, jmin, jmax] and restricts
+    the map to data[imin:imax, jmin:jmax].
+
+    Returns the internal map name and the map data. For .map stores, the data
+    is a read-only memory-mapped array: only the pixels that are actually
+    accessed are read from disk. Use numpy.array() to obtain a modifiable copy.
+    For .npz files, the entire map is decompressed and returned as a regular
+    array.
+    """
+    if is_map_store(filename):
+        mapname = get_metadata(filename)["name"]
+        data = np.load(f"{filename}/{mapname}.npy", mmap_mode="r")
+    else:
+        with np.load(filename) as datafile:
+            mapname = datafile.files[0]
+            data = datafile[mapname]
+    if selection is not None:
+        data = data[selection[0] : selection[1], selection[2] : selection[3]]
+    return mapname, data
+
+
+def get_statistics(filename):
+    """
+    Get the global statistics of the given .map store or .npz file.
+
+    Returns a dictionary with the internal map name ("name"), and the minimum
+    ("min"), maximum ("max"), mean ("mean") and minimum positive value
+    ("posmin") of the map.
+
+    For .map stores, these are read from the metadata without touching the map
+    itself. For .npz files, they are computed from the decompressed map.
+    """
+    if is_map_store(filename):
+        metadata = get_metadata(filename)
+        stats = dict(metadata["statistics"])
+        stats["name"] = metadata["name"]
+        return stats
+
+    mapname, data = load_map(filename)
+    positive = data[data > 0.0]
+    return {
+        "name": mapname,
+        "min": float(np.nanmin(data)),
+        "max": float(np.nanmax(data)),
+        "mean": float(np.nanmean(data)),
+        "posmin": float(positive.min()) if positive.size > 0 else np.nan,
+    }
+
+
+def load_tile_statistics(filename):
+    """
+    Get the per tile statistics of the given .map store.
+
+    Returns the tile size and a dictionary with "min", "max", "mean", "posmin"
+    and "count" arrays.
+    """
+    tile_size = get_metadata(filename)["tile_size"]
+    with np.load(f"{filename}/tiles.npz") as datafile:
+        tiles = {key: datafile[key] for key in datafile.files}
+    return tile_size, tiles
+
+
+def convert_map(input_name, output_name=None, tile_size=default_tile_size):
+    """
+    Convert the given .npz file into a .map store.
+
+    If no output name is given, the .npz extension is simply replaced with .map.
+    """
+    if output_name is None:
+        output_name = f"{input_name.removesuffix('.npz')}.map"
+    mapname, data = load_map(input_name)
+    save_map(output_name, mapname, data, tile_size, load_provenance(input_name))
+    return output_name
+
+
+if __name__ == "__main__":
+    """
+    Standalone mode: convert .npz files into .map stores.
+    """
+
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("input", nargs="+")
+    argparser.add_argument("--tile_size", "-t", type=int, default=default_tile_size)
+    args = argparser.parse_args()
+
+    for input_name in args.input:
+        print(convert_map(input_name, tile_size=args.tile_size))
@@ -12,9 +12,15 @@ scripts in ZoomMaps/ and have a name that matches one of the following patterns:
 where <boxsize> is the size of the simulation box in Mpc, <component> is one
 of "gas", "dm", "star" or "neutrinoNS", and <maptype> is one of "sigma",
 "temp" or "xray".
+The maps can also be stored in uncompressed .map stores (see map_store.py),
+in which case the .npz extension is replaced with .map.
 """
 
+import os
+import functools
+import hashlib
 import numpy as np
+import yaml
 import matplotlib
 
 matplotlib.use("Agg")
@@ -24,11 +30,13 @@ import re
 from swiftsimio.visualisation.tools.cmaps import LinearSegmentedCmap2D
 from matplotlib.colors import LinearSegmentedColormap
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
+from map_store import load_map
+from block_reduce import block_reduce
 
 # regular expressions used to obtain information from map file names.
 boxsize_re = re.compile("L(\d+)\_8192")
-label_re = re.compile("L\d+\_8192\_([a-zA-Z]+)\_map\_([a-zA-Z]+)\.npz")
-label_re2 = re.compile("L\d+\_8192\_([a-zA-Z]+)\_([a-zA-Z]+)\.npz")
+label_re = re.compile("L\d+\_8192\_([a-zA-Z]+)\_map\_([a-zA-Z]+)\.(?:npz|map)")
+label_re2 = re.compile("L\d+\_8192\_([a-zA-Z]+)\_([a-zA-Z]+)\.(?:npz|map)")
 
 # background neutrino surface density
 # value based on z=0 for the FLAMINGO cosmology
@@ -39,6 +47,9 @@ rho_nu = rho_crit * omega_nu
 sigma_nu = rho_nu * (20.0 * unyt.Mpc)
 sigma_nu.convert_to_base("galactic")
 
+# number of decoded maps that get_data() keeps in memory
+memo_size = 8
+
 # 2D gas surface density - temperature colour map (gas_temperature_map)
 # we go from black for low density, cold gas to white for high density, hot gas
 # high density, cold gas is blue and low density, hot gas is red
@@ -137,21 +148,104 @@ def get_units(mapname):
     }[mapname]
 
 
-def get_data(input_name, add_neutrino_correction=False):
+def decode_map(input_name, add_neutrino_correction=False):
+    """
+    Read the raw values from the given .npz file (or .map store) and convert
+    them to galactic units, optionally adding the neutrino correction.
+
+    The conversion is done in place on the values that were read, so that we
+    never hold more than one full copy of the map.
+
+    Returns the converted values (a plain numpy array) and their units.
+    """
+    mapname, data = load_map(input_name)
+    # memory-mapped .map stores are read-only: we need our own copy
+    if not data.flags.writeable or not np.issubdtype(data.dtype, np.floating):
+        data = np.array(data, dtype=np.result_type(data.dtype, np.float32))
+    factor = (1.0 * get_units(mapname)).in_base("galactic")
+    data *= data.dtype.type(factor.value)
+    if add_neutrino_correction:
+        data += data.dtype.type(sigma_nu.to(factor.units).value)
+    return data, factor.units
+
+
+def get_cache_name(input_name, mtime, add_neutrino_correction, cache_folder):
+    """
+    Get the base name (without extension) of the file in the given cache
+    folder that stores the decoded version of the given map.
+
+    The name contains a hash of the full path, modification time and neutrino
+    correction, so that a cached map is never used for a different (or
+    updated) map.
+    """
+    key = f"{os.path.abspath(input_name)}:{mtime}:{add_neutrino_correction}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    basename = os.path.basename(os.path.normpath(input_name))
+    return os.path.join(cache_folder, f"{basename}.{digest}")
+
+
+@functools.lru_cache(maxsize=memo_size)
+def load_decoded_map(input_name, mtime, add_neutrino_correction, cache_folder):
+    """
+    Memoised version of decode_map(). If a cache folder is given, decoded
+    maps are stored in that folder as uncompressed .npy files (with a small
+    YAML file for the units), which are memory-mapped when they are used
+    again, e.g. by a later run of the same script.
+
+    The modification time is only part of the arguments so that the memo is
+    invalidated when the map changes.
+
+    Returns a read-only array with the values and their units.
+    """
+    if cache_folder is None:
+        data, units = decode_map(input_name, add_neutrino_correction)
+        data.flags.writeable = False
+        return data, units
+
+    cache_name = get_cache_name(
+        input_name, mtime, add_neutrino_correction, cache_folder
+    )
+    # the YAML file is written last, so it only exists if the cache is complete
+    if not os.path.exists(f"{cache_name}.yml"):
+        os.makedirs(cache_folder, exist_ok=True)
+        data, units = decode_map(input_name, add_neutrino_correction)
+        tmpname = f"{cache_name}.tmp.{os.getpid()}.npy"
+        np.save(tmpname, data)
+        os.replace(tmpname, f"{cache_name}.npy")
+        del data
+        tmpname = f"{cache_name}.tmp.{os.getpid()}.yml"
+        with open(tmpname, "w") as handle:
+            handle.write(
+                yaml.safe_dump(
+                    {"source": os.path.abspath(input_name), "units": str(units)}
+                )
+            )
+        os.replace(tmpname, f"{cache_name}.yml")
+    with open(f"{cache_name}.yml", "r") as handle:
+        units = unyt.Unit(yaml.safe_load(handle.read())["units"])
+    return np.load(f"{cache_name}.npy", mmap_mode="r"), units
+
+
+def get_data(input_name, add_neutrino_correction=False, cache_folder=None):
     """
-    Get the data from a given .npz file.
+    Get the data from a given .npz file (or .map store, see map_store.py).
     The units are deduced automatically from the internal map name in the .npz
-    file.
+    file, and the data are converted to galactic units.
 
     Optionally add the (globally defined) neutrino correction.
+
+    The last memo_size maps are kept in memory, so asking for the same map
+    again is free. If cache_folder is given, decoded maps are also cached on
+    disk (see load_decoded_map()).
+
+    The returned array is a read-only view on the memoised map: use .copy()
+    to get a map that can be modified.
     """
-    with np.load(input_name) as datafile:
-        mapname = datafile.files[0]
-        data = datafile[mapname] * get_units(mapname)
-    if add_neutrino_correction:
-        data += sigma_nu
-    data.convert_to_base("galactic")
-    return data
+    mtime = os.stat(input_name).st_mtime_ns
+    data, units = load_decoded_map(
+        input_name, mtime, add_neutrino_correction, cache_folder
+    )
+    return unyt.unyt_array(data, units)
 
 
 def get_limits(data):
@@ -240,6 +334,52 @@ def create_map(data, lims, labels):
         return gas_temperature_map(*scaled_data), [gas_map, temperature_map], plot_lims
 
 
+def get_window_indices(imin, imax, shift, size):
+    """
+    Get the indices of pixels imin to imax (exclusive) of a periodically
+    shifted map axis with the given size, in the original (unshifted) map.
+
+    Returns a slice if the window does not wrap around the edge of the map,
+    or an index array if it does.
+    """
+    begin = (imin - shift) % size
+    if begin + imax - imin <= size:
+        return slice(begin, begin + imax - imin)
+    return (np.arange(imin, imax) - shift) % size
+
+
+def get_pixel_window(whole_extent, actual_extent, shape):
+    """
+    Get the range of pixels of a map with the given shape that covers the
+    whole_extent that are (at least partially) visible within actual_extent.
+
+    Returns [ixmin, ixmax, iymin, iymax] (exclusive upper limits).
+    """
+    window = []
+    for i in range(2):
+        size = whole_extent[2 * i + 1] - whole_extent[2 * i]
+        low = float((actual_extent[2 * i] - whole_extent[2 * i]) / size)
+        high = float((actual_extent[2 * i + 1] - whole_extent[2 * i]) / size)
+        window.append(min(max(int(np.floor(low * shape[i])), 0), shape[i]))
+        window.append(min(max(int(np.ceil(high * shape[i])), 0), shape[i]))
+    return window
+
+
+def get_downsampling_factor(ax, shape, dpi):
+    """
+    Get the largest integer factor by which a map with the given shape can be
+    downsampled without dropping below the resolution of the given axis in an
+    image with the given DPI.
+    """
+    fig = ax.get_figure()
+    bbox = ax.get_window_extent()
+    npix_x = bbox.width * dpi / fig.dpi
+    npix_y = bbox.height * dpi / fig.dpi
+    if npix_x <= 0 or npix_y <= 0:
+        return 1
+    return max(int(min(shape[0] / npix_x, shape[1] / npix_y)), 1)
+
+
 def plot_data_on_axis(
     data,
     vmin,
@@ -250,6 +390,7 @@ def plot_data_on_axis(
     shift=None,
     scale_label=True,
     cmap="viridis",
+    dpi=None,
 ):
     """
     Plot the given map data on the given axis, using the given data limits and
@@ -262,6 +403,12 @@ def plot_data_on_axis(
     The map is plotted with a scale indication (scale_label), and with the
     given colour map (cmap).
 
+    Only the pixels that are visible within actual_extent are extracted from
+    the map (the shift is applied to the pixel indices, the map itself is
+    never copied or rolled). If the DPI of the output image is given, the
+    visible pixels are additionally averaged down to the resolution of the
+    axis in the output image before they are plotted.
+
     Returns the AxesImage returned by matplotlib.imshow(). Can be used to
     create a colour bar based on the image.
     """
@@ -280,20 +427,46 @@ def plot_data_on_axis(
     whole_boxsize = whole_extent[1] - whole_extent[0]
     boxsize = actual_extent[1] - actual_extent[0]
 
-    # make a copy of the data to avoid overwriting the original
-    # then apply the shift, if one has been requested
-    datacopy = data.copy()
+    # get the pixel shift, if one has been requested
+    xshift = 0
+    yshift = 0
     if shift is not None:
         xshift = int(shift[0] / whole_boxsize * data.shape[0])
         yshift = int(shift[1] / whole_boxsize * data.shape[1])
-        datacopy = np.roll(datacopy, (xshift, yshift), axis=(0, 1))
+
+    # find the pixels that are visible and the extent they cover
+    ixmin, ixmax, iymin, iymax = get_pixel_window(
+        whole_extent, actual_extent, data.shape
+    )
+    # downsample to the output resolution, if requested
+    # we only use complete blocks of pixels, the partial blocks at the edge of
+    # the window are smaller than a pixel in the output image
+    factor = 1
+    if dpi is not None:
+        factor = get_downsampling_factor(ax, (ixmax - ixmin, iymax - iymin), dpi)
+        ixmax = ixmin + factor * ((ixmax - ixmin) // factor)
+        iymax = iymin + factor * ((iymax - iymin) // factor)
+    pixel_x = whole_boxsize / data.shape[0]
+    pixel_y = (whole_extent[3] - whole_extent[2]) / data.shape[1]
+    window_extent = [
+        whole_extent[0] + ixmin * pixel_x,
+        whole_extent[0] + ixmax * pixel_x,
+        whole_extent[2] + iymin * pixel_y,
+        whole_extent[2] + iymax * pixel_y,
+    ]
+
+    # extract the visible pixels (this does not modify the original)
+    window = data[get_window_indices(ixmin, ixmax, xshift, data.shape[0])]
+    window = window[:, get_window_indices(iymin, iymax, yshift, data.shape[1])]
+    if factor > 1:
+        window = block_reduce(window, factor, "mean")
 
     # plot the map
     vals = ax.imshow(
-        datacopy.T,
+        window.T,
         origin="lower",
         norm=matplotlib.colors.LogNorm(vmin.to(data.units), vmax.to(data.units)),
-        extent=whole_extent,
+        extent=window_extent,
         cmap=cmap,
     )
 
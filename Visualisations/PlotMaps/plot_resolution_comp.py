@@ -14,10 +14,22 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as pl
 import unyt
 from plot_map import get_data, get_limits, plot_data_on_axis
+from map_algebra import zeros_like_map, add_map
+from block_reduce import block_reduce
 
 # Set to True to generate fake image maps
 # Useful to run some quick tests, since loading the maps is quite slow
 dummy = False
+# folder used to cache the decoded maps, so that the next run can memory-map
+# them instead of decompressing the .npz files again (None disables the cache)
+cache_folder = "map_cache"
+# resolution of the output image. The maps are downsampled to this resolution
+# before they are plotted
+dpi = 300
+# data type used for the total mass map (np.float64 for full precision)
+total_dtype = np.float32
+# number of threads used to accumulate the total mass map and downsample maps
+nthread = 4
 
 # names and labels for the 3 different resolutions
 names = ["L1000N3600", "L1000N1800", "L1000N0900"]
@@ -69,7 +81,9 @@ for type, label in [
         dname = "map_sigma"
         files = [f"L1000_zooms/{res}/L63_8192_{type}_{dname}.npz" for res in names]
         if not dummy:
-            data = [get_data(file, type == "neutrinoNS") for file in files]
+            data = [
+                get_data(file, type == "neutrinoNS", cache_folder) for file in files
+            ]
         else:
             # create a dummy map instead
             data = [
@@ -80,25 +94,20 @@ for type, label in [
             ]
             data[0][40:60, 40:60] = 1.0
 
-    # accumulate the total masses
-    if total is None:
-        total = list(data)
-    else:
+    # accumulate the total masses (in a single buffer per map, see map_algebra.py)
+    # the total map itself is not added again
+    if type != "total":
+        if total is None:
+            total = [zeros_like_map(d, total_dtype) for d in data]
         for id in range(len(data)):
-            total[id] += data[id]
+            add_map(total[id], data[id], nthread)
     # skip maps that are not the total, since that is what we show in the paper
     if type != "total":
         continue
     # downgrade the stellar map to increase its brightness
     if type == "star":
         rfac = 8
-        res = data[0].shape[0] // rfac
-        newshape = (res, rfac, res, rfac)
-        for id in range(len(data)):
-            data_reshape = data[id].reshape(newshape)
-            data_reshape = data_reshape.mean(axis=1)
-            data_reshape = data_reshape.mean(axis=2)
-            data[id] = data_reshape
+        data = [block_reduce(d, rfac, "mean", nthread) for d in data]
 
     # get the data limits, to ensure the same colour map for the full map
     # and the zoom inset
@@ -133,7 +142,7 @@ for type, label in [
     # them, but then on a different axis
     for i, d in enumerate(data):
         # delegate the actual plotting to plot_data_on_axis()
-        vals = plot_data_on_axis(d, vmin, vmax, ax[i], extent)
+        vals = plot_data_on_axis(d, vmin, vmax, ax[i], extent, dpi=dpi)
         # plot the simulation name label
         ax[i].text(
             0.5,
@@ -146,7 +155,7 @@ for type, label in [
         ax[i].axis("off")
 
         # now plot the zoom map
-        plot_data_on_axis(d, vmin, vmax, iax[i], extent, actual_extent=zoom)
+        plot_data_on_axis(d, vmin, vmax, iax[i], extent, actual_extent=zoom, dpi=dpi)
         iax[i].set_xlim(zoom[0], zoom[1])
         iax[i].set_ylim(zoom[2], zoom[3])
         iax[i].axis("off")
@@ -165,6 +174,6 @@ for type, label in [
 
     # save the figure
     pl.tight_layout()
-    pl.savefig(f"compare_resolutions_{type}.png", dpi=300, bbox_inches="tight")
+    pl.savefig(f"compare_resolutions_{type}.png", dpi=dpi, bbox_inches="tight")
     # close the figure, in case we are plotting multiple components
     pl.close(fig)
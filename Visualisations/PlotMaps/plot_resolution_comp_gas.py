@@ -108,8 +108,8 @@ for type, label in [
         if key == "map_temp":
             vmin[key] = 1.0e5 * unyt.K
         vmax[key] = bounds[key][:, 1].max()
-        for d in data[key]:
-            d[d < vmin[key]] = vmin[key]
+        # (get_data() returns read-only maps, so we cannot clip in place)
+        data[key] = [np.maximum(d, vmin[key]) for d in data[key]]
 
     maps = [
         create_map(
@@ -13,6 +13,8 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as pl
 import unyt
 from plot_map import get_data, get_limits, plot_data_on_axis
+from map_algebra import zeros_like_map, add_map
+from block_reduce import block_reduce
 
 ## global parameters (can be changed freely):
 
@@ -20,6 +22,17 @@ from plot_map import get_data, get_limits, plot_data_on_axis
 # file data, making the script a lot faster to run. Useful for testing and
 # fine-tuning of plots.
 dummy = False
+# folder used to cache the decoded maps, so that the next run (e.g. for
+# another zoom level) can memory-map them instead of decompressing the .npz
+# files again. Set to None to disable the cache.
+cache_folder = "map_cache"
+# resolution of the output images. The maps are downsampled to this resolution
+# before they are plotted
+dpi = 300
+# data type used for the total mass map (np.float64 for full precision)
+total_dtype = np.float32
+# number of threads used to accumulate the total mass map and downsample maps
+nthread = 4
 # simulation to plot (possible options: L1000 or L2800)
 sim = "L2800"
 # how many levels of zoom to add (0-2)
@@ -127,7 +140,9 @@ for type, label in [
         map_info = [get_closest_map(tsize) for tsize in targets]
         files = [f"{path}/{map}_8192_{type}_{dname}.npz" for map, _ in map_info]
         if not dummy:
-            data = [get_data(file, type == "neutrinoNS") for file in files]
+            data = [
+                get_data(file, type == "neutrinoNS", cache_folder) for file in files
+            ]
         else:
             # dummy: generate random data instead
             data = [
@@ -139,12 +154,14 @@ for type, label in [
             # mark a square in the large map to check the positioning
             data[0][40:60, 40:60] = 1.0
 
-    # accumulate totals for the last map
-    if total is None:
-        total = list(data)
-    else:
+    # accumulate totals for the last map, in a single buffer per map
+    # (see map_algebra.py)
+    # the total map itself is not added again
+    if type != "total":
+        if total is None:
+            total = [zeros_like_map(d, total_dtype) for d in data]
         for id in range(len(data)):
-            total[id] += data[id]
+            add_map(total[id], data[id], nthread)
 
     # skip plotting the maps that are not "total" (for now)
     if type != "total":
@@ -153,13 +170,7 @@ for type, label in [
     # downsample the stellar map, since it looks horrible at file resolution
     if type == "star":
         rfac = 8
-        res = data[0].shape[0] // rfac
-        newshape = (res, rfac, res, rfac)
-        for id in range(len(data)):
-            data_reshape = data[id].reshape(newshape)
-            data_reshape = data_reshape.mean(axis=1)
-            data_reshape = data_reshape.mean(axis=2)
-            data[id] = data_reshape
+        data = [block_reduce(d, rfac, "mean", nthread) for d in data]
 
     # get the limits of the data
     bounds = np.array([get_limits(d) for d in data])
@@ -210,7 +221,9 @@ for type, label in [
         extents.append(extent)
         print(map_extent, extent)
         # plot the data on this level
-        vals = plot_data_on_axis(d, vmin, vmax, ax[i], map_extent, extent, shift=shift)
+        vals = plot_data_on_axis(
+            d, vmin, vmax, ax[i], map_extent, extent, shift=shift, dpi=dpi
+        )
         # set the appropriate extent on the axis
         ax[i].set_xlim(extent[0], extent[1])
         ax[i].set_ylim(extent[2], extent[3])
@@ -255,7 +268,7 @@ for type, label in [
     suffix = ["none", "half", "full"][level]
     pl.savefig(
         f"sequence/zoom_sequence_{output_suffix}_{type}_{suffix}.png",
-        dpi=300,
+        dpi=dpi,
         bbox_inches="tight",
     )
     # stop here if we are only testing things
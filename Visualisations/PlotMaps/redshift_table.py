@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+redshift_table.py
+
+Run-level table of snapshot redshifts and scale factors.
+
+Scripts that need the redshift of many snapshots (or of the same snapshot
+many times) should not open the snapshot headers over and over again. A
+RedshiftTable is created once, either from the output_list.txt file that
+SWIFT used to decide when to write snapshots (a single small file), or by
+reading the snapshot headers (in parallel), and then answers all queries from
+memory.
+
+SWIFT output lists contain a header line ("# Redshift", "# Scale Factor" or
+"# Time", optionally followed by ", Select Output") and one output per line,
+with the output time in the first column. Lists in "Time" units are not
+supported, since converting them requires the cosmology.
+"""
+
+import multiprocessing as mp
+import numpy as np
+import h5py
+
+
+def read_output_list(filename):
+    """
+    Get the redshifts of the outputs in the given SWIFT output list.
+    """
+    with open(filename, "r") as handle:
+        lines = handle.readlines()
+
+    column = "redshift"
+    values = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line.startswith("#"):
+            header = line[1:].split(",")[0].strip().lower()
+            if header in ["redshift", "scale factor", "time"]:
+                column = header
+            continue
+        values.append(float(line.split(",")[0]))
+    values = np.array(values, dtype=np.float64)
+
+    if column == "scale factor":
+        return 1.0 / values - 1.0
+    if column == "time":
+        raise RuntimeError(f"Output list in time units not supported: {filename}!")
+    return values
+
+
+def read_snapshot_redshift(filename):
+    """
+    Get the redshift from the header of the given snapshot file.
+    """
+    with h5py.File(filename, "r") as handle:
+        z = handle["Header"].attrs["Redshift"]
+    return float(np.ravel(z)[0])
+
+
+def read_snapshot_redshifts(filenames, nproc=1):
+    """
+    Get the redshifts from the headers of the given snapshot files, using
+    nproc processes.
+    """
+    if nproc > 1 and len(filenames) > 1:
+        with mp.Pool(min(nproc, len(filenames))) as pool:
+            return np.array(pool.map(read_snapshot_redshift, filenames))
+    return np.array([read_snapshot_redshift(filename) for filename in filenames])
+
+
+class RedshiftTable:
+    """
+    Redshifts and scale factors of all snapshots of a run, indexed by
+    snapshot number.
+    """
+
+    def __init__(self, redshifts):
+        """
+        Create a table with the given snapshot redshifts.
+        """
+        self.redshifts = np.asarray(redshifts, dtype=np.float64)
+        self.scale_factors = 1.0 / (1.0 + self.redshifts)
+
+    @classmethod
+    def from_output_list(cls, filename):
+        """
+        Create a table from the given SWIFT output list.
+        """
+        return cls(read_output_list(filename))
+
+    @classmethod
+    def from_snapshots(cls, filenames, nproc=1):
+        """
+        Create a table by reading the headers of the given snapshot files (in
+        order of snapshot number), using nproc processes.
+        """
+        return cls(read_snapshot_redshifts(filenames, nproc))
+
+    def __len__(self):
+        return self.redshifts.shape[0]
+
+    def get_redshift(self, snap):
+        """
+        Get the redshift of the given snapshot.
+        """
+        return self.redshifts[snap]
+
+    def get_scale_factor(self, snap):
+        """
+        Get the scale factor of the given snapshot.
+        """
+        return self.scale_factors[snap]
+
+    def get_interpolation_factor(self, snap, z):
+        """
+        Get the weight of snapshot snap+1 for linear interpolation in scale
+        factor between snapshots snap and snap+1 at the given redshift.
+        """
+        a = 1.0 / (1.0 + z)
+        a_1 = self.scale_factors[snap]
+        a_2 = self.scale_factors[snap + 1]
+        return (a - a_1) / (a_2 - a_1)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+tile_pyramid.py
+
+Memory-mapped pyramids of 8-bit RGBA image tiles.
+
+A pyramid stores an RGBA image (e.g. a map that was converted using
+colour_lut.py) at a number of levels: level 0 is the full resolution image,
+and every next level is a factor 2 smaller in both dimensions. Each pixel on a
+level combines 2x2 pixels on the previous level, using one or more reductions:
+"mean" (area averaging, the default for displaying an image at a lower
+resolution) and/or "max" (which preserves isolated bright pixels, e.g. stars
+in a mostly empty map). Every level is split into square tiles of
+tile_size x tile_size pixels that are stored contiguously, so that reading a
+small part of an image only touches the tiles that overlap with that part.
+
+A pyramid is a folder with a .pyramid extension that contains:
+ - metadata.yml: the shape of the full resolution image, the tile size, the
+   number of levels, the reductions and an optional provenance record (a
+   dictionary with the parameters that were used to create the image, see
+   map_store.py).
+ - <reduction>_XX.npy: the tiles for level XX, as an uncompressed array with
+   shape (ntile_rows, ntile_columns, tile_size, tile_size, 4). The image is
+   padded with transparent pixels to fill the last row/column of tiles.
+   Level 0 is only stored once, as mean_00.npy.
+
+The level arrays are opened with numpy.load(..., mmap_mode="r"), so that only
+the tiles that are actually used are read from disk, and processes that read
+the same pyramid share the same pages in memory: the levels are computed
+once, and all worker processes use the same read-only copy.
+"""
+
+import os
+import shutil
+import numpy as np
+import yaml
+
+# default size (in pixels) of the square tiles
+default_tile_size = 256
+
+# default reductions that are used to create the levels
+default_reductions = ["mean"]
+
+
+def downsample(image, reduction="mean"):
+    """
+    Reduce the size of the given RGBA image by a factor 2 in both dimensions,
+    by combining every 2x2 block of pixels using the given reduction.
+
+    Images with an odd number of rows/columns are padded by repeating the
+    last row/column.
+    """
+    nrow, ncol = image.shape[:2]
+    padding = ((0, nrow % 2), (0, ncol % 2), (0, 0))
+    if nrow % 2 or ncol % 2:
+        image = np.pad(image, padding, mode="edge")
+    blocks = image.reshape((image.shape[0] // 2, 2, image.shape[1] // 2, 2, -1))
+    if reduction == "mean":
+        result = blocks.sum(axis=(1, 3), dtype=np.uint16)
+        result += 2
+        result //= 4
+        return result.astype(np.uint8)
+    if reduction == "max":
+        return blocks.max(axis=(1, 3))
+    raise RuntimeError(f"Unknown reduction: {reduction}!")
+
+
+def split_tiles(image, tile_size):
+    """
+    Split the given RGBA image into square tiles, padding it with transparent
+    pixels if necessary.
+
+    Returns an array with shape (ntile_rows, ntile_columns, tile_size,
+    tile_size, 4).
+    """
+    nrow, ncol = image.shape[:2]
+    ntrow = (nrow + tile_size - 1) // tile_size
+    ntcol = (ncol + tile_size - 1) // tile_size
+    padded = np.zeros((ntrow * tile_size, ntcol * tile_size, 4), dtype=np.uint8)
+    padded[:nrow, :ncol] = image
+    tiles = padded.reshape((ntrow, tile_size, ntcol, tile_size, 4))
+    return np.ascontiguousarray(tiles.transpose((0, 2, 1, 3, 4)))
+
+
+def get_level_name(filename, reduction, level):
+    """
+    Get the name of the file that contains the given level for the given
+    reduction. All reductions share level 0.
+    """
+    if level == 0:
+        reduction = "mean"
+    return f"{filename}/{reduction}_{level:02d}.npy"
+
+
+def build_pyramid(
+    filename,
+    image,
+    tile_size=default_tile_size,
+    nlevel=None,
+    provenance=None,
+    reductions=default_reductions,
+):
+    """
+    Create a pyramid with the given file name from the given 8-bit RGBA image,
+    with levels for each of the given reductions ("mean" and/or "max").
+
+    If nlevel is not given, levels are added until the image fits into a
+    single tile. Like for map stores, the pyramid is first written to a
+    temporary folder that is only moved into place once it is complete.
+    """
+    if nlevel is None:
+        nlevel = 1
+        size = max(image.shape[:2])
+        while size > tile_size:
+            size = (size + 1) // 2
+            nlevel += 1
+
+    tmpname = f"{filename.rstrip('/')}.tmp"
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    os.makedirs(tmpname)
+
+    image = np.asarray(image, dtype=np.uint8)
+    np.save(get_level_name(tmpname, "mean", 0), split_tiles(image, tile_size))
+    for reduction in reductions:
+        level_image = image
+        for level in range(1, nlevel):
+            level_image = downsample(level_image, reduction)
+            np.save(
+                get_level_name(tmpname, reduction, level),
+                split_tiles(level_image, tile_size),
+            )
+    del level_image
+
+    metadata = {
+        "shape": list(image.shape[:2]),
+        "tile_size": tile_size,
+        "nlevel": nlevel,
+        "reductions": list(reductions),
+        "provenance": provenance,
+    }
+    with open(f"{tmpname}/metadata.yml", "w") as handle:
+        handle.write(yaml.safe_dump(metadata))
+
+    if os.path.exists(filename):
+        shutil.rmtree(filename)
+    os.rename(tmpname, filename)
+
+
+def load_pyramid_provenance(filename):
+    """
+    Get the provenance record of the given pyramid.
+
+    Returns None if the pyramid does not exist or cannot be read.
+    """
+    try:
+        with open(f"{filename}/metadata.yml", "r") as handle:
+            return yaml.safe_load(handle.read()).get("provenance")
+    except Exception:
+        return None
+
+
+class TilePyramid:
+    """
+    Read-only access to a pyramid created with build_pyramid().
+    """
+
+    def __init__(self, filename):
+        """
+        Open the pyramid with the given file name. The level arrays are
+        memory-mapped.
+        """
+        with open(f"{filename}/metadata.yml", "r") as handle:
+            metadata = yaml.safe_load(handle.read())
+        self.filename = filename
+        self.shape = tuple(metadata["shape"])
+        self.tile_size = metadata["tile_size"]
+        self.nlevel = metadata["nlevel"]
+        self.reductions = metadata.get("reductions", ["mean"])
+        self.levels = {
+            reduction: [
+                np.load(get_level_name(filename, reduction, level), mmap_mode="r")
+                for level in range(self.nlevel)
+            ]
+            for reduction in self.reductions
+        }
+
+    def get_shape(self, level):
+        """
+        Get the shape (number of rows and columns) of the image at the given
+        level.
+        """
+        nrow, ncol = self.shape
+        for _ in range(level):
+            nrow = (nrow + 1) // 2
+            ncol = (ncol + 1) // 2
+        return nrow, ncol
+
+    def get_level(self, scale):
+        """
+        Get the level that best matches the given scale, i.e. the number of
+        full resolution pixels per output pixel. This is the coarsest level
+        that still has at least one pixel per output pixel.
+        """
+        if scale <= 1.0:
+            return 0
+        return int(min(np.floor(np.log2(scale)), self.nlevel - 1))
+
+    def get_region(self, level, imin, imax, jmin, jmax, reduction="mean"):
+        """
+        Get the part [imin:imax, jmin:jmax] of the image at the given level,
+        for the given reduction. Only the tiles that overlap with this region
+        are read.
+
+        The region is clipped to the image. Returns an (imax-imin, jmax-jmin, 4)
+        RGBA array.
+        """
+        nrow, ncol = self.get_shape(level)
+        imin, imax = max(imin, 0), min(imax, nrow)
+        jmin, jmax = max(jmin, 0), min(jmax, ncol)
+        region = np.zeros((max(imax - imin, 0), max(jmax - jmin, 0), 4), dtype=np.uint8)
+        tiles = self.levels[reduction][level]
+        t = self.tile_size
+        for ti in range(imin // t, (imax + t - 1) // t):
+            for tj in range(jmin // t, (jmax + t - 1) // t):
+                i0 = max(imin, ti * t)
+                i1 = min(imax, (ti + 1) * t)
+                j0 = max(jmin, tj * t)
+                j1 = min(jmax, (tj + 1) * t)
+                region[i0 - imin : i1 - imin, j0 - jmin : j1 - jmin] = tiles[
+                    ti, tj, i0 - ti * t : i1 - ti * t, j0 - tj * t : j1 - tj * t
+                ]
+        return region
+
+    def get_image(self, level, reduction="mean"):
+        """
+        Get the entire image at the given level, for the given reduction.
+        """
+        nrow, ncol = self.get_shape(level)
+        return self.get_region(level, 0, nrow, 0, ncol, reduction)
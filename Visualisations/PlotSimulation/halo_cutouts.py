@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""
+halo_cutouts.py
+
+Batch engine to create gas surface density cutout images centred on a (large)
+number of halos from a SOAP catalogue.
+
+Instead of loading a separate region of the snapshot for every halo, the halos
+are grouped into cubic blocks that consist of an integer number of top-level
+cells. Each block is loaded once (together with a layer of cells that is thick
+enough to contain the cutouts of halos near the edge of the block), and all
+cutouts for halos in that block are rendered from the loaded particles.
+Rendering many halo thumbnails then requires a single sweep through the
+snapshot. Only cells in the boundary layers are read more than once; larger
+blocks reduce the number of cells that are read twice, at the cost of more
+memory.
+
+When run in standalone mode, the script renders thumbnails for all halos in a
+given mass range.
+"""
+
+import os
+import sys
+import numpy as np
+import h5py
+import swiftsimio as sw
+from swiftsimio.visualisation.projection import project_gas
+import unyt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../ZoomMaps"))
+from particle_tools import get_values, recentre_coordinates
+
+# particles are included in a cutout if their kernel (which extends at most
+# this many smoothing lengths from the particle) overlaps with the cutout
+kernel_extent = 2.0
+
+
+def read_halo_positions(
+    catalogue,
+    mass_range=None,
+    fraction=1.0,
+    seed=42,
+    mass_name="SO/200_crit/TotalMass",
+    position_name="VR/CentreOfPotential",
+):
+    """
+    Read the positions (in Mpc) of the halos in the given SOAP catalogue.
+
+    Optionally, only halos with a mass (mass_name) within the given mass_range
+    ([min, max], in the units of the catalogue) are selected. If fraction is
+    smaller than 1, a random subset of (approximately) that fraction of the
+    halos is selected. The random number generator is seeded with the given
+    seed to make the selection reproducible.
+    """
+    with h5py.File(catalogue, "r") as handle:
+        mass = handle[mass_name][:]
+        position = handle[position_name][:]
+
+    np.random.seed(seed)
+    rand = np.random.random(mass.shape)
+
+    mask = rand < fraction
+    if mass_range is not None:
+        mask &= (mass >= mass_range[0]) & (mass <= mass_range[1])
+    return position[mask] * unyt.Mpc
+
+
+def get_blocks(positions, boxsize, cell_size, block_size):
+    """
+    Group the given halo positions into cubic blocks.
+
+    The blocks consist of an integer number of top-level cells, so that the
+    block size is approximately block_size (but at least 1 cell).
+
+    Returns a list of tuples containing the lower and upper corner of a block
+    and the indices of the halos within that block. Empty blocks are omitted.
+    """
+    units = positions.units
+    b = get_values(boxsize, units, np.float64)
+    ncell = np.maximum(np.round(b / get_values(cell_size, units, np.float64)), 1)
+    ncell_per_block = np.maximum(
+        np.round(get_values(block_size, units, np.float64) / (b / ncell)), 1
+    )
+    nblock = np.ceil(ncell / ncell_per_block).astype(np.int64)
+    bsize = ncell_per_block * b / ncell
+
+    pos = np.mod(positions.to(units).value, b[None, :])
+    index = np.minimum(np.floor(pos / bsize[None, :]).astype(np.int64), nblock - 1)
+    keys = np.ravel_multi_index(index.T, nblock)
+
+    order = np.argsort(keys, kind="stable")
+    unique_keys, first = np.unique(keys[order], return_index=True)
+    blocks = []
+    for key, halos in zip(unique_keys, np.split(order, first[1:])):
+        lower = np.array(np.unravel_index(key, nblock)) * bsize
+        upper = np.minimum(lower + bsize, b)
+        blocks.append((lower * units, upper * units, halos))
+    return blocks
+
+
+def get_candidates(xsorted, xmin, xmax, boxsize):
+    """
+    Get the range(s) of indices in the sorted x coordinates that fall within
+    [xmin, xmax], taking into account periodic wrapping.
+    """
+    xmin = np.mod(xmin, boxsize)
+    xmax = np.mod(xmax, boxsize)
+    ilo = np.searchsorted(xsorted, xmin, side="left")
+    ihi = np.searchsorted(xsorted, xmax, side="right")
+    if xmin <= xmax:
+        return np.arange(ilo, ihi)
+    return np.concatenate([np.arange(ilo, xsorted.shape[0]), np.arange(0, ihi)])
+
+
+def make_cutouts(snapshot, positions, width, resolution, block_size=None):
+    """
+    Create gas surface density cutouts centred on the given halo positions.
+
+    Parameters:
+     - snapshot: str
+       Name of the snapshot file.
+     - positions: unyt.unyt_array
+       Positions of the halos, with shape (N, 3).
+     - width: unyt.unyt_quantity
+       Side length of the cutout cubes.
+     - resolution: int
+       Number of pixels on the side of each cutout image.
+     - block_size: unyt.unyt_quantity (default: None)
+       Approximate size of the blocks of top-level cells that are loaded in
+       one go. Defaults to 4 times the width of the cutouts.
+
+    This is a generator: it yields the index of a halo (in positions) and the
+    corresponding image (a unyt_array) as soon as it has been rendered. The
+    order in which halos are processed is determined by the block they belong
+    to.
+    """
+
+    if block_size is None:
+        block_size = 4.0 * width
+
+    mask = sw.mask(snapshot)
+    b = mask.metadata.boxsize
+    blocks = get_blocks(positions, b, mask.cell_size, block_size)
+
+    bcentre = 0.5 * b
+    half_width = 0.5 * width
+    region = [
+        bcentre[0] - half_width,
+        bcentre[0] + half_width,
+        bcentre[1] - half_width,
+        bcentre[1] + half_width,
+        bcentre[2] - half_width,
+        bcentre[2] + half_width,
+    ]
+
+    for iblock, (lower, upper, halos) in enumerate(blocks):
+        print(f"Loading block {iblock+1}/{len(blocks)} ({len(halos)} halos)")
+
+        # load the block, including a layer that is thick enough to contain
+        # the cutouts of all halos in the block
+        mask = sw.mask(snapshot)
+        load_region = [[lower[i] - half_width, upper[i] + half_width] for i in range(3)]
+        mask.constrain_spatial(load_region)
+        data = sw.load(snapshot, mask=mask)
+
+        # sort the particles on x coordinate, so that we can quickly find the
+        # particles that overlap with each cutout
+        coordinates = data.gas.coordinates
+        order = np.argsort(coordinates[:, 0].value)
+        coordinates = coordinates[order]
+        masses = data.gas.masses[order]
+        hsml = data.gas.smoothing_lengths[order]
+
+        units = coordinates.units
+        xsorted = np.mod(coordinates[:, 0].value, get_values(b[0], units, np.float64))
+        hmax = kernel_extent * hsml.to(units).value.max() if hsml.shape[0] > 0 else 0.0
+        box = get_values(b, units, np.float64)
+        r = get_values(half_width, units, np.float64)
+
+        for ihalo in halos:
+            p = get_values(positions[ihalo], units, np.float64)
+            candidates = get_candidates(
+                xsorted, p[0] - r - hmax, p[0] + r + hmax, box[0]
+            )
+
+            # select the particles that contribute to the cutout
+            # the projection only uses particles inside the slice along z, but
+            # also uses particles outside the image if their kernel overlaps
+            dx = coordinates[candidates].value - p[None, :]
+            dx -= box[None, :] * np.round(dx / box[None, :])
+            h = kernel_extent * hsml[candidates].to(units).value
+            selection = (
+                (np.abs(dx[:, 0]) <= r + h)
+                & (np.abs(dx[:, 1]) <= r + h)
+                & (np.abs(dx[:, 2]) <= r)
+            )
+            selection = candidates[selection]
+
+            # temporarily replace the particle data with the recentred cutout
+            data.gas.coordinates = coordinates[selection]
+            data.gas.masses = masses[selection]
+            data.gas.smoothing_lengths = hsml[selection]
+            recentre_coordinates(data.gas.coordinates, positions[ihalo], b)
+
+            img = project_gas(
+                data,
+                resolution=resolution,
+                project="masses",
+                parallel=True,
+                region=region,
+            )
+
+            yield ihalo, img
+
+        del data
+        del mask
+
+
+if __name__ == "__main__":
+    """
+    Standalone mode.
+    """
+
+    import argparse
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as pl
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("catalogue")
+    argparser.add_argument("snapshot")
+    argparser.add_argument("output_folder")
+    argparser.add_argument("--mass_range", "-m", type=float, nargs=2, default=None)
+    argparser.add_argument("--fraction", "-f", type=float, default=1.0)
+    argparser.add_argument("--width_in_Mpc", "-w", type=float, default=50.0)
+    argparser.add_argument("--block_size_in_Mpc", "-b", type=float, default=None)
+    argparser.add_argument("--resolution", "-r", type=int, default=1024)
+    args = argparser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    pos = read_halo_positions(args.catalogue, args.mass_range, args.fraction)
+    block_size = None
+    if args.block_size_in_Mpc is not None:
+        block_size = args.block_size_in_Mpc * unyt.Mpc
+
+    for ihalo, img in make_cutouts(
+        args.snapshot,
+        pos,
+        args.width_in_Mpc * unyt.Mpc,
+        args.resolution,
+        block_size,
+    ):
+        pl.imshow(img.T, origin="lower", norm=matplotlib.colors.LogNorm())
+        pl.axis("off")
+        pl.tight_layout()
+        pl.savefig(
+            f"{args.output_folder}/halo_{ihalo:03d}.png", dpi=300, bbox_inches="tight"
+        )
+        pl.close()
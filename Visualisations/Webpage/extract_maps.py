@@ -2,28 +2,111 @@ import numpy as np
 import h5py
 import healpy
 import unyt
+import multiprocessing
+import os
 
-def extract_map(data, name):
+# resolution of the Mollweide maps (the maps have res x res/2 pixels)
+res = 800
+# resolution of the HEALPix shell maps
+nside = 1024
+# number of shells and number of processes used to process them
+nshell = 68
+nproc = 8
+# number of HEALPix pixels that are read from a shell at once
+chunk_size = 1 << 22
+# folder used to cache the Mollweide projection index
+cache_folder = "projection_cache"
 
-    res = 800
-    mollproj = healpy.projector.MollweideProj(xsize=res)
+# projection index, shared by all shells (set by init_worker())
+projection = None
 
-    pdata = mollproj.projmap(
-        data, lambda x, y, z: healpy.vec2pix(1024, x, y, z)
-    )
+
+def get_projection_index(xsize, nside, cache_folder):
+    """
+    Get the HEALPix pixel index for each pixel in a Mollweide map with the
+    given size. The index only depends on xsize and nside, so it is computed
+    once and cached on disk.
+
+    Returns the shape of the Mollweide map, the (sorted) HEALPix indices of
+    all Mollweide pixels that are inside the projection, and the (flattened)
+    Mollweide pixel each of these corresponds to.
+    """
+    cache_name = f"{cache_folder}/mollweide_{xsize}_nside{nside}.npz"
+    if not os.path.exists(cache_name):
+        # project a map that contains its own pixel index: this is exactly the
+        # same as what projmap() does for an actual map. Pixels outside the
+        # projection get -inf
+        mollproj = healpy.projector.MollweideProj(xsize=xsize)
+        image = mollproj.projmap(
+            np.arange(healpy.nside2npix(nside), dtype=np.float64),
+            lambda x, y, z: healpy.vec2pix(nside, x, y, z),
+        )
+        index = image.ravel()
+        pixels = np.flatnonzero(np.isfinite(index))
+        index = index[pixels].astype(np.int64)
+        # sort on HEALPix index, so that every chunk of the shell maps to a
+        # contiguous range of Mollweide pixels
+        order = np.argsort(index, kind="stable")
+        os.makedirs(cache_folder, exist_ok=True)
+        tmpname = f"{cache_name}.tmp.{os.getpid()}.npz"
+        np.savez(
+            tmpname,
+            shape=np.array(image.shape),
+            index=index[order],
+            pixels=pixels[order],
+        )
+        os.replace(tmpname, cache_name)
+    with np.load(cache_name) as cache:
+        return tuple(cache["shape"]), cache["index"], cache["pixels"]
+
+
+def init_worker(xsize, nside, cache_folder):
+    global projection
+    projection = get_projection_index(xsize, nside, cache_folder)
+
+
+def extract_map(i):
+    """
+    Project the DM map of the given shell and save it as a binary file with
+    the base 10 logarithm of the values (in pc/cm^3), in single precision.
+    Pixels outside the projection (and pixels with negative values) are NaN.
+    """
+    shape, index, pixels = projection
+    pdata = np.full(shape[0] * shape[1], np.nan)
+
+    shell = f"lightcone0_shells/shell_{i}/lightcone0.shell_{i}.0.hdf5"
+    with h5py.File(shell, "r") as file:
+        dataset = file["DM"]
+        if dataset.shape[0] != healpy.nside2npix(nside):
+            raise RuntimeError(f"Shell {i} does not have nside {nside}!")
+        conversion = dataset.attrs[
+            "Conversion factor to CGS (not including cosmological corrections)"
+        ][0]
+        factor = (conversion * unyt.cm ** (-2)).to_value("pc/cm**3")
+        # the index is sorted, so every chunk fills a range of pixels
+        ranges = np.searchsorted(index, np.arange(0, dataset.shape[0], chunk_size))
+        ranges = np.append(ranges, index.shape[0])
+        for ichunk, begin in enumerate(range(0, dataset.shape[0], chunk_size)):
+            ibegin, iend = ranges[ichunk], ranges[ichunk + 1]
+            if ibegin == iend:
+                continue
+            data = dataset[begin : begin + chunk_size]
+            pdata[pixels[ibegin:iend]] = data[index[ibegin:iend] - begin]
+    pdata *= factor
 
     mask = pdata < 0.0
     pdata[mask] = np.nan
 
     logpdata = np.log10(pdata).astype(np.float32)
-    logpdata.tofile(name)
+    logpdata.tofile(f"maps/shell_{i}.dat")
 
 
-for i in range(68):
-    shell = f"lightcone0_shells/shell_{i}/lightcone0.shell_{i}.0.hdf5"
-    with h5py.File(shell, "r") as file:
-        conversion = file["DM"].attrs["Conversion factor to CGS (not including cosmological corrections)"][0]
-        data = unyt.unyt_array(file["DM"][:]*conversion, units="cm**(-2)")
-    data.convert_to_units("pc/cm**3")
+if __name__ == "__main__":
+
+    # make sure the projection index is cached before the workers need it
+    get_projection_index(res, nside, cache_folder)
 
-    extract_map(data.value, f"maps/shell_{i}.dat")
+    with multiprocessing.Pool(
+        nproc, initializer=init_worker, initargs=(res, nside, cache_folder)
+    ) as pool:
+        pool.map(extract_map, range(nshell))
@@ -6,6 +6,12 @@ from swiftsimio.visualisation.smoothing_length_generation import (
 import unyt
 import time
 import os
+import sys
+
+# the map storage functions are shared with the plotting scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../PlotMaps"))
+from map_store import save_map, load_map, is_current
+from particle_tools import recentre_coordinates, slab_mask, mask_particles
 
 """
 make_zoom_maps.py
@@ -28,12 +34,17 @@ def create_maps(
     centre: unyt.unyt_array,
     zwidth: unyt.unyt_quantity = 20.0 * unyt.Mpc,
     output_folder: str = "final_zoom_maps",
+    map_format: str = "npz",
+    slab_cut: bool = True,
+    neighbour_margin: unyt.unyt_quantity = 5.0 * unyt.Mpc,
+    map_callback=None,
 ):
     """
     Create maps for the given snapshot.
 
-    Maps are output in a folder (output_folder) as .npz files, with a name
-    set by the box size (boxsize) and resolution (res). 6 maps are created:
+    Maps are output in a folder (output_folder) as .npz files (or .map stores,
+    see below), with a name set by the box size (boxsize) and resolution (res).
+    6 maps are created:
      - <output_folder>/L<boxsize>_<res>_gas_map_sigma.npz:
        Gas surface density (in g cm^-2).
      - <output_folder>/L<boxsize>_<res>_gas_map_temp.npz:
@@ -54,6 +65,11 @@ def create_maps(
     used (because it does not really make sense to require 50 neighbours for
     a lonely star particle in a small halo).
 
+    Existing maps are only reused if they contain a provenance record that
+    matches the current snapshot (path and modification time) and parameters
+    (centre, boxsize, zwidth, res and projection backend). Otherwise, they are
+    regenerated.
+
     Parameters:
      - filename: str
        Name of the snapshot file.
@@ -68,19 +84,50 @@ def create_maps(
        Width of the slice along the projection direction (the z axis).
      - output_folder: str
        Name of the folder where the output .npz files are stored.
+     - map_format: str (default: "npz")
+       Format of the output maps: "npz" for compressed .npz files, or "map"
+       for uncompressed, memory-mappable .map stores (see
+       PlotMaps/map_store.py). The latter are larger, but a lot faster to read,
+       especially if only part of a map is needed.
+     - slab_cut: bool (default: True)
+       Discard particles outside the slice before they are passed on to the
+       projection. Gas and star particles are discarded while their
+       coordinates are recentred, which does not change the maps, since the
+       projection ignores these particles anyway. DM and neutrino particles
+       are discarded in two steps: particles further than neighbour_margin
+       from the slice are discarded before their smoothing lengths are
+       computed, and particles whose kernel does not intersect the slice are
+       discarded before the projection. The DM and neutrino maps are only
+       unchanged as long as the neighbours of all particles in the slice lie
+       within neighbour_margin of the slice (see below); set slab_cut to
+       False to compute the smoothing lengths from all particles.
+     - neighbour_margin: unyt.unyt_quantity (default: 5.*unyt.Mpc)
+       Width of the layer of DM and neutrino particles that is retained on
+       either side of the slice when computing smoothing lengths. This layer
+       needs to be large enough to contain the neighbours of all particles in
+       the slice, otherwise the smoothing lengths near the edges of the slice
+       will be overestimated.
+     - map_callback: function (default: None)
+       Function that is called with the file name, internal map name and
+       map (a unyt_array) for every map that is generated, right after it was
+       saved. This makes it possible to use the maps without reading them
+       back from disk (see PlotMaps/Evolution/pipeline.py). Maps that were up
+       to date are not passed on.
     """
 
     # deal with cosmo_array input
     centre = unyt.unyt_array(centre)
 
     # generate output file names
+    if not map_format in ["npz", "map"]:
+        raise RuntimeError(f"Unknown map format: {map_format}!")
     rname = f"L{boxsize:.0f}_{res}"
-    sname = f"{output_folder}/{rname}_gas_map_sigma.npz"
-    Tname = f"{output_folder}/{rname}_gas_map_temp.npz"
-    Xname = f"{output_folder}/{rname}_gas_map_xray.npz"
-    dname = f"{output_folder}/{rname}_dm_map_sigma.npz"
-    stname = f"{output_folder}/{rname}_star_map_sigma.npz"
-    nuname = f"{output_folder}/{rname}_neutrinoNS_map_sigma.npz"
+    sname = f"{output_folder}/{rname}_gas_map_sigma.{map_format}"
+    Tname = f"{output_folder}/{rname}_gas_map_temp.{map_format}"
+    Xname = f"{output_folder}/{rname}_gas_map_xray.{map_format}"
+    dname = f"{output_folder}/{rname}_dm_map_sigma.{map_format}"
+    stname = f"{output_folder}/{rname}_star_map_sigma.{map_format}"
+    nuname = f"{output_folder}/{rname}_neutrinoNS_map_sigma.{map_format}"
 
     # make sure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
@@ -88,6 +135,37 @@ def create_maps(
     # convert the box size into a unyt_quantity
     boxsize = boxsize * unyt.Mpc
 
+    # provenance records for the maps
+    # existing maps are only reused if their provenance record matches
+    provenance = {
+        "snapshot": os.path.abspath(filename),
+        "mtime": os.path.getmtime(filename),
+        "centre": [float(x) for x in centre.to("Mpc").value],
+        "boxsize": float(boxsize.to("Mpc").value),
+        "zwidth": float(zwidth.to("Mpc").value),
+        "resolution": int(res),
+    }
+    gas_provenance = dict(provenance, backend="subsampled")
+    star_provenance = dict(provenance, backend="histogram")
+    # the DM and neutrino smoothing lengths can depend on the neighbour margin
+    smoothed_provenance = dict(provenance, backend="subsampled")
+    if slab_cut:
+        smoothed_provenance["neighbour_margin"] = float(
+            neighbour_margin.to("Mpc").value
+        )
+
+    do_sigma = not is_current(sname, gas_provenance)
+    do_temp = not is_current(Tname, gas_provenance)
+    do_xray = not is_current(Xname, gas_provenance)
+    do_dm = not is_current(dname, smoothed_provenance)
+    do_star = not is_current(stname, star_provenance)
+    do_nu = not is_current(nuname, smoothed_provenance)
+    do_gas = do_sigma or do_temp or do_xray
+
+    if not (do_gas or do_dm or do_star or do_nu):
+        print("All maps are up to date")
+        return
+
     # set up the mask
     mask = sw.mask(filename)
     b = mask.metadata.boxsize
@@ -117,25 +195,36 @@ def create_maps(
 
     mask.constrain_spatial(load_region)
 
+    # the slice, and the (larger) slice containing the neighbours needed to
+    # compute smoothing lengths for the particles in that slice
+    zslab = region[4:]
+    neighbour_zslab = [zslab[0] - neighbour_margin, zslab[1] + neighbour_margin]
+
     # load the data
     data = sw.load(filename, mask=mask)
 
-    do_gas = (
-        (not os.path.exists(sname))
-        or (not os.path.exists(Tname))
-        or (not os.path.exists(Xname))
-    )
-
     # recentre and wrap gas coordinates
     if do_gas:
         tic = time.time()
-        data.gas.coordinates[:, :] += bcentre[None, :] - centre[None, :]
-        data.gas.coordinates = np.mod(data.gas.coordinates, b[None, :])
+        in_slab = recentre_coordinates(
+            data.gas.coordinates,
+            centre,
+            b,
+            zslab=zslab if slab_cut else None,
+        )
+        if slab_cut:
+            fields = ["coordinates", "masses", "smoothing_lengths"]
+            if do_temp:
+                fields.append("temperatures")
+            if do_xray:
+                fields.append("xray_luminosities.ROSAT")
+            mask_particles(data.gas, in_slab, fields)
+            del in_slab
         toc = time.time()
         print(f"Recentering gas coordinates took {toc-tic:.2f}s")
 
-    # generate the surface density map (if it does not exist yet)
-    if not os.path.exists(sname):
+    # generate the surface density map (if it is not up to date)
+    if do_sigma:
         tic = time.time()
         mass_map = sw.visualisation.projection.project_gas(
             data,
@@ -146,19 +235,21 @@ def create_maps(
             backend="subsampled",
         )
         mass_map.convert_to_units("g/cm**2")
-        np.savez_compressed(sname, surfdens=mass_map)
+        save_map(sname, "surfdens", mass_map, provenance=gas_provenance)
+        if map_callback is not None:
+            map_callback(sname, "surfdens", mass_map)
         toc = time.time()
         print(f"Generating gas surface density map took {toc-tic:.2f}s")
-    elif (not os.path.exists(Tname)) or (not os.path.exists(Xname)):
+    elif do_temp or do_xray:
         # load the map, since we need it for the temperature or X-ray
         # normalisation
-        mass_map = unyt.unyt_array(np.load(sname)["surfdens"], units="g/cm**2")
+        mass_map = unyt.unyt_array(load_map(sname)[1], units="g/cm**2")
         print("Loaded existing gas surface density map")
     else:
-        print("Gas surface density map exists, not loading it")
+        print("Gas surface density map is up to date, not loading it")
 
-    # generate the temperature map (if it does not exist yet)
-    if not os.path.exists(Tname):
+    # generate the temperature map (if it is not up to date)
+    if do_temp:
         tic = time.time()
         data.gas.mass_weighted_var = data.gas.masses * data.gas.temperatures
         mass_weighted_temp_map = sw.visualisation.projection.project_gas(
@@ -172,14 +263,16 @@ def create_maps(
         mass_weighted_temp_map.convert_to_units("K*g/cm**2")
         temp_map = mass_weighted_temp_map / mass_map
         temp_map.convert_to_units("K")
-        np.savez_compressed(Tname, temp=temp_map)
+        save_map(Tname, "temp", temp_map, provenance=gas_provenance)
+        if map_callback is not None:
+            map_callback(Tname, "temp", temp_map)
         toc = time.time()
         print(f"Generating gas temperature map took {toc-tic:.2f}s")
     else:
-        print("Gas temperature map already exists")
+        print("Gas temperature map is up to date")
 
-    # generate the X-ray map (if it does not exist yet)
-    if not os.path.exists(Xname):
+    # generate the X-ray map (if it is not up to date)
+    if do_xray:
         tic = time.time()
         data.gas.mass_weighted_var = data.gas.masses * data.gas.xray_luminosities.ROSAT
         mass_weighted_xray_map = sw.visualisation.projection.project_gas(
@@ -193,11 +286,13 @@ def create_maps(
         mass_weighted_xray_map.convert_to_units("erg/s*g/cm**2")
         xray_map = mass_weighted_xray_map / mass_map
         xray_map.convert_to_units("erg/s")
-        np.savez_compressed(Xname, rosat=xray_map)
+        save_map(Xname, "rosat", xray_map, provenance=gas_provenance)
+        if map_callback is not None:
+            map_callback(Xname, "rosat", xray_map)
         toc = time.time()
         print(f"Generating gas Xray map took {toc-tic:.2f}s")
     else:
-        print("Gas Xray map already exists")
+        print("Gas Xray map is up to date")
 
     # force unload of gas data?
     # not sure if this works, but since the memory footprint of the script is
@@ -208,12 +303,19 @@ def create_maps(
     data.gas.xray_luminosities.ROSAT = None
     data.gas.mass_weighted_var = None
 
-    # generate the DM surface density map (if it does not exist yet)
-    if not os.path.exists(dname):
+    # generate the DM surface density map (if it is not up to date)
+    if do_dm:
         # recentre and wrap dm coordinates
         tic = time.time()
-        data.dark_matter.coordinates += bcentre[None, :] - centre[None, :]
-        data.dark_matter.coordinates = np.mod(data.dark_matter.coordinates, b[None, :])
+        in_slab = recentre_coordinates(
+            data.dark_matter.coordinates,
+            centre,
+            b,
+            zslab=neighbour_zslab if slab_cut else None,
+        )
+        if slab_cut:
+            mask_particles(data.dark_matter, in_slab, ["coordinates", "masses"])
+            del in_slab
         toc = time.time()
         print(f"Recentering DM coordinates took {toc-tic:.2f}s")
 
@@ -230,6 +332,20 @@ def create_maps(
         toc = time.time()
         print(f"Generating dark matter smoothing lengths took {toc-tic:.2f}s")
 
+        if slab_cut:
+            in_slab = slab_mask(
+                data.dark_matter.coordinates,
+                zslab,
+                data.dark_matter.smoothing_length,
+                kernel_gamma=1.8,
+            )
+            mask_particles(
+                data.dark_matter,
+                in_slab,
+                ["coordinates", "masses", "smoothing_length"],
+            )
+            del in_slab
+
         tic = time.time()
         dm_mass = sw.visualisation.projection.project_pixel_grid(
             data=data.dark_matter,
@@ -245,11 +361,13 @@ def create_maps(
         units *= data.dark_matter.masses.units
         dm_mass = unyt.unyt_array(dm_mass, units=units)
         dm_mass.convert_to_units("g/cm**2")
-        np.savez_compressed(dname, surfdens=dm_mass)
+        save_map(dname, "surfdens", dm_mass, provenance=smoothed_provenance)
+        if map_callback is not None:
+            map_callback(dname, "surfdens", dm_mass)
         toc = time.time()
         print(f"Generating DM map took {toc-tic:.2f}s")
     else:
-        print("DM map already exists")
+        print("DM map is up to date")
 
     # try to reduce the memory footprint by unloading data (not sure if this
     # has an impact)
@@ -257,12 +375,19 @@ def create_maps(
     data.dark_matter.coordinates = None
     data.dark_matter.masses = None
 
-    # generate the stellar surface density map (if it does not exist yet)
-    if not os.path.exists(stname):
+    # generate the stellar surface density map (if it is not up to date)
+    if do_star:
         # recentre and wrap star coordinates
         tic = time.time()
-        data.stars.coordinates += bcentre[None, :] - centre[None, :]
-        data.stars.coordinates = np.mod(data.stars.coordinates, b[None, :])
+        in_slab = recentre_coordinates(
+            data.stars.coordinates,
+            centre,
+            b,
+            zslab=zslab if slab_cut else None,
+        )
+        if slab_cut:
+            mask_particles(data.stars, in_slab, ["coordinates", "masses"])
+            del in_slab
         toc = time.time()
         print(f"Recentering star coordinates took {toc-tic:.2f}s")
 
@@ -281,11 +406,13 @@ def create_maps(
         units *= data.stars.masses.units
         star_mass = unyt.unyt_array(star_mass, units=units)
         star_mass.convert_to_units("g/cm**2")
-        np.savez_compressed(stname, surfdens=star_mass)
+        save_map(stname, "surfdens", star_mass, provenance=star_provenance)
+        if map_callback is not None:
+            map_callback(stname, "surfdens", star_mass)
         toc = time.time()
         print(f"Generating stellar surface density map took {toc-tic:.2f}s")
     else:
-        print("Stellar surface density map already exists")
+        print("Stellar surface density map is up to date")
 
     # try to reduce the memory footprint by unloading data (not sure if this
     # has an impact)
@@ -293,12 +420,19 @@ def create_maps(
     data.stars.coordinates = None
     data.stars.masses = None
 
-    # generate the neutrino surface density map (if it does not exist yet)
-    if not os.path.exists(nuname):
+    # generate the neutrino surface density map (if it is not up to date)
+    if do_nu:
         data.neutrinos.weighted_masses = data.neutrinos.masses * data.neutrinos.weights
         tic = time.time()
-        data.neutrinos.coordinates += bcentre[None, :] - centre[None, :]
-        data.neutrinos.coordinates = np.mod(data.neutrinos.coordinates, b[None, :])
+        in_slab = recentre_coordinates(
+            data.neutrinos.coordinates,
+            centre,
+            b,
+            zslab=neighbour_zslab if slab_cut else None,
+        )
+        if slab_cut:
+            mask_particles(data.neutrinos, in_slab, ["coordinates", "weighted_masses"])
+            del in_slab
         toc = time.time()
         print(f"Recentering neutrino coordinates took {toc-tic:.2f}s")
 
@@ -314,6 +448,20 @@ def create_maps(
         toc = time.time()
         print(f"Generating neutrino smoothing lengths took {toc-tic:.2f}s")
 
+        if slab_cut:
+            in_slab = slab_mask(
+                data.neutrinos.coordinates,
+                zslab,
+                data.neutrinos.smoothing_length,
+                kernel_gamma=1.8,
+            )
+            mask_particles(
+                data.neutrinos,
+                in_slab,
+                ["coordinates", "weighted_masses", "smoothing_length"],
+            )
+            del in_slab
+
         tic = time.time()
         nu_mass = sw.visualisation.projection.project_pixel_grid(
             data=data.neutrinos,
@@ -329,11 +477,13 @@ def create_maps(
         units *= data.neutrinos.weighted_masses.units
         nu_mass = unyt.unyt_array(nu_mass, units=units)
         nu_mass.convert_to_units("g/cm**2")
-        np.savez_compressed(nuname, surfdens=nu_mass)
+        save_map(nuname, "surfdens", nu_mass, provenance=smoothed_provenance)
+        if map_callback is not None:
+            map_callback(nuname, "surfdens", nu_mass)
         toc = time.time()
         print(f"Generating neutrino map took {toc-tic:.2f}s")
     else:
-        print("Neutrino map already exists")
+        print("Neutrino map is up to date")
 
     # try to reduce the memory footprint by unloading data (not sure if this
     # has an impact)
@@ -357,6 +507,7 @@ if __name__ == "__main__":
 
     argparser = argparse.ArgumentParser()
     argparser.add_argument("output_folder")
+    argparser.add_argument("--map_format", "-f", choices=["npz", "map"], default="npz")
     args = argparser.parse_args()
 
     filename = "L1000N0900.hdf5"
@@ -366,4 +517,12 @@ if __name__ == "__main__":
 
     centre = [500.0 * unyt.Mpc, 500.0 * unyt.Mpc, 500.0 * unyt.Mpc]
 
-    create_maps(filename, boxsize, res, centre, 20.0 * unyt.Mpc, args.output_folder)
+    create_maps(
+        filename,
+        boxsize,
+        res,
+        centre,
+        20.0 * unyt.Mpc,
+        args.output_folder,
+        args.map_format,
+    )
@@ -0,0 +1,153 @@
+import numpy as np
+import unyt
+
+"""
+particle_tools.py
+
+Helper functions to manipulate particle data before it is projected onto a
+map.
+
+All functions operate in place on the raw coordinate values, in their native
+data type and units, to avoid making temporary copies of (large) particle
+arrays.
+"""
+
+# number of particles that is processed in one go
+# this limits the size of the temporary arrays used to compute slab masks
+default_chunk_size = 1 << 20
+
+
+def get_values(quantity, units, dtype):
+    """
+    Get the raw values of the given quantity in the given units, as an array
+    with the given data type.
+
+    Quantities without units are assumed to already be in the right units.
+    """
+    if hasattr(quantity, "units"):
+        quantity = unyt.unyt_array(quantity)
+        if units is not None:
+            quantity = quantity.to(units)
+        quantity = quantity.value
+    return np.asarray(quantity, dtype=dtype)
+
+
+def recentre_coordinates(
+    coordinates, centre, boxsize, zslab=None, chunk_size=default_chunk_size
+):
+    """
+    Periodically recentre the given coordinates on the given centre, so that
+    the centre ends up in the middle of the box.
+
+    This is equivalent to
+      coordinates += 0.5 * boxsize - centre
+      coordinates = np.mod(coordinates, boxsize)
+    but is done in place, in the native data type and units of the coordinates.
+
+    If a z slab [zmin, zmax] (in recentred coordinates) is given, the function
+    also returns a mask that selects the particles inside that slab. This mask
+    is computed in the same pass over the coordinates. Otherwise, None is
+    returned.
+
+    Parameters:
+     - coordinates: unyt.unyt_array or numpy.NDArray[float]
+       Particle coordinates, with shape (N, 3). Modified in place.
+     - centre: unyt.unyt_array or numpy.NDArray[float]
+       Position that should end up in the centre of the box.
+     - boxsize: unyt.unyt_array or numpy.NDArray[float]
+       Size of the (periodic) box in all 3 dimensions.
+     - zslab: list of 2 unyt.unyt_quantity or float (default: None)
+       Lower and upper bound of the slab along the z axis.
+     - chunk_size: int
+       Number of particles to process in one go.
+    """
+    units = coordinates.units if hasattr(coordinates, "units") else None
+    values = coordinates.view(np.ndarray)
+    b = get_values(boxsize, units, values.dtype)
+    shift = 0.5 * b - get_values(centre, units, values.dtype)
+
+    in_slab = None
+    if zslab is not None:
+        zmin = get_values(zslab[0], units, values.dtype)
+        zmax = get_values(zslab[1], units, values.dtype)
+        in_slab = np.zeros(values.shape[0], dtype=bool)
+
+    for ibegin in range(0, values.shape[0], chunk_size):
+        chunk = values[ibegin : ibegin + chunk_size]
+        np.add(chunk, shift[None, :], out=chunk)
+        np.mod(chunk, b[None, :], out=chunk)
+        if in_slab is not None:
+            slab = in_slab[ibegin : ibegin + chunk_size]
+            np.greater_equal(chunk[:, 2], zmin, out=slab)
+            slab &= chunk[:, 2] <= zmax
+
+    return in_slab
+
+
+def slab_mask(
+    coordinates,
+    zslab,
+    smoothing_lengths=None,
+    kernel_gamma=1.0,
+    chunk_size=default_chunk_size,
+):
+    """
+    Get a mask that selects the particles whose kernel intersects the given
+    z slab [zmin, zmax].
+
+    The kernel of a particle extends kernel_gamma times its smoothing length
+    on either side of its position. If no smoothing lengths are given, the
+    particles are treated as points and only particles inside the slab are
+    selected.
+
+    Parameters:
+     - coordinates: unyt.unyt_array or numpy.NDArray[float]
+       Particle coordinates, with shape (N, 3). Should already be recentred
+       (see recentre_coordinates()); periodic wrapping is not taken into
+       account.
+     - zslab: list of 2 unyt.unyt_quantity or float
+       Lower and upper bound of the slab along the z axis.
+     - smoothing_lengths: unyt.unyt_array or numpy.NDArray[float] (default: None)
+       Particle smoothing lengths, with shape (N,).
+     - kernel_gamma: float (default: 1.0)
+       Ratio of the kernel support radius and the smoothing length.
+     - chunk_size: int
+       Number of particles to process in one go.
+    """
+    units = coordinates.units if hasattr(coordinates, "units") else None
+    values = coordinates.view(np.ndarray)
+    zmin = get_values(zslab[0], units, values.dtype)
+    zmax = get_values(zslab[1], units, values.dtype)
+    if smoothing_lengths is not None:
+        hsml = get_values(smoothing_lengths, units, values.dtype)
+
+    in_slab = np.zeros(values.shape[0], dtype=bool)
+    for ibegin in range(0, values.shape[0], chunk_size):
+        z = values[ibegin : ibegin + chunk_size, 2]
+        slab = in_slab[ibegin : ibegin + chunk_size]
+        if smoothing_lengths is None:
+            np.greater_equal(z, zmin, out=slab)
+            slab &= z <= zmax
+        else:
+            h = kernel_gamma * hsml[ibegin : ibegin + chunk_size]
+            np.greater_equal(z + h, zmin, out=slab)
+            slab &= z - h <= zmax
+
+    return in_slab
+
+
+def mask_particles(dataset, mask, fields):
+    """
+    Only retain the particles selected by the given mask for the given fields
+    of the given swiftsimio particle dataset (e.g. data.gas).
+
+    Fields are given by name, and can refer to named columns using a "."
+    (e.g. "xray_luminosities.ROSAT"). Fields that have not been read yet are
+    read before they are masked.
+    """
+    for field in fields:
+        parent = dataset
+        names = field.split(".")
+        for name in names[:-1]:
+            parent = getattr(parent, name)
+        setattr(parent, names[-1], getattr(parent, names[-1])[mask])
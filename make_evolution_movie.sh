@@ -32,6 +32,15 @@ python -u Visualisations/PlotMaps/Evolution/add_redshift.py "${dirname}/limits.y
 # Creating frames
 python -u Visualisations/PlotMaps/Evolution/plot_frames.py "${dirname}/limits_with_z.yml"  "${dirname}/frames" --nproc=10 --nframe="$n_frame"
 
+# Alternatively, pipe the frames directly into ffmpeg (if available), which
+# writes one video per quantity (e.g. dm.mp4) instead of PNG frames:
+# python -u Visualisations/PlotMaps/Evolution/plot_frames.py "${dirname}/limits_with_z.yml"  "${dirname}/frames" --nproc=10 --nframe="$n_frame" --video --framerate=10
+
+# Alternatively, run all of the steps above in a single process, keeping the
+# maps in shared memory instead of reading them back from disk (the output list
+# contains the snapshot redshifts):
+# python -u Visualisations/PlotMaps/Evolution/pipeline.py "${flamingo}/snapshots/flamingo_{snap:04d}/flamingo_{snap:04d}.hdf5" "${flamingo}/output_list.txt" $dirname "${dirname}/frames" --boxsize=700 --resolution=8192 --centre 579.619106529648 873.5596484955305 832.4762741155331 --nproc=10 --nframe="$n_frame" --memory_budget=64
+
 # Copy files to laptop
 # Set framerate such that runtime is ~20s
 # $ffmpeg -framerate 10 -i dm_frame_%04d.png -c:v libx264 -pix_fmt yuv420p 0_dm.mp4